@@ -54,5 +54,5 @@ setuptools.setup(
     include_package_data=True,
     entry_points={
         'console_scripts': [
-            'taskcmd = tasklib.cli:main',
+            'taskcmd = tasklib.client:main',
         ]})
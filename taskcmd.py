@@ -5,5 +5,5 @@ import sys
 current_directory = os.path.dirname(__file__)
 sys.path.append(current_directory)
 
-from tasklib import cli
-cli.main()
+from tasklib import client
+client.main()
@@ -23,18 +23,37 @@ the task itself or pre/post test.
   is correct by the 'verify' function and during the initialization.
 * If verification is failed action should raise 'exceptions.NotValidMetadata'
 * Action SHOULD run its payload when 'run' method is called.
+* Action MAY provide its payload as a generator of steps in 'steps' to be
+  run by the async engine.
+* Action SHOULD run its commands in the task directory given by 'cwd'.
 * If action is failed it should raise 'exceptions.Failed'
+* Action SHOULD stop its payload after the 'timeout' and raise
+  'exceptions.TimedOut'. Retries are done by the task.
 * Action SHOULD return report when 'report' method is called. The report
   should be a String, preferably in xUnit xml format, or None, it there is
   no report to return.
+* Action MAY return additional report files as a dictionary of file names
+  and contents when 'artifacts' method is called.
 * Action MAY implement 'reset' method to reload to the initial state if it's
   required.
+* Action MAY implement 'fingerprint_paths' method to return the files and
+  directories its result depends on besides its metadata.
 * Action MAY use logger and config values from the parent task.
+* Action SHOULD run its commands with the resource limits of the task
+  given by 'preexec' (see the resources module).
+* Action SHOULD save the full output of the commands it runs to the
+  'output_file' of its phase and keep only a limited tail of it in memory.
+* Action SHOULD keep the commands it has run in 'commands', their run times
+  and resource usage are recorded by the task.
 * Action MUST NOT work with reports and tests, it's Task's job.
 * Action MUST NOT interfere with status and processes, it's Agent's job.
 """
 
+import os
+
+from tasklib import common
 from tasklib import exceptions
+from tasklib import resources
 
 
 class Action(object):
@@ -43,11 +62,19 @@ class Action(object):
     It should be inherited and implemented by other actions
     """
 
-    def __init__(self, task, data):
+    def __init__(self, task, data, phase=None):
         self.task = task
         self.data = data
+        self.phase = phase
+        self.output_files = {}
+        if self.phase:
+            for stream in ('stdout', 'stderr'):
+                self.output_files[stream] = os.path.abspath(
+                    self.task.output_file(self.phase, stream))
         self.verify()
         self.log = task.log
+        self.limits = resources.Limits.for_task(task)
+        self.commands = []
         self.log.debug("Task: '%s' action: '%s' init",
                        self.task.name, self.type)
 
@@ -55,15 +82,122 @@ class Action(object):
     def type(self):
         return self.__class__.__name__
 
+    @property
+    def timeout(self):
+        """Maximum run time in seconds or None if there is no limit
+
+        :rtype: float
+        """
+        timeout = self.data.get('timeout', None)
+        if not timeout:
+            return None
+        return float(timeout)
+
+    @property
+    def retries(self):
+        """How many times the failed action should be retried
+
+        :rtype: int
+        """
+        return int(self.data.get('retries', None) or 0)
+
+    @property
+    def interval(self):
+        """Delay before the retry in seconds
+
+        :rtype: float
+        """
+        return float(self.data.get('interval', None) or 0)
+
     def reset(self):
         pass
 
     def verify(self):
         if not isinstance(self.data, dict):
-            raise exceptions.NotValidMetadata()
+            raise exceptions.NotValidMetadata(str(self.task))
+
+    def output_file(self, stream):
+        """Path to save the stdout or stderr of the action
+
+        The path is absolute because the action runs in the task directory.
+        :param stream: 'stdout' or 'stderr'
+        :rtype: str
+        :return: path or None if the action is not a phase of the task
+        """
+        return self.output_files.get(stream, None)
+
+    def task_path(self, path):
+        """Path relative to the task directory
+
+        :param path: str
+        :rtype: str
+        """
+        return os.path.join(self.task.task_directory or '', path)
+
+    def fingerprint_paths(self):
+        paths = self.data.get('fingerprint_paths') or []
+        return [self.task_path(path) for path in paths]
+
+    @property
+    def cwd(self):
+        return self.task.working_directory
+
+    def preexec(self):
+        """Function applying the resource limits of the task
+
+        :rtype: callable
+        :return: function to run in the command process or None
+        """
+        if self.limits is None:
+            return None
+        return self.limits.preexec()
+
+    def new_command(self, cmd):
+        """Create the command to run for this action
+
+        :param cmd: str
+        :rtype: common.Command
+        """
+        command = common.Command(
+            cmd,
+            self.output_file('stdout'),
+            self.output_file('stderr'),
+            self.timeout,
+            self.task.config['exec_mode'] == 'direct',
+            self.cwd,
+            self.preexec(),
+        )
+        self.commands.append(command)
+        return command
+
+    def command_stats(self):
+        """Run times and resource usage of the started commands
+
+        :rtype: list
+        """
+        return [command.stats() for command in self.commands
+                if command.started is not None]
 
     def run(self):
         raise NotImplementedError('Should be implemented by action driver.')
 
+    def steps(self):
+        """Steps of the action for the engines
+
+        Actions able to wait for their commands in the async engine yield
+        them here and make 'run' use engine.run(self.steps()). By default
+        the action is just run.
+        :return: generator of steps
+        """
+        yield self.run()
+
     def report(self):
         raise NotImplementedError('Should be implemented by action driver.')
+
+    def artifacts(self):
+        """Additional report files of the last run
+
+        :rtype: dict
+        :return: Dictionary of file names and their contents
+        """
+        return {}
@@ -0,0 +1,125 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Cache of compiled Puppet catalogs.
+
+* A catalog is stored in the 'catalog_dir' under the hash of everything
+  its compilation depends on: the node name, the manifest, the modules,
+  the hiera configuration and data and the facts files.
+* Any change of these inputs gives another key, so a stale catalog is
+  never used. Old catalogs stay until the cache is purged.
+* Hits and misses of the current process are counted and logged.
+"""
+
+import hashlib
+import json
+import logging
+import os
+
+from tasklib import common
+
+counters = {
+    'hit': 0,
+    'miss': 0,
+}
+
+
+class CatalogCache(object):
+    def __init__(self, config, log=None):
+        self.config = config
+        self.log = log or logging.getLogger(__name__)
+        self.directory = config['catalog_dir']
+
+    def key(self, node, paths):
+        """Hash of the catalog inputs
+
+        :param node: node name the catalog is compiled for
+        :param paths: manifest and modules paths
+        :rtype: str
+        """
+        digest = hashlib.sha1()
+        digest.update(node + '\0')
+        for path in list(paths) + \
+                list(self.config['hiera_paths'] or []) + \
+                list(self.config['facts_paths'] or []):
+            common.update_digest(digest, path)
+        return digest.hexdigest()
+
+    def catalog_file(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def lookup(self, key):
+        """Find the cached catalog and count the hit or miss
+
+        :param key: str
+        :rtype: str
+        :return: path to the catalog or None if it's not cached
+        """
+        path = self.catalog_file(key)
+        if os.path.isfile(path):
+            counters['hit'] += 1
+            result = 'hit'
+        else:
+            counters['miss'] += 1
+            result = 'miss'
+            path = None
+        self.log.info("Catalog cache %s: '%s' hits: %d misses: %d",
+                      result, key, counters['hit'], counters['miss'])
+        return path
+
+    def store(self, key, compile_output):
+        """Save the catalog from the output of the compilation
+
+        Puppet can print messages before the catalog, so everything before
+        the first line of the JSON document is dropped.
+        :param key: str
+        :param compile_output: path to the stdout of 'puppet master --compile'
+        :rtype: str
+        :return: path to the catalog or None if there is no valid catalog
+        """
+        with open(compile_output, 'r') as f:
+            lines = f.readlines()
+        for number, line in enumerate(lines):
+            if line.startswith('{'):
+                catalog = ''.join(lines[number:])
+                break
+        else:
+            return None
+        try:
+            json.loads(catalog)
+        except ValueError:
+            return None
+        common.ensure_dir_created(self.directory)
+        path = self.catalog_file(key)
+        temp_file = '%s.%d' % (path, os.getpid())
+        with open(temp_file, 'w') as f:
+            f.write(catalog)
+        os.rename(temp_file, path)
+        return path
+
+    def purge(self):
+        """Remove all cached catalogs
+
+        :rtype: int
+        :return: number of removed catalogs
+        """
+        if not os.path.isdir(self.directory):
+            return 0
+        removed = 0
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            os.unlink(os.path.join(self.directory, file_name))
+            removed += 1
+        return removed
@@ -0,0 +1,216 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Persistent shell coprocess.
+
+Starting a new shell for every small command takes more time than the
+command itself. A coprocess is a long living shell which reads commands
+from its stdin and runs them one by one.
+
+* Every command is run in a subshell of the coprocess in the given
+  directory or in the current directory of the caller, so changes of the
+  directory and the environment done by a command do not affect the next
+  one.
+* Output of the command is redirected to the given files. The exit code is
+  written to the coprocess stdout after a unique sentinel line.
+* If the command times out the whole coprocess is killed and a new one is
+  started for the next command.
+* A coprocess found dead when a command is sent is started again. If it
+  exits while it runs a command, exceptions.CoprocessExited is raised and
+  a new one is started for the next command.
+* There is one coprocess for every process using it, a forked worker never
+  uses the coprocess of its parent.
+"""
+
+import errno
+import os
+import pipes
+import select
+import subprocess
+import tempfile
+import uuid
+
+from tasklib import common
+from tasklib import exceptions
+
+
+class Coprocess(object):
+    def __init__(self, shell):
+        self.shell = shell
+        self.process = None
+        self.owner = None
+        self.buffer = ''
+
+    def alive(self):
+        if self.process is None or self.owner != os.getpid():
+            return False
+        return self.process.poll() is None
+
+    def start(self):
+        with open(os.devnull, 'r+') as devnull:
+            self.process = subprocess.Popen(
+                [self.shell, '--noprofile', '--norc'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                close_fds=True,
+                preexec_fn=os.setsid,
+            )
+        self.owner = os.getpid()
+        self.buffer = ''
+
+    def stop(self):
+        if self.process is None:
+            return
+        # the coprocess of the parent of a forked worker is left alone
+        if self.owner == os.getpid():
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            common.kill_group(self.process)
+            self.process.stdout.close()
+        self.process = None
+
+    def send(self, script):
+        """Write the script to the coprocess
+
+        A coprocess which has exited is started again once.
+        :param script: str
+        :raises: exceptions.CoprocessExited if it can't be written
+        """
+        for attempt in range(2):
+            if not self.alive():
+                self.stop()
+                self.start()
+            try:
+                self.process.stdin.write(script)
+                self.process.stdin.flush()
+                return
+            except IOError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                self.stop()
+        raise exceptions.CoprocessExited(self.shell)
+
+    def script(self, cmd, stdout_file, stderr_file, sentinel, cwd=None):
+        """Shell code to run the command and report its exit code
+
+        :rtype: str
+        """
+        return "( cd %s && eval %s ) >%s 2>%s </dev/null\n" \
+               "printf '%%s %%d\\n' %s $?\n" % (
+                   pipes.quote(cwd or os.getcwd()),
+                   pipes.quote(cmd),
+                   pipes.quote(stdout_file),
+                   pipes.quote(stderr_file),
+                   sentinel,
+               )
+
+    def read_line(self, deadline):
+        """Read the next line of the coprocess stdout
+
+        :param deadline: monotonic clock deadline or None
+        :rtype: str
+        :return: the line or None if the deadline has passed
+        :raises: exceptions.CoprocessExited at the end of the output
+        """
+        fd = self.process.stdout.fileno()
+        while '\n' not in self.buffer:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - common.monotonic()
+                if timeout <= 0:
+                    return None
+            try:
+                readable = select.select([fd], [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                return None
+            data = os.read(fd, 4096)
+            if not data:
+                raise exceptions.CoprocessExited(self.shell)
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def execute(self, cmd, stdout_file=None, stderr_file=None, tail=None,
+                timeout=None, cwd=None):
+        """Run the command in the coprocess
+
+        Has the same arguments and return value as common.execute
+        :rtype: tuple
+        :return: exit code and tails of stdout and stderr
+        :raises: exceptions.CoprocessExited if the coprocess has exited
+                 without running the command to the end
+        """
+        if tail is None:
+            tail = common.DEFAULT_OUTPUT_TAIL
+        deadline = None
+        if timeout:
+            deadline = common.monotonic() + timeout
+        temp_files = []
+        if not stdout_file:
+            stdout_file = self.temp_file(temp_files)
+        if not stderr_file:
+            stderr_file = self.temp_file(temp_files)
+        try:
+            sentinel = uuid.uuid4().hex
+            self.send(self.script(
+                cmd, stdout_file, stderr_file, sentinel, cwd))
+            code = None
+            while True:
+                try:
+                    line = self.read_line(deadline)
+                except exceptions.CoprocessExited:
+                    self.stop()
+                    raise
+                if line is None:
+                    self.stop()
+                    break
+                if line.startswith(sentinel + ' '):
+                    code = int(line.split()[1])
+                    break
+            with open(stdout_file, 'rb') as stdout:
+                with open(stderr_file, 'rb') as stderr:
+                    return (code,
+                            common.read_tail(stdout, tail),
+                            common.read_tail(stderr, tail))
+        finally:
+            for temp_file in temp_files:
+                os.unlink(temp_file)
+
+    @staticmethod
+    def temp_file(temp_files):
+        fd, path = tempfile.mkstemp(prefix='tasklib')
+        os.close(fd)
+        temp_files.append(path)
+        return path
+
+
+coprocesses = {}
+
+
+def coprocess(shell):
+    """Get the coprocess of the current process
+
+    :param shell: path to bash
+    :rtype: Coprocess
+    """
+    if shell not in coprocesses:
+        coprocesses[shell] = Coprocess(shell)
+    return coprocesses[shell]
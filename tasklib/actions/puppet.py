@@ -12,13 +12,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import json
 import logging
 import os
+import pipes
+import socket
+import tempfile
+from xml.etree import ElementTree
 import yaml
 
 from tasklib.actions import action
-from tasklib import exceptions
+from tasklib.actions import catalog
+from tasklib.actions import puppet_report
 from tasklib import common
+from tasklib import engine
+from tasklib import exceptions
 
 log = logging.getLogger(__name__)
 
@@ -28,9 +36,14 @@ class PuppetAction(action.Action):
 
     Implements support for Puppet type actions.
     Can apply a single manifest and determine success or failure.
+    Every run uses its own state directory so puppet tasks can run
+    at the same time without reading the reports of each other.
+    With the catalog cache the catalog is compiled only if its inputs have
+    changed and the cached catalog is applied.
     """
     LAST_RUN_REPORT = '/var/lib/puppet/state/last_run_report.yaml'
-    report = None
+    parsed_report = None
+    catalog = None
     resources = None
     metrics = None
     exit_code = None
@@ -42,7 +55,7 @@ class PuppetAction(action.Action):
 
         :return:
         """
-        self.report = None
+        self.parsed_report = None
         self.resources = None
         self.metrics = None
         self.exit_code = None
@@ -52,11 +65,12 @@ class PuppetAction(action.Action):
     def run_puppet(self):
         """Execute the puppet command
 
-        :rtype: int
+        :return: generator of steps
         """
-        self.exit_code, self.stdout, self.stderr \
-            = common.execute(self.command)
-        return self.exit_code
+        command = self.new_command(self.command)
+        yield command
+        self.exit_code, self.stdout, self.stderr = command.result(
+            self.task.config['output_tail'])
 
     @property
     def puppet_report(self):
@@ -65,11 +79,10 @@ class PuppetAction(action.Action):
         :rtype : dict
         :return: Parsed Puppet report structure
         """
-        if self.report:
-            return self.report
-        self.reset_mnemoization()
-        self.report = self.load_report_file()
-        return self.report
+        if self.parsed_report:
+            return self.parsed_report
+        self.parsed_report = self.load_report_file()
+        return self.parsed_report
 
     @property
     def puppet_resources(self):
@@ -111,6 +124,128 @@ class PuppetAction(action.Action):
             self.metrics[event[1]] = event[2]
         return self.metrics
 
+    @property
+    def puppet_time_metrics(self):
+        """Get time metrics data from the time section
+
+        :rtype: dict
+        :return: Dictionary of the evaluation time of resource types
+        """
+        if not self.puppet_report:
+            return None
+        values = self.puppet_report\
+            .get('metrics', {})\
+            .get('time', {})\
+            .get('values', {})
+        metrics = {}
+        for value in values:
+            metrics[value[1]] = value[2]
+        return metrics
+
+    @property
+    def resource_profile(self):
+        """Evaluation time and state of every resource
+
+        :rtype: list
+        :return: List of resource dictionaries, the slowest first
+        """
+        return self.profile_resources(self.puppet_resources)
+
+    @classmethod
+    def profile_resources(cls, resources):
+        """Evaluation time and state of the resources
+
+        :param resources: dictionary of resource structures
+        :rtype: list
+        :return: List of resource dictionaries, the slowest first
+        """
+        profile = []
+        for title, params in (resources or {}).iteritems():
+            params = params or {}
+            profile.append({
+                'title': title,
+                'type': params.get('resource_type') or title.split('[')[0],
+                'time': float(params.get('evaluation_time') or 0),
+                'changed': bool(params.get('changed')),
+                'failed': bool(params.get('failed')),
+                'skipped': bool(params.get('skipped')),
+            })
+        profile.sort(key=lambda resource: (-resource['time'],
+                                           resource['title']))
+        return profile
+
+    def profile(self, resources):
+        """Profiling summary of the run
+
+        :param resources: resource profile
+        :rtype: dict
+        :return: slowest resources and the time spent by resource types
+        """
+        types = {}
+        for resource in resources:
+            resource_type = types.setdefault(resource['type'], {
+                'count': 0,
+                'time': 0.0,
+            })
+            resource_type['count'] += 1
+            resource_type['time'] += resource['time']
+        return {
+            'total_time': sum(resource['time'] for resource in resources),
+            'metrics_time': self.puppet_time_metrics,
+            'types': types,
+            'slowest': resources[:self.task.config['profile_top']],
+        }
+
+    def junit(self, resources, name=None):
+        """JUnit report with a test case for every resource
+
+        :param resources: resource profile
+        :param name: test suite name, the task name by default
+        :rtype: str
+        """
+        suite = ElementTree.Element('testsuite', {
+            'name': name or self.task.name,
+            'tests': str(len(resources)),
+            'failures': str(len([r for r in resources if r['failed']])),
+            'skipped': str(len([r for r in resources if r['skipped']])),
+            'time': '%.6f' % sum(r['time'] for r in resources),
+        })
+        for resource in resources:
+            case = ElementTree.SubElement(suite, 'testcase', {
+                'classname': resource['type'],
+                'name': resource['title'],
+                'time': '%.6f' % resource['time'],
+            })
+            if resource['failed']:
+                ElementTree.SubElement(case, 'failure', {
+                    'message': 'Resource failed',
+                })
+            elif resource['skipped']:
+                ElementTree.SubElement(case, 'skipped')
+        return ElementTree.tostring(suite, 'utf-8')
+
+    def artifacts(self):
+        """Profiling report and JUnit report of the resources
+
+        :rtype: dict
+        """
+        if not self.puppet_report:
+            return {}
+        return self.profile_artifacts(self.resource_profile)
+
+    def profile_artifacts(self, resources, name=None):
+        """Profiling report and JUnit report of the resource profile
+
+        :param resources: resource profile
+        :param name: test suite name, the task name by default
+        :rtype: dict
+        """
+        return {
+            'profile.json': json.dumps(self.profile(resources),
+                                       indent=2, sort_keys=True),
+            'junit.xml': self.junit(resources, name),
+        }
+
     @property
     def success_deployment_status(self):
         """Get deployment status from report
@@ -182,13 +317,66 @@ class PuppetAction(action.Action):
         return criterias
 
     def run(self):
+        engine.run(self.steps())
+        return self.exit_code
+
+    def compile_catalog(self):
+        """Find the cached catalog or compile and cache it
+
+        :return: generator of steps
+        """
+        cache = catalog.CatalogCache(self.task.config, self.log)
+        key = cache.key(self.catalog_node, self.catalog_inputs())
+        self.catalog = cache.lookup(key)
+        if self.catalog:
+            return
+        log.debug(
+            "Compiling catalog of puppet task '%s' with command '%s'",
+            self.task.name,
+            self.compile_command
+        )
+        fd, compile_output = tempfile.mkstemp(prefix='tasklib')
+        os.close(fd)
+        try:
+            command = common.Command(
+                self.compile_command,
+                compile_output,
+                self.output_file('stderr'),
+                self.timeout,
+                self.task.config['exec_mode'] == 'direct',
+                self.cwd,
+                self.preexec(),
+            )
+            self.commands.append(command)
+            yield command
+            self.exit_code = command.code
+            if self.exit_code is None:
+                raise exceptions.TimedOut(
+                    self.task.name, self.type, self.timeout)
+            if self.exit_code == 0:
+                self.catalog = cache.store(key, compile_output)
+        finally:
+            os.unlink(compile_output)
+        if not self.catalog:
+            log.warning("Catalog compilation of puppet task '%s' failed",
+                        self.task.name)
+            raise exceptions.Failed(self.task.name, self.type)
+
+    def steps(self):
+        self.reset_mnemoization()
+        self.prepare_state_directory()
+        self.catalog = None
+        if self.use_catalog_cache:
+            yield self.compile_catalog()
+
         log.debug(
             "Running puppet task '%s' with command '%s'",
             self.task.name,
             self.command
         )
-
-        self.run_puppet()
+        yield self.run_puppet()
+        if self.exit_code is None:
+            raise exceptions.TimedOut(self.task.name, self.type, self.timeout)
 
         log.debug(
             "Task '%s' with cmd '%s' returned code '%s' out: '%s' err: '%s'",
@@ -203,9 +391,27 @@ class PuppetAction(action.Action):
         log.debug("Success: %s", repr(success))
 
         if False in success.values():
-            raise exceptions.Failed()
+            raise exceptions.Failed(self.task.name, self.type)
 
-        return self.exit_code
+    def report(self):
+        """Summary of the last run
+
+        :rtype: str
+        :return: the report or None if there was no run
+        """
+        if self.exit_code is None and self.stdout is None:
+            return None
+        status = None
+        if self.puppet_report:
+            status = self.puppet_report.get('status', None)
+        return "command: '%s' status: '%s' stdout: '%s' stderr: '%s' " \
+               "code: '%s'" % (
+                   self.command,
+                   status,
+                   self.stdout,
+                   self.stderr,
+                   self.exit_code,
+               )
 
     @classmethod
     def filter_useless_resources(cls, resource_title):
@@ -222,54 +428,59 @@ class PuppetAction(action.Action):
             return False
         return True
 
-    @classmethod
-    def construct_ruby_object(cls, loader, suffix, node):
-        """Parse ruby objects
+    def load_report_file(self):
+        """Read and parse the Puppet report file
 
-        :param loader:
-        :param suffix:
-        :param node:
-        :return:
+        Only the parts used by the action are parsed.
+        :rtype: dict
+        :return: The parsed Puppet report
         """
-        return loader.construct_yaml_map(node)
+        try:
+            with open(self.last_run_report, 'rb') as f:
+                return puppet_report.load(f)
+        except IOError:
+            return None
+        except yaml.YAMLError as e:
+            log.warning("Task '%s' puppet report '%s' is not valid: %s",
+                        self.task.name, self.last_run_report, e)
+            return None
 
-    @classmethod
-    def construct_ruby_sym(cls, loader, node):
-        """Parse ruby symbols
+    @property
+    def state_directory(self):
+        """Puppet state directory of this task phase
 
-        :param loader:
-        :param node:
-        :return:
+        It's inside the report directory and is used instead of the
+        global state directory of Puppet.
+        :rtype: str
+        :return: path or None if the action is not a phase of the task
         """
-        return loader.construct_yaml_str(node)
+        if not self.phase:
+            return None
+        return os.path.abspath(os.path.join(
+            self.task.config['report_dir'],
+            '%s.%s.puppet' % (self.task.id, self.phase),
+        ))
 
-    @classmethod
-    def extend_yaml(cls):
-        """Extend yaml module to support Puppet reports
+    @property
+    def last_run_report(self):
+        """Path to the report of the last Puppet run
 
-        :return:
+        :rtype: str
         """
-        yaml.add_multi_constructor(u"!ruby/object:",
-                                   cls.construct_ruby_object)
-        yaml.add_constructor(u"!ruby/sym",
-                             cls.construct_ruby_sym)
+        if not self.state_directory:
+            return self.LAST_RUN_REPORT
+        return os.path.join(self.state_directory, 'last_run_report.yaml')
 
-    def load_report_file(self):
-        """Read and parse the Puppet report file
+    def prepare_state_directory(self):
+        """Create the state directory and remove the previous report
 
-        :rtype: dict
-        :return: The parsed Puppet report
+        :return:
         """
-        try:
-            f = open(self.LAST_RUN_REPORT, 'r')
-            raw_report = f.read()
-            f.close()
-        except IOError:
-            return None
-
-        if raw_report:
-            self.extend_yaml()
-            return yaml.load(raw_report)
+        if not self.state_directory:
+            return
+        common.ensure_dir_created(self.state_directory)
+        if os.path.exists(self.last_run_report):
+            os.unlink(self.last_run_report)
 
     @property
     def manifest(self):
@@ -278,8 +489,8 @@ class PuppetAction(action.Action):
         :rtype: str
         :return: Manifest file name
         """
-        return (self.task.metadata.get('puppet_manifest') or
-                self.config['puppet_manifest'])
+        return (self.data.get('puppet_manifest') or
+                self.task.config['puppet_manifest'])
 
     @property
     def puppet_options(self):
@@ -288,9 +499,9 @@ class PuppetAction(action.Action):
         :rtype: str
         :return: String of Puppet options
         """
-        if 'puppet_options' in self.task.metadata:
-            return self.task.metadata['puppet_options']
-        return self.config['puppet_options']
+        if 'puppet_options' in self.data:
+            return self.data['puppet_options']
+        return self.task.config['puppet_options']
 
     @property
     def puppet_modules(self):
@@ -299,8 +510,49 @@ class PuppetAction(action.Action):
         :rtype: str
         :return: The path to Puppet modules
         """
-        return (self.task.metadata.get('puppet_modules') or
-                self.config['puppet_modules'])
+        return (self.data.get('puppet_modules') or
+                self.task.config['puppet_modules'])
+
+    @property
+    def use_catalog_cache(self):
+        """Apply the cached compiled catalog
+
+        :rtype: bool
+        """
+        if 'catalog_cache' in self.data:
+            return bool(self.data['catalog_cache'])
+        return bool(self.task.config['catalog_cache'])
+
+    @property
+    def catalog_node(self):
+        """Node name to compile the catalog for
+
+        :rtype: str
+        """
+        return self.task.config['catalog_node'] or socket.getfqdn()
+
+    def catalog_inputs(self):
+        """The manifest and the modules the catalog is compiled from
+
+        :rtype: list
+        """
+        paths = [self.manifest]
+        if self.puppet_modules:
+            paths.extend(self.puppet_modules.split(':'))
+        return [self.task_path(path) for path in paths]
+
+    @property
+    def compile_command(self):
+        """Command printing the compiled catalog
+
+        :rtype: str
+        """
+        cmd = ['puppet', 'master', '--compile', pipes.quote(self.catalog_node),
+               '--color=false',
+               pipes.quote('--manifest={0}'.format(self.manifest))]
+        if self.puppet_modules:
+            cmd.append('--modulepath={0}'.format(self.puppet_modules))
+        return ' '.join(cmd)
 
     @property
     def command(self):
@@ -312,9 +564,30 @@ class PuppetAction(action.Action):
         cmd = ['puppet', 'apply', '--detailed-exitcodes']
         if self.puppet_modules:
             cmd.append('--modulepath={0}'.format(self.puppet_modules))
+        if self.state_directory:
+            cmd.append(pipes.quote(
+                '--statedir={0}'.format(self.state_directory)))
+            cmd.append(pipes.quote('--lastrunfile={0}'.format(
+                os.path.join(self.state_directory, 'last_run_summary.yaml'))))
+            cmd.append(pipes.quote(
+                '--lastrunreport={0}'.format(self.last_run_report)))
         if self.puppet_options:
             cmd.append(self.puppet_options)
-        if self.config['debug']:
+        if self.task.config['debug']:
             cmd.append('--debug --verbose --evaltrace --trace')
-        cmd.append(os.path.join(self.task.dir, self.manifest))
+        if self.catalog:
+            cmd.append(pipes.quote('--catalog={0}'.format(self.catalog)))
+        else:
+            cmd.append(self.manifest)
         return ' '.join(cmd)
+
+    def fingerprint_paths(self):
+        """The manifest and either the selected paths or the modules
+
+        Relative paths are relative to the task directory.
+        :rtype: list
+        """
+        paths = [self.manifest]
+        paths.extend(self.data.get('fingerprint_paths') or
+                     self.puppet_modules.split(':'))
+        return [self.task_path(path) for path in paths]
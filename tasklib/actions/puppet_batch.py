@@ -0,0 +1,152 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Puppet action applying the manifests of several tasks in a single run.
+
+* The manifest of every task is wrapped into its own class in a generated
+  manifest. The classes are declared and chained in the order of the tasks
+  and Puppet is run with '--ordering=manifest'.
+* Puppet tags the resources declared by a class with the class name, so
+  the resources of the report can be split back by the tasks.
+* Resources of the classes included by the task manifests have no task
+  tags. They are not attributed to any task and their failure fails all
+  tasks of the batch.
+* A task manifest should not define nodes or import other manifests.
+"""
+
+import os
+
+from tasklib.actions import puppet
+from tasklib import common
+
+
+class BatchAction(puppet.PuppetAction):
+    """Puppet action for a chain of puppet tasks.
+
+    It's created by the first task of the chain and gets the other tasks
+    in their run order.
+    """
+
+    def __init__(self, task, data, phase, tasks):
+        self.tasks = tasks
+        super(BatchAction, self).__init__(task, data, phase)
+
+    @staticmethod
+    def class_name(index):
+        return 'tasklib_batch_%d' % index
+
+    @property
+    def timeout(self):
+        """Sum of the timeouts of the tasks or None if any has no limit
+
+        :rtype: float
+        """
+        timeouts = [puppet.PuppetAction(task, task.task_data).timeout
+                    for task in self.tasks]
+        if None in timeouts:
+            return None
+        return sum(timeouts)
+
+    @property
+    def manifest(self):
+        return os.path.join(self.state_directory, 'batch.pp')
+
+    @property
+    def puppet_options(self):
+        options = super(BatchAction, self).puppet_options
+        return ' '.join(filter(None, [options, '--ordering=manifest']))
+
+    @property
+    def use_catalog_cache(self):
+        return False
+
+    def write_manifest(self):
+        """Generate the manifest applying all tasks of the batch
+
+        :return:
+        """
+        lines = ['# Generated by tasklib for tasks: %s' %
+                 ', '.join(task.id for task in self.tasks)]
+        for index, task in enumerate(self.tasks):
+            action = puppet.PuppetAction(task, task.task_data)
+            with open(action.task_path(action.manifest), 'r') as f:
+                body = f.read()
+            lines.append('# Task: %s' % task.id)
+            lines.append('class %s {' % self.class_name(index))
+            lines.append(body.rstrip('\n'))
+            lines.append('}')
+        for index in range(len(self.tasks)):
+            lines.append('include %s' % self.class_name(index))
+        lines.append(' -> '.join("Class['%s']" % self.class_name(index)
+                                 for index in range(len(self.tasks))))
+        common.ensure_dir_created(self.state_directory)
+        with open(self.manifest, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def steps(self):
+        self.write_manifest()
+        yield super(BatchAction, self).steps()
+
+    def split(self):
+        """Split the resources of the report by the tasks
+
+        :rtype: tuple
+        :return: dictionary of task ids and their resources and
+                 the resources not attributed to any task
+        """
+        resources = dict((task.id, {}) for task in self.tasks)
+        unattributed = {}
+        for title, params in (self.puppet_resources or {}).iteritems():
+            tags = (params or {}).get('tags', None) or []
+            for index, task in enumerate(self.tasks):
+                if self.class_name(index) in tags:
+                    resources[task.id][title] = params
+                    break
+            else:
+                unattributed[title] = params
+        return resources, unattributed
+
+    def task_report(self, task, resources):
+        """Report of a single task of the batch
+
+        :param task: Task
+        :param resources: dictionary of the task resources
+        :rtype: str
+        """
+        status = None
+        if self.puppet_report:
+            status = self.puppet_report.get('status', None)
+        failed = [title for title, params in resources.iteritems()
+                  if (params or {}).get('failed', False)]
+        return "batch: '%s' command: '%s' status: '%s' resources: '%d' " \
+               "failed: '%s' code: '%s'" % (
+                   ', '.join(t.id for t in self.tasks),
+                   self.command,
+                   status,
+                   len(resources),
+                   ', '.join(sorted(failed)),
+                   self.exit_code,
+               )
+
+    def task_artifacts(self, task, resources):
+        """Profiling artifacts of a single task of the batch
+
+        :param task: Task
+        :param resources: dictionary of the task resources
+        :rtype: dict
+        """
+        if not self.puppet_report:
+            return {}
+        return self.profile_artifacts(self.profile_resources(resources),
+                                      task.name)
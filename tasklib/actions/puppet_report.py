@@ -0,0 +1,157 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Selective parser of Puppet reports.
+
+A report of a large manifest is tens of megabytes, mostly log lines and
+bodies of resource events, while only its status, metrics and resource
+statuses are used.
+
+* The report is read as a stream of libyaml events and only the selected
+  keys are turned into Python objects. The rest is skipped without
+  constructing anything.
+* A selection is True to keep the whole value or a dict of the selected
+  mapping keys to their selections. The '*' key selects all other keys,
+  False skips the key.
+* Ruby tags are understood by 'PuppetReportLoader': objects are loaded as
+  dictionaries and symbols as strings.
+"""
+
+import yaml
+
+from tasklib import common
+
+REPORT_SELECTION = {
+    'status': True,
+    'metrics': True,
+    'resource_statuses': {
+        '*': {
+            'events': False,
+            '*': True,
+        },
+    },
+}
+
+
+class PuppetReportLoader(common.YamlLoader):
+    """YAML loader with the constructors for Ruby tags"""
+
+    def construct_ruby_object(self, suffix, node):
+        return self.construct_mapping(node)
+
+    def construct_ruby_sym(self, node):
+        return self.construct_scalar(node)
+
+
+PuppetReportLoader.add_multi_constructor(
+    u'!ruby/object:', PuppetReportLoader.construct_ruby_object)
+PuppetReportLoader.add_constructor(
+    u'!ruby/sym', PuppetReportLoader.construct_ruby_sym)
+
+
+class SelectiveParser(object):
+    def __init__(self, stream, selection):
+        self.loader = PuppetReportLoader(stream)
+        self.selection = selection
+        self.anchors = {}
+
+    def parse(self):
+        """Parse the first document of the stream
+
+        :return: the selected part of the document or None if it's empty
+        """
+        try:
+            self.loader.get_event()
+            if self.loader.check_event(yaml.StreamEndEvent):
+                return None
+            self.loader.get_event()
+            return self.value(self.selection)
+        finally:
+            self.loader.dispose()
+
+    def value(self, selection):
+        """Construct the next node keeping only the selected keys
+
+        :param selection: True or dict
+        """
+        event = self.loader.get_event()
+        if isinstance(event, yaml.AliasEvent):
+            return self.anchors.get(event.anchor, None)
+        if isinstance(event, yaml.ScalarEvent):
+            value = self.scalar(event)
+        elif isinstance(event, yaml.SequenceStartEvent):
+            value = []
+            while not self.loader.check_event(yaml.SequenceEndEvent):
+                value.append(self.value(selection))
+            self.loader.get_event()
+        else:
+            value = {}
+            while not self.loader.check_event(yaml.MappingEndEvent):
+                key = self.value(True)
+                key_selection = self.select(selection, key)
+                if key_selection is False:
+                    self.skip()
+                else:
+                    value[key] = self.value(key_selection)
+            self.loader.get_event()
+        if event.anchor is not None:
+            self.anchors[event.anchor] = value
+        return value
+
+    @staticmethod
+    def select(selection, key):
+        if selection is True:
+            return True
+        try:
+            return selection.get(key, selection.get('*', False))
+        except TypeError:
+            return selection.get('*', False)
+
+    def scalar(self, event):
+        tag = event.tag
+        if tag is None or tag == u'!':
+            tag = self.loader.resolve(yaml.ScalarNode, event.value,
+                                      event.implicit)
+        node = yaml.ScalarNode(tag, event.value, event.start_mark,
+                               event.end_mark, event.style)
+        value = self.loader.construct_object(node, deep=True)
+        self.loader.constructed_objects.pop(node, None)
+        return value
+
+    def skip(self):
+        """Skip the next node without constructing it"""
+        depth = 0
+        while True:
+            event = self.loader.get_event()
+            if isinstance(event, (yaml.SequenceStartEvent,
+                                  yaml.MappingStartEvent)):
+                depth += 1
+            elif isinstance(event, (yaml.SequenceEndEvent,
+                                    yaml.MappingEndEvent)):
+                depth -= 1
+            if depth == 0:
+                return
+
+
+def load(stream, selection=None):
+    """Parse the selected parts of the Puppet report
+
+    :param stream: file or str
+    :param selection: selection of the keys, REPORT_SELECTION by default
+    :rtype: dict
+    :return: the report or None if it's empty
+    """
+    if selection is None:
+        selection = REPORT_SELECTION
+    return SelectiveParser(stream, selection).parse()
@@ -13,21 +13,29 @@
 #    under the License.
 
 from tasklib.actions import action
+from tasklib.actions import coprocess
+from tasklib import engine
 from tasklib import exceptions
-from tasklib import common
 
 
 class ShellAction(action.Action):
-    def __init__(self, task, data):
+    """Shell action plugin.
+
+    Runs a command. Commands with 'persistent: true' are run by the
+    persistent shell coprocess, which is not waited for asynchronously.
+    Commands of the tasks with resource limits are never run by the
+    coprocess, it can't be limited for a single command.
+    """
+    def __init__(self, task, data, phase=None):
         self.code = None
         self.stdout = None
         self.stderr = None
-        super(ShellAction, self).__init__(task, data)
+        super(ShellAction, self).__init__(task, data, phase)
 
     def verify(self):
         super(ShellAction, self).verify()
-        if 'cmd' not in self.data:
-            raise exceptions.NotValidMetadata()
+        if not isinstance(self.data.get('cmd', None), basestring):
+            raise exceptions.NotValidMetadata(str(self.task))
 
     def reset(self):
         self.code = None
@@ -38,19 +46,53 @@ class ShellAction(action.Action):
     def command(self):
         return self.data['cmd']
 
+    @property
+    def persistent(self):
+        """Run the command in the persistent shell coprocess
+
+        :rtype: bool
+        """
+        return bool(self.data.get('persistent', False)) and \
+            self.limits is None
+
     def run(self):
+        engine.run(self.steps())
+        return self.code
+
+    def steps(self):
         self.log.debug("Task: '%s' action: '%s' run command: '%s'",
                        self.task.name, self.type, self.command)
         self.reset()
-        self.code, self.stdout, self.stderr = common.execute(self.command)
+        tail = self.task.config['output_tail']
+        if self.persistent:
+            shell = coprocess.coprocess(self.task.config['persistent_shell'])
+            try:
+                self.code, self.stdout, self.stderr = shell.execute(
+                    self.command,
+                    self.output_file('stdout'),
+                    self.output_file('stderr'),
+                    tail,
+                    self.timeout,
+                    self.cwd,
+                )
+            except exceptions.CoprocessExited as e:
+                self.log.error("Task: '%s' action: '%s' %s", self.task.name,
+                               self.type, e.msg)
+                self.stdout, self.stderr = '', e.msg
+                raise exceptions.Failed(self.task.name, self.type)
+        else:
+            command = self.new_command(self.command)
+            yield command
+            self.code, self.stdout, self.stderr = command.result(tail)
         self.log.debug("Task: '%s' action: '%s' %s" % (
             self.task.name,
             self.type,
             self.report(),
         ))
+        if self.code is None:
+            raise exceptions.TimedOut(self.task.name, self.type, self.timeout)
         if self.code != 0:
             raise exceptions.Failed(self.task.name, self.type)
-        return self.code
 
     def report(self):
         if not self.stderr and self.stdout and self.code:
@@ -12,13 +12,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import errno
 import os
 import daemonize
-import logging
 
 from tasklib import task
+from tasklib import cache
 from tasklib import common
+from tasklib import engine
+from tasklib import locks
 from tasklib import logger
+from tasklib import state
 from tasklib import exceptions
 
 
@@ -35,18 +39,18 @@ class Agent(object):
     * Answering if the task is running or not
     * Using task's methods to get the task's
     """
-    def __init__(self, task_name, config):
+    def __init__(self, task_name, config, task_data=None):
         self.config = config
         self.log = logger.setup_logging(self.config, 'TaskLib')
         self.log.debug("Task: '%s' agent init", task_name)
         self.task = None
         self.saved_directory = None
         self.init_task_name = task_name
-        self.library = common.task_library(self.config)
         self.init_directories()
 
-        if task_name in self.library:
-            task_data = self.library[task_name]
+        if task_data is None:
+            task_data = cache.task_data(self.config, task_name)
+        if task_data:
             self.task = task.Task(self, task_data)
 
         self.verify()
@@ -63,9 +67,37 @@ class Agent(object):
                 self.config['tasks_directory']
             )
 
+    def lock(self):
+        return locks.TaskLock(self.config, self.task.name)
+
+    def semaphore(self):
+        return locks.semaphore(self.config, self.task.data)
+
+    def steps(self):
+        """Steps of the task run holding the task lock
+
+        The task waits for a slot of its concurrency group before it's run.
+        :raises: exceptions.AlreadyRunning if the task is running already
+        :return: generator of steps
+        """
+        task_lock = self.lock()
+        task_lock.acquire()
+        semaphore = self.semaphore()
+        try:
+            if semaphore:
+                self.log.debug("Task: '%s' waits for the concurrency "
+                               "group: '%s'", self.task.name, semaphore.group)
+                yield semaphore
+            yield self.task.steps()
+        finally:
+            if semaphore:
+                semaphore.release()
+            task_lock.release()
+
     def run(self):
         self.verify()
-        return self.task.run()
+        engine.run(self.steps())
+        return self.task.code()
 
     def daemon_run_wrapper(self):
         try:
@@ -74,10 +106,30 @@ class Agent(object):
                 self.saved_directory = None
             self.log.debug("Task: '%s' daemon active with pid: '%d'",
                            self.task.name, os.getpid())
-            self.run()
+            self.state.set_pid(self.task.name, os.getpid())
+            try:
+                self.run()
+            finally:
+                self.state.set_pid(self.task.name, None)
         except Exception as e:
             self.log.exception(str(e))
 
+    def supervised_run(self):
+        """Run the task in a worker of the supervisor
+
+        The pid file is maintained as it's done by the task daemon.
+        :rtype: int
+        :return: task status code
+        """
+        with open(self.pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+        try:
+            self.daemon_run_wrapper()
+        finally:
+            if os.path.exists(self.pid_file):
+                os.unlink(self.pid_file)
+        return self.code()
+
     def status(self):
         if not self.task:
             return
@@ -88,13 +140,19 @@ class Agent(object):
             return
         return self.task.code()
 
-    def report(self):
+    def timing(self):
+        if not self.task:
+            return
+        return self.task.last_timing()
+
+    def report(self, **page):
         if not self.task:
             return
         report = {}
         for action in ['pre', 'task', 'post']:
-            if self.task.report(action):
-                report[action] = self.task.report(action)
+            action_report = self.task.report(action, **page)
+            if action_report:
+                report[action] = action_report
         return report
 
     def __repr__(self):
@@ -108,31 +166,33 @@ class Agent(object):
         return os.path.join(self.config['pid_dir'],
                             self.task.name + '.pid')
 
+    @property
+    def state(self):
+        return state.backend(self.config)
+
     @property
     def pid(self):
-        if not os.path.exists(self.pid_file):
-            return None
-        with open(self.pid_file, 'r') as f:
-            return f.read()
+        holder = self.lock().holder()
+        if holder and holder['pid']:
+            return str(holder['pid'])
+        return self.state.pid(self.task.name)
 
     def running(self):
-        if not self.pid:
-            return False
-        return self.pid_exists(self.pid)
+        return self.lock().holder() is not None
 
     @staticmethod
     def pid_exists(pid):
-        cmdline = '/proc/%s/cmdline' % pid
-        return os.path.isdir(cmdline)
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
 
     def daemon(self):
         self.verify()
         if self.running():
             raise exceptions.AlreadyRunning(self.task.name, self.pid)
-        log_keep_fds = []
-        for handler in self.log.handlers:
-            if isinstance(handler, logging.FileHandler):
-                log_keep_fds.append(handler.stream.fileno())
+        log_keep_fds = logger.file_descriptors(self.log)
         print log_keep_fds
         self.saved_directory = os.getcwdu()
         daemon = daemonize.Daemonize(
@@ -143,11 +203,13 @@ class Agent(object):
         )
         self.log.debug("Task: '%s' daemon start with pid file: '%s'",
                        self.task.name, self.pid_file)
+        state.close()
         daemon.start()
         return daemon
 
     def clear(self):
         if os.path.exists(self.pid_file):
             os.unlink(self.pid_file)
+        self.state.set_pid(self.task.name, None)
         if self.task:
             self.task.reset()
@@ -0,0 +1,230 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Batches of puppet tasks run by a single puppet apply.
+
+* A batch is a chain of puppet tasks of the graph: every task of the chain
+  is the only one required by the next task and the next task is the only
+  one waiting for it.
+* Only tasks without pre and post tests, retries and catalog cache and
+  with the same puppet modules and options are batched. A task can opt
+  out with 'batch: false' in its parameters.
+* The status, report, artifacts and history of every task are saved as if
+  it was run by itself, so the per-task commands keep working. The timing
+  of every task is the timing of the whole batch.
+"""
+
+import time
+
+from tasklib.actions import puppet_batch
+from tasklib import agent
+from tasklib import common
+from tasklib import engine
+from tasklib import exceptions
+from tasklib import history
+from tasklib import logger
+
+
+def batchable(task_data):
+    """Check if the task can be a part of a batch
+
+    :param task_data: dict
+    :rtype: bool
+    """
+    if common.task_type(task_data) != 'puppet':
+        return False
+    if task_data.get('test_pre') or task_data.get('test_post'):
+        return False
+    parameters = task_data.get('parameters', None) or {}
+    if parameters.get('retries') or parameters.get('catalog_cache'):
+        return False
+    return bool(parameters.get('batch', True))
+
+
+def batch_key(task_data):
+    parameters = task_data.get('parameters', None) or {}
+    return (parameters.get('puppet_modules', None),
+            parameters.get('puppet_options', None))
+
+
+def find_batches(task_graph):
+    """Find the chains of puppet tasks in the graph
+
+    :param task_graph: graph.Graph
+    :rtype: dict
+    :return: Dictionary of the first task ids of the chains and the lists
+             of the chain task ids in their run order
+    """
+    chains = {}
+    for task_id in task_graph.topology():
+        task_data = task_graph.library[task_id]
+        if not batchable(task_data):
+            continue
+        requires = task_graph.requires[task_id]
+        if len(requires) == 1:
+            previous = list(requires)[0]
+            if previous in chains and \
+                    len(task_graph.required_for[previous]) == 1 and \
+                    batch_key(task_graph.library[previous]) == \
+                    batch_key(task_data):
+                chains[task_id] = chains[previous]
+                chains[task_id].append(task_id)
+                continue
+        chains[task_id] = [task_id]
+    return dict((chain[0], chain) for chain in chains.itervalues()
+                if len(chain) > 1)
+
+
+class Batch(object):
+    def __init__(self, config, task_ids, library):
+        self.config = config
+        self.log = logger.setup_logging(self.config, 'TaskLib')
+        self.agents = [agent.Agent(task_id, self.config, library[task_id])
+                       for task_id in task_ids]
+
+    @property
+    def tasks(self):
+        return [task_agent.task for task_agent in self.agents]
+
+    def run(self):
+        """Run the batch waiting for every step in turn
+
+        :rtype: dict
+        :return: Dictionary of task statuses
+        """
+        engine.run(self.steps())
+        return self.statuses()
+
+    def statuses(self):
+        return dict((task.id, task.status()) for task in self.tasks)
+
+    def steps(self):
+        """Steps of the batch run for the engines
+
+        The locks of all tasks are held for the time of the batch run.
+        The batch takes a single slot of every concurrency group of its
+        tasks, the groups are taken in the order of their names.
+        :raises: exceptions.AlreadyRunning if any task is running already
+        :return: generator of steps
+        """
+        task_locks = []
+        semaphores = {}
+        try:
+            for task_agent in self.agents:
+                task_lock = task_agent.lock()
+                task_lock.acquire()
+                task_locks.append(task_lock)
+                semaphore = task_agent.semaphore()
+                if semaphore:
+                    semaphores.setdefault(semaphore.group, semaphore)
+            for group in sorted(semaphores):
+                yield semaphores[group]
+            yield self.run_steps()
+        finally:
+            for semaphore in semaphores.values():
+                semaphore.release()
+            for task_lock in task_locks:
+                task_lock.release()
+
+    def run_steps(self):
+        """Run the tasks of the batch
+
+        Up to date tasks are not run in the incremental mode.
+        :return: generator of steps
+        """
+        tasks = []
+        fingerprints = {}
+        for task in self.tasks:
+            if self.config['incremental']:
+                fingerprints[task.id] = task.fingerprint()
+                if task.up_to_date(fingerprints[task.id]):
+                    self.log.info("Task: '%s' is up to date, skipping run",
+                                  task.id)
+                    task.save_status(common.STATUS.success.name)
+                    continue
+            task.save_fingerprint(None)
+            task.save_report('task', None)
+            task.save_status(common.STATUS.run_task.name)
+            tasks.append(task)
+        if not tasks:
+            return
+        self.log.debug("Batch run start: '%s'",
+                       ', '.join(task.id for task in tasks))
+        head = tasks[0]
+        action = puppet_batch.BatchAction(head, head.task_data, 'task', tasks)
+        started = time.time()
+        start = common.monotonic()
+        try:
+            yield action.steps()
+        except exceptions.Failed:
+            self.log.warning("Batch: '%s' failed!", head.id)
+        end = common.monotonic()
+        self.save_results(action, tasks, end - start)
+        # the commands of the batch are shared by all its tasks
+        phases = {'task': {
+            'start': start,
+            'end': end,
+            'duration': end - start,
+            'batch': head.id,
+            'commands': action.command_stats(),
+        }}
+        for task in tasks:
+            task.save_timing(started, phases)
+        for task in tasks:
+            if task.success():
+                task.save_fingerprint(fingerprints.get(task.id, None))
+        self.log.debug("Batch run end: '%s'", head.id)
+
+    @staticmethod
+    def failed(resources, state='failed'):
+        """Check if any of the resources has failed
+
+        :param resources: dictionary of resource structures
+        :param state: 'failed' or 'skipped'
+        :rtype: bool
+        """
+        return any((params or {}).get(state, False)
+                   for params in (resources or {}).itervalues())
+
+    def save_results(self, action, tasks, duration):
+        """Save the status, report, artifacts and history of every task
+
+        :param action: puppet_batch.BatchAction
+        :param tasks: list of the tasks run by the batch
+        :param duration: duration of the batch run in seconds
+        """
+        resources, unattributed = action.split()
+        failed_anywhere = self.failed(action.puppet_resources)
+        failed_unattributed = self.failed(unattributed)
+        batch_failed = False in action.all_success_criterias.values()
+        previous_failed = False
+        for task in tasks:
+            task_resources = resources[task.id]
+            if action.exit_code is None:
+                status = common.STATUS.timeout.name
+            elif self.failed(task_resources) or failed_unattributed or \
+                    (batch_failed and not failed_anywhere):
+                status = common.STATUS.fail_task.name
+                previous_failed = True
+            elif previous_failed and self.failed(task_resources, 'skipped'):
+                # puppet skips resources depending on the failed ones
+                status = common.STATUS.skipped.name
+            else:
+                status = common.STATUS.success.name
+            task.save_report('task', action.task_report(task, task_resources))
+            task.save_artifacts('task', action.task_artifacts(
+                task, task_resources))
+            task.save_status(status)
+            history.record(self.config, task.id, status,
+                           {'task': duration / len(tasks)})
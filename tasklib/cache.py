@@ -0,0 +1,268 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Compiled task library cache.
+
+Parsing every task file on each CLI call is expensive when the tasks
+directory is large. The cache keeps the processed data of each task file
+together with the file's mtime, size and inode. Unchanged files are loaded
+from the cache and only new or changed files are parsed again.
+
+The cache also maintains a small index of task ids, their files and the
+positions of tasks inside these files. It allows to load a single task
+by parsing only the part of the file where this task is defined.
+Positions are byte offsets, so only this part is read. When several files
+define the same task id the later file wins, both in the library and in
+the index.
+
+The index is used only while the library is the same as when it was
+built: the stat of every task file and the mtime of every directory of
+the tasks tree are saved with it. A changed, removed or added file makes
+the lookup go through the library, which parses only the changed files
+and saves a new index.
+
+The status directory may be shared, so the files are saved with marshal
+which can hold only plain data and never runs code when loaded.
+"""
+
+import marshal
+import os
+
+from tasklib import common
+
+
+class LibraryCache(object):
+    VERSION = 6
+
+    def __init__(self, config):
+        self.config = config
+
+    @property
+    def cache_file(self):
+        return os.path.join(self.config['status_dir'], 'library.cache')
+
+    @property
+    def index_file(self):
+        return os.path.join(self.config['status_dir'], 'library.index')
+
+    @staticmethod
+    def file_stat(task_file):
+        """Get the values used to detect a changed task file
+
+        :param task_file: str
+        :rtype: tuple
+        :return: mtime, size and inode of the file or None
+        """
+        try:
+            stat = os.stat(task_file)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size, stat.st_ino
+
+    def read(self, path):
+        """Read the data saved to the cache or index file
+
+        Missing, broken or outdated file is treated as empty.
+        :param path: str
+        :rtype: dict
+        """
+        try:
+            with open(path, 'rb') as f:
+                cache = marshal.load(f)
+        except Exception:
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        if cache.get('version') != self.VERSION:
+            return {}
+        if cache.get('tasks_directory') != self.config['tasks_directory']:
+            return {}
+        if cache.get('tasks_pattern') != self.config['tasks_pattern']:
+            return {}
+        return cache.get('data', {})
+
+    def write(self, path, data):
+        """Atomically write the data to the cache or index file
+
+        Failure to write the cache is not an error, the library
+        will be parsed again next time. So is data marshal can't save,
+        like dates in the task files.
+        :param path: str
+        :param data: dict
+        """
+        cache = {
+            'version': self.VERSION,
+            'tasks_directory': self.config['tasks_directory'],
+            'tasks_pattern': self.config['tasks_pattern'],
+            'data': data,
+        }
+        temp_file = '%s.%d' % (path, os.getpid())
+        try:
+            common.ensure_dir_created(os.path.dirname(path))
+            with open(temp_file, 'wb') as f:
+                marshal.dump(cache, f)
+            os.rename(temp_file, path)
+        except (IOError, OSError, ValueError):
+            if os.path.exists(temp_file):
+                os.unlink(temp_file)
+
+    def load(self):
+        """Read the saved file entries from the cache file
+
+        :rtype: dict
+        :return: file entries by file path and directory mtimes
+        """
+        cache = self.read(self.cache_file)
+        return cache.get('entries', {}), cache.get('directories', {})
+
+    def save(self, entries, task_files, directories):
+        """Save file entries and the task index built from them
+
+        :param entries: dict
+        :param task_files: list of files in the library order
+        :param directories: mtimes of the directories of the tasks tree
+        """
+        self.write(self.cache_file, {
+            'entries': entries,
+            'directories': directories,
+        })
+        tasks = {}
+        files = {}
+        for task_file in task_files:
+            entry = entries[task_file]
+            files[task_file] = entry['stat']
+            for task_id, position in entry['positions'].iteritems():
+                tasks[task_id] = (task_file,) + position
+        self.write(self.index_file, {
+            'tasks': tasks,
+            'files': files,
+            'directories': directories,
+        })
+
+    def entry(self, parsed):
+        """Create a new cache entry from the parsed task file
+
+        :param parsed: parse_task_file result
+        :rtype: dict
+        """
+        task_file, tasks, positions, error = parsed
+        return {
+            'stat': self.file_stat(task_file),
+            'tasks': tasks,
+            'positions': positions,
+            'error': error,
+        }
+
+    def library(self, rebuild=False, errors=None):
+        """Get the task library using the cache
+
+        :param rebuild: ignore the saved cache and parse all files
+        :param errors: if a list is given ParseError of each file that
+                       could not be parsed will be added to it
+        :rtype: dict
+        :return: Task library dictionary
+        """
+        if rebuild:
+            cached, cached_directories = {}, None
+        else:
+            cached, cached_directories = self.load()
+        entries = {}
+        task_files = []
+        changed_files = []
+        directories = {}
+        for task_file in common.tasks_files(self.config, directories):
+            entry = cached.get(task_file)
+            if entry and entry['stat'] == self.file_stat(task_file):
+                entries[task_file] = entry
+            else:
+                changed_files.append(task_file)
+            task_files.append(task_file)
+
+        parsed_files = common.parse_task_files(self.config, changed_files)
+        for parsed in parsed_files:
+            entries[parsed[0]] = self.entry(parsed)
+
+        if changed_files or len(entries) != len(cached) or \
+                directories != cached_directories:
+            self.save(entries, task_files, directories)
+
+        library = {}
+        for task_file in task_files:
+            entry = entries[task_file]
+            if entry['error'] and errors is not None:
+                errors.append(common.ParseError(task_file, entry['error']))
+            library.update(entry['tasks'])
+        return library
+
+    def task(self, task_id):
+        """Get a single task using the index
+
+        Only the part of the file defining this task is parsed if the
+        library was not changed since the index was built. Otherwise, or
+        if the task is not in the index, the library is loaded through
+        the cache.
+        :param task_id: str
+        :rtype: dict
+        :return: Task data or None if there is no such task
+        """
+        index = self.read(self.index_file)
+        tasks = index.get('tasks', {})
+        if task_id in tasks and self.index_valid(index):
+            task_file, start, end = tasks[task_id]
+            task = common.process_task_chunk(task_file, start, end)
+            if task and task['id'] == task_id:
+                return task
+        return self.library().get(task_id)
+
+    def index_valid(self, index):
+        """Check that no task file was changed, removed or added
+
+        A file added or removed changes the mtime of its directory.
+        :param index: dict
+        :rtype: bool
+        """
+        for directory, mtime in index['directories'].iteritems():
+            if common.directory_mtime(directory) != mtime:
+                return False
+        for task_file, stat in index['files'].iteritems():
+            if self.file_stat(task_file) != stat:
+                return False
+        return True
+
+
+def task_library(config, rebuild=False, errors=None):
+    """Get the task library using the cache if it's enabled
+
+    :param config: Config
+    :param rebuild: force the cache to be rebuilt
+    :param errors: list to collect file parsing errors
+    :rtype: dict
+    :return: Task library dictionary
+    """
+    if not config['use_cache'] and not rebuild:
+        return common.task_library(config, errors)
+    return LibraryCache(config).library(rebuild, errors)
+
+
+def task_data(config, task_id):
+    """Get the data of a single task using the index if it's enabled
+
+    :param config: Config
+    :param task_id: str
+    :rtype: dict
+    :return: Task data or None if there is no such task
+    """
+    if not config['use_cache']:
+        return common.task_library(config).get(task_id)
+    return LibraryCache(config).task(task_id)
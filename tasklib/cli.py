@@ -13,16 +13,26 @@
 #    under the License.
 
 import argparse
+import json
 import sys
 import os
 import textwrap
+import time
 
 import yaml
 
+from tasklib.actions import catalog
 from tasklib import agent
+from tasklib import cache
 from tasklib import config
 from tasklib import exceptions
 from tasklib import common
+from tasklib import graph
+from tasklib import locks
+from tasklib import scheduler
+from tasklib import server
+from tasklib import supervisor
+from tasklib import state
 from contextlib import contextmanager
 
 
@@ -31,6 +41,8 @@ class CmdApi(object):
     TaskLib CLI utility
     """
 
+    OPTIONS = ('debug', 'use_cache', 'incremental', 'force')
+
     def __init__(self):
         self.parser = argparse.ArgumentParser(
             description=textwrap.dedent(self.__doc__),
@@ -40,6 +52,9 @@ class CmdApi(object):
             description='Supported actions',
             help='Provide of one valid actions')
         self.config = config.Config()
+        # the task library kept in memory by the server
+        self.library = None
+        self.library_errors = []
         self.register_options()
         self.register_actions()
 
@@ -49,6 +64,17 @@ class CmdApi(object):
             help='Path to a configuration file')
         self.parser.add_argument(
             '--debug', '-d', dest='debug', action='store_true', default=None)
+        self.parser.add_argument(
+            '--no-cache', dest='use_cache', action='store_false', default=None,
+            help='Do not use the compiled task library cache')
+        self.parser.add_argument(
+            '--incremental', '-i', dest='incremental', action='store_true',
+            default=None,
+            help='Skip the tasks which inputs have not changed since '
+                 'their last successful run')
+        self.parser.add_argument(
+            '--force', '-f', dest='force', action='store_true', default=None,
+            help='Run the tasks even if they are up to date')
 
     def register_actions(self):
         task_arg = [(('task',), {'type': str})]
@@ -56,12 +82,66 @@ class CmdApi(object):
         self.register_parser('conf')
         self.register_parser('log')
         self.register_parser('truncate')
-        for name in ('run', 'daemon', 'report', 'status', 'show', 'clear'):
+        self.register_parser('rebuild-cache')
+        self.register_parser('purge-catalogs')
+        self.register_parser('serve')
+        self.register_parser('ps', [
+            (('--format',), {'choices': ['table', 'json'],
+                             'default': 'table'}),
+        ])
+        for name in ('run', 'show', 'clear', 'profile'):
             self.register_parser(name, task_arg)
+        self.register_parser('daemon', [
+            (('tasks',), {'type': str, 'nargs': '*',
+                          'help': 'Tasks to run in the background'}),
+            (('--role', '-r'), {'action': 'append', 'dest': 'roles',
+                                'help': 'Run the tasks of this role'}),
+            (('--group', '-g'), {'action': 'append', 'dest': 'groups',
+                                 'help': 'Run the tasks of this group'}),
+            (('--workers', '-w'), {'type': int, 'default': None,
+                                   'help': 'Number of supervisor workers'}),
+        ])
+        query_args = [
+            (('task',), {'type': str, 'nargs': '?'}),
+            (('--all', '-a'), {'action': 'store_true',
+                               'help': 'Show all tasks'}),
+            (('--status', '-s'), {'action': 'append', 'dest': 'filter',
+                                  'help': 'Show only the tasks with '
+                                          'this status'}),
+            (('--format',), {'choices': ['table', 'json'],
+                             'default': 'table'}),
+        ]
+        self.register_parser('status', query_args)
+        self.register_parser('report', query_args + [
+            (('--head',), {'type': int, 'default': None,
+                           'help': 'Show the first lines of the reports'}),
+            (('--tail',), {'type': int, 'default': None,
+                           'help': 'Show the last lines of the reports'}),
+            (('--offset',), {'type': int, 'default': None,
+                             'help': 'Start the reports at this byte'}),
+            (('--length',), {'type': int, 'default': None,
+                             'help': 'Show at most this number of bytes '
+                                     'of the reports'}),
+        ])
+        self.register_parser('run-graph', [
+            (('tasks',), {'type': str, 'nargs': '*',
+                          'help': 'Tasks to run, all tasks by default'}),
+            (('--workers', '-w'), {'type': int, 'default': None,
+                                   'help': 'Number of parallel workers'}),
+            (('--batch', '-b'), {'action': 'store_true', 'default': None,
+                                 'help': 'Run chains of puppet tasks by '
+                                         'a single puppet apply'}),
+        ])
+        self.register_parser('plan', [
+            (('tasks',), {'type': str, 'nargs': '*',
+                          'help': 'Tasks to plan, all tasks by default'}),
+            (('--workers', '-w'), {'type': int, 'default': None,
+                                   'help': 'Number of parallel workers'}),
+        ])
 
     def register_parser(self, func_name, arguments=()):
         parser = self.subparser.add_parser(func_name)
-        parser.set_defaults(func=getattr(self, func_name))
+        parser.set_defaults(func=getattr(self, func_name.replace('-', '_')))
         for args, kwargs in arguments:
             parser.add_argument(*args, **kwargs)
 
@@ -69,16 +149,40 @@ class CmdApi(object):
         parsed = self.parser.parse_args(args)
         if parsed.config:
             self.config.update_from_file(parsed.config)
-        if parsed.debug is not None:
-            self.config['debug'] = parsed.debug
+        self.apply_options(parsed)
         if parsed.config is None:
             local_log = 'tasklib.yaml'
             if os.path.isfile(local_log):
                 parsed.config = local_log
         return parsed.func(parsed)
 
+    def apply_options(self, parsed):
+        for name in self.OPTIONS:
+            value = getattr(parsed, name)
+            if value is not None:
+                self.config[name] = value
+
+    def task_library(self, errors=None):
+        """Task library from the memory of the server or the cache
+
+        :param errors: list to collect file parsing errors
+        :rtype: dict
+        """
+        if self.library is None:
+            return cache.task_library(self.config, errors=errors)
+        if errors is not None:
+            errors.extend(self.library_errors)
+        return self.library
+
+    def agent(self, task_id):
+        task_data = None
+        if self.library is not None:
+            task_data = self.library.get(task_id, None)
+        return agent.Agent(task_id, self.config, task_data)
+
     def list(self, args):
-        library = common.task_library(self.config)
+        errors = []
+        library = self.task_library(errors)
         tasks = library.keys()
         tasks.sort()
         max_len = common.max_task_id_length(library)
@@ -93,20 +197,23 @@ class CmdApi(object):
             common.output(task_id, fill=max_len + 3, newline=False)
             common.output('(' + task_type + ')', fill=10, newline=False)
             common.output('[' + ', '.join(actions) + ']')
+        for error in errors:
+            common.output("Error parsing file: %s - %s" % error)
 
     def show(self, args):
         with self.rescue_exceptions():
-            library = common.task_library(self.config)
-            if not args.task in library:
-                raise exceptions.NotFound()
+            task_data = cache.task_data(self.config, args.task)
+            if not task_data:
+                raise exceptions.NotFound(
+                    args.task, self.config['tasks_directory'])
             common.output(yaml.dump(
-                library[args.task],
+                task_data,
                 default_flow_style=False
             ))
 
     def run(self, args):
         with self.rescue_exceptions():
-            task_agent = agent.Agent(args.task, self.config)
+            task_agent = self.agent(args.task)
             task_agent.run()
             status = task_agent.status()
             common.output("Task status: '%s'" % status)
@@ -114,27 +221,255 @@ class CmdApi(object):
             common.output(common.report_to_text(task_agent.report()))
             return task_agent.code()
 
+    def task_graph(self, task_ids):
+        library = self.task_library()
+        for task_id in task_ids:
+            if task_id not in library:
+                raise exceptions.NotFound(
+                    task_id, self.config['tasks_directory'])
+        return graph.Graph(library, task_ids or None)
+
+    def run_graph(self, args):
+        if args.batch is not None:
+            self.config['puppet_batch'] = args.batch
+        with self.rescue_exceptions():
+            task_graph = self.task_graph(args.tasks)
+            task_scheduler = scheduler.Scheduler(
+                self.config, task_graph, args.workers)
+            statuses = task_scheduler.run()
+            max_len = common.max_task_id_length(statuses) or 0
+            for task_id in task_graph.topology():
+                common.output(task_id, fill=max_len + 3, newline=False)
+                common.output(statuses.get(task_id))
+            return task_scheduler.code()
+
+    def plan(self, args):
+        with self.rescue_exceptions():
+            task_graph = self.task_graph(args.tasks)
+            task_scheduler = scheduler.Scheduler(
+                self.config, task_graph, args.workers)
+            order = task_scheduler.plan()
+            max_len = max(len('Task'),
+                          common.max_task_id_length(task_scheduler.durations))
+            common.output('Task', fill=max_len + 3, newline=False)
+            common.output('Start', fill=10, newline=False)
+            common.output('End')
+            for task_id, start, end in order:
+                common.output(task_id, fill=max_len + 3, newline=False)
+                common.output('%.1f' % start, fill=10, newline=False)
+                common.output('%.1f' % end)
+            critical_path = task_graph.critical_path(task_scheduler.durations)
+            makespan = max([end for task_id, start, end in order] or [0])
+            common.output("Critical path: %s" % ' -> '.join(critical_path))
+            common.output("Estimated makespan: %.1f s" % makespan)
+
+    def daemon_tasks(self, args):
+        """Tasks to run by the supervisor
+
+        :rtype: list
+        :return: task ids or None if a single task daemon is started
+        """
+        if len(args.tasks) == 1 and not args.roles and not args.groups:
+            return None
+        library = self.task_library()
+        for task_id in args.tasks:
+            if task_id not in library:
+                raise exceptions.NotFound(
+                    task_id, self.config['tasks_directory'])
+        task_ids = list(args.tasks)
+        for task_id in supervisor.select(library, args.roles, args.groups):
+            if task_id not in task_ids:
+                task_ids.append(task_id)
+        return task_ids
+
     def daemon(self, args):
         with self.rescue_exceptions():
-            task_agent = agent.Agent(args.task, self.config)
-            task_agent.daemon()
+            task_ids = self.daemon_tasks(args)
+            if task_ids is None:
+                task_agent = self.agent(args.tasks[0])
+                task_agent.daemon()
+                return
+            task_supervisor = supervisor.Supervisor(
+                self.config, self.task_library(), args.workers)
+            if task_ids:
+                common.output("Tasks queued: %s" % ', '.join(task_ids))
+            else:
+                common.output("Resuming the queued tasks")
+            sys.stdout.flush()
+            pid = task_supervisor.submit(task_ids)
+            if pid is not None:
+                common.output("Supervisor is running with pid: '%s'" % pid)
+
+    def daemon_check(self, args):
+        """Check if the daemon can be started without starting it"""
+        with self.rescue_exceptions():
+            if self.daemon_tasks(args) is not None:
+                return
+            task_agent = self.agent(args.tasks[0])
+            if task_agent.running():
+                raise exceptions.AlreadyRunning(task_agent.task.name,
+                                                task_agent.pid)
+
+    @staticmethod
+    def report_page(args):
+        return dict((name, getattr(args, name))
+                    for name in ('head', 'tail', 'offset', 'length')
+                    if getattr(args, name) is not None)
 
     def report(self, args):
+        if args.all or args.filter or not args.task:
+            return self.report_all(args)
         with self.rescue_exceptions():
-            task_agent = agent.Agent(args.task, self.config)
-            common.output(common.report_to_text(task_agent.report()))
+            task_agent = self.agent(args.task)
+            page = self.report_page(args)
+            common.output(common.report_to_text(task_agent.report(**page)))
+            timing = common.timing_to_text(task_agent.timing())
+            if timing and not page:
+                common.output(timing)
+
+    def profile(self, args):
+        with self.rescue_exceptions():
+            task_agent = self.agent(args.task)
+            for action in ['pre', 'task', 'post']:
+                data = task_agent.task.artifact(action, 'profile.json')
+                if not data:
+                    continue
+                profile = json.loads(data)
+                common.output("===== %s =====" % action)
+                common.output("Total resource time: %.2f s" %
+                              profile['total_time'])
+                common.output("Slowest resources:")
+                for resource in profile['slowest']:
+                    common.output('%.3f' % resource['time'], fill=10,
+                                  newline=False)
+                    common.output(resource['title'])
+                common.output("Time by resource type:")
+                types = sorted(profile['types'].iteritems(),
+                               key=lambda item: -item[1]['time'])
+                for resource_type, stats in types:
+                    common.output('%.3f' % stats['time'], fill=10,
+                                  newline=False)
+                    common.output('%s (%d)' % (resource_type, stats['count']))
 
     def status(self, args):
+        if args.all or args.filter or not args.task:
+            return self.status_all(args)
         with self.rescue_exceptions():
-            task_agent = agent.Agent(args.task, self.config)
+            task_agent = self.agent(args.task)
             common.output("Task status: '%s'" % task_agent.status())
+            timing = common.timing_to_text(task_agent.timing())
+            if timing:
+                common.output(timing, newline=False)
             return task_agent.code()
 
+    def task_states(self, args):
+        """Statuses and last runs of the tasks without creating agents
+
+        All tasks of the library and the state backend are included.
+        :rtype: dict
+        :return: Dictionary of task ids and tuples of the status and
+                 the last history record
+        """
+        library = self.task_library()
+        states = state.backend(self.config).summary()
+        for task_id in library:
+            if task_id not in states:
+                states[task_id] = (common.STATUS.not_found.name, None)
+        if args.filter:
+            states = dict((task_id, task_state)
+                          for task_id, task_state in states.iteritems()
+                          if task_state[0] in args.filter)
+        return states
+
+    def status_all(self, args):
+        states = self.task_states(args)
+        rows = []
+        for task_id in sorted(states):
+            status, last_run = states[task_id]
+            duration = None
+            if last_run:
+                duration = sum(last_run.get('durations', {}).values())
+            code = getattr(common.STATUS, status, common.STATUS.error).code
+            rows.append((task_id, status, code, duration))
+        if args.format == 'json':
+            common.output(json.dumps(dict(
+                (task_id, {'status': status, 'code': code,
+                           'duration': duration})
+                for task_id, status, code, duration in rows
+            ), indent=2, sort_keys=True))
+            return
+        max_len = max([len('Task')] + [len(row[0]) for row in rows])
+        common.output('Task', fill=max_len + 3, newline=False)
+        common.output('Status', fill=18, newline=False)
+        common.output('Code', fill=6, newline=False)
+        common.output('Duration')
+        for task_id, status, code, duration in rows:
+            common.output(task_id, fill=max_len + 3, newline=False)
+            common.output(status, fill=18, newline=False)
+            common.output(code, fill=6, newline=False)
+            common.output('-' if duration is None else '%.1f' % duration)
+
+    def report_all(self, args):
+        states = self.task_states(args)
+        reports = state.backend(self.config).reports(
+            sorted(states), **self.report_page(args))
+        if args.format == 'json':
+            common.output(json.dumps(reports, indent=2, sort_keys=True))
+            return
+        for task_id in sorted(reports):
+            common.output("##### %s #####" % task_id)
+            common.output(common.report_to_text(reports[task_id]))
+
+    def ps(self, args):
+        """Running tasks with their pids, phases and elapsed times"""
+        tasks = locks.running(self.config)
+        statuses = state.backend(self.config).statuses()
+        now = time.time()
+        rows = []
+        for task_id in sorted(tasks):
+            phase = statuses.get(task_id, None) or '-'
+            if phase.startswith('run_'):
+                phase = phase[len('run_'):]
+            start = tasks[task_id]['start']
+            elapsed = None if start is None else now - start
+            rows.append((task_id, tasks[task_id]['pid'], phase, elapsed))
+        if args.format == 'json':
+            common.output(json.dumps(dict(
+                (task_id, {'pid': pid, 'phase': phase, 'elapsed': elapsed})
+                for task_id, pid, phase, elapsed in rows
+            ), indent=2, sort_keys=True))
+            return
+        max_len = max([len('Task')] + [len(row[0]) for row in rows])
+        common.output('Task', fill=max_len + 3, newline=False)
+        common.output('Pid', fill=8, newline=False)
+        common.output('Phase', fill=8, newline=False)
+        common.output('Elapsed')
+        for task_id, pid, phase, elapsed in rows:
+            common.output(task_id, fill=max_len + 3, newline=False)
+            common.output(pid or '-', fill=8, newline=False)
+            common.output(phase, fill=8, newline=False)
+            common.output('-' if elapsed is None else '%.1f' % elapsed)
+
     def clear(self, args):
         with self.rescue_exceptions():
-            task_agent = agent.Agent(args.task, self.config)
+            task_agent = self.agent(args.task)
             task_agent.clear()
 
+    def rebuild_cache(self, args):
+        errors = []
+        library = cache.task_library(self.config, True, errors)
+        common.output("Task library cache rebuilt: %d tasks" % len(library))
+        for error in errors:
+            common.output("Error parsing file: %s - %s" % error)
+
+    def serve(self, args):
+        with self.rescue_exceptions():
+            server.Server(self, args.config).run()
+
+    def purge_catalogs(self, args):
+        removed = catalog.CatalogCache(self.config).purge()
+        common.output("Catalog cache purged: %d catalogs" % removed)
+
     def conf(self, args):
         common.output(self.config)
 
@@ -163,6 +498,9 @@ class CmdApi(object):
         except exceptions.NotValidMetadata as e:
             common.output(e.msg)
             sys.exit(common.STATUS.error.code)
+        except exceptions.CycleDetected as e:
+            common.output(e.msg)
+            sys.exit(common.STATUS.error.code)
 
 ##############################################################################
 
@@ -0,0 +1,106 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Thin client of the resident agent server.
+
+* The client MUST stay cheap to import: it doesn't import yaml, argparse,
+  daemonize or the rest of tasklib unless it has to run the command by
+  itself.
+* Served actions are sent to the server socket ('TASKLIB_SOCKET' in the
+  environment or the default one). If the server isn't running or refuses
+  the request, the command is run standalone by the CLI.
+"""
+
+import errno
+import json
+import os
+import socket
+import sys
+
+DEFAULT_SOCKET = '/var/tmp/task_pid/tasklib.sock'
+SERVED_ACTIONS = ('run', 'daemon', 'status', 'report', 'list', 'clear',
+                  'ps')
+VALUE_OPTIONS = ('--config', '-c')
+
+
+def socket_path():
+    return os.environ.get('TASKLIB_SOCKET', DEFAULT_SOCKET)
+
+
+def action(argv):
+    """Find the action in the command line arguments
+
+    :param argv: list of arguments without the program name
+    :rtype: str
+    :return: the action or None if the arguments ask for help
+    """
+    if '-h' in argv or '--help' in argv:
+        return None
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument in VALUE_OPTIONS:
+            next(arguments, None)
+        elif not argument.startswith('-'):
+            return argument
+    return None
+
+
+def request(argv, path=None):
+    """Send the command to the server
+
+    :param argv: list of arguments without the program name
+    :param path: path to the server socket
+    :rtype: tuple
+    :return: the exit code, the output and the error output or None if
+             the command should be run standalone
+    """
+    if action(argv) not in SERVED_ACTIONS:
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            connection.connect(path or socket_path())
+        except socket.error as e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED, errno.EACCES):
+                return None
+            raise
+        connection.sendall(json.dumps({
+            'argv': argv,
+            'cwd': os.getcwd(),
+        }) + '\n')
+        response = connection.makefile('rb').readline()
+    finally:
+        connection.close()
+    if not response:
+        # the request could have been started, it's not run again
+        return 1, '', 'No answer from the server\n'
+    try:
+        response = json.loads(response)
+    except ValueError as e:
+        return 1, '', 'Invalid answer from the server: %s\n' % e
+    if not response.get('served', False):
+        return None
+    return (response.get('code', 1), response.get('stdout', ''),
+            response.get('stderr', ''))
+
+
+def main():
+    response = request(sys.argv[1:])
+    if response is None:
+        from tasklib import cli
+        return cli.main()
+    code, stdout, stderr = response
+    sys.stdout.write(stdout.encode('utf-8'))
+    sys.stderr.write(stderr.encode('utf-8'))
+    sys.exit(code)
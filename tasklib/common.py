@@ -13,14 +13,83 @@
 #    under the License.
 
 from collections import namedtuple
+import ctypes
+import ctypes.util
+import errno
 import fnmatch
+import multiprocessing
 import os
+import re
+import shlex
+import signal
 import subprocess
+import tempfile
+import time
 import yaml
 import sys
 
+from distutils.spawn import find_executable
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+CLOCK_MONOTONIC = 1
+
+
+def clock_monotonic():
+    """Read CLOCK_MONOTONIC using clock_gettime from libc
+
+    :rtype: float
+    :return: seconds
+    """
+    timespec = Timespec()
+    if libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.clock_gettime
+except (OSError, AttributeError):
+    libc = None
+
+if hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+elif libc is not None:
+    monotonic = clock_monotonic
+else:
+    monotonic = time.time
+
+DEFAULT_OUTPUT_TAIL = 65536
+KILL_TIMEOUT = 5
+SHELL_SYNTAX = re.compile(r'[|&;<>()$`*?\[\]{}~#!\n]')
+RUSAGE_FIELDS = (
+    ('user', 'ru_utime'),
+    ('sys', 'ru_stime'),
+    ('max_rss', 'ru_maxrss'),
+    ('block_in', 'ru_inblock'),
+    ('block_out', 'ru_oublock'),
+    ('voluntary_switches', 'ru_nvcsw'),
+    ('involuntary_switches', 'ru_nivcsw'),
+)
+# pages the child may touch between fork and exec, in kilobytes
+FORK_RSS_MARGIN = 1024
+
+# use libyaml if it's available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 Status = namedtuple('Status', ['name', 'code'])
+ParseError = namedtuple('ParseError', ['file', 'error'])
 
 
 def key_value_enum(enums):
@@ -38,60 +107,600 @@ STATUS = key_value_enum({
     'not_found':       7,
     'already_running': 8,
     'error':           9,
+    'skipped':         10,
+    'timeout':         11,
 })
 
 
-def task_library(config):
+def status_name(code):
+    """Find the status name by its code
+
+    :param code: int
+    :rtype: str
+    """
+    for status in STATUS.__dict__.itervalues():
+        if isinstance(status, Status) and status.code == code:
+            return status.name
+    return STATUS.error.name
+
+
+def task_library(config, errors=None):
+    """Parse all task files and build the task library
+
+    :param config: Config
+    :param errors: if a list is given ParseError of each file that
+                   could not be parsed will be added to it
+    :rtype: dict
+    :return: Task library dictionary
+    """
     library = {}
-    for task_file in tasks_files(config):
-        if not os.path.isfile(task_file):
-            continue
-        task_data = process_task_data(task_file)
-        library.update(task_data)
+    parsed = parse_task_files(config, list(tasks_files(config)))
+    for task_file, tasks, positions, error in parsed:
+        if error and errors is not None:
+            errors.append(ParseError(task_file, error))
+        library.update(tasks)
     return library
 
 
-def process_task_data(task_file):
-    task_data = {}
+def process_task(task, task_directory):
+    """Validate a single task from the task file and set its defaults
+
+    :param task: dict
+    :param task_directory: str
+    :rtype: dict
+    :return: the task or None if it's not valid
+    """
+    if not isinstance(task, dict):
+        return None
+    if not 'id' in task:
+        return None
+    if not 'type' in task:
+        return None
+    if not task['type'] in ['puppet', 'shell']:
+        return None
+    if 'parameters' in task:
+        if not 'cwd' in task:
+            task['parameters']['cwd'] = task_directory
+    return task
+
+
+def task_file_items(task_file):
+    """Parse the task file and locate the items of its top level list
+
+    :param task_file: str
+    :rtype: list
+    :return: List of (item, start, end) where start and end are byte
+             offsets of the item's lines in the file
+    """
+    items = []
+    with open(task_file, 'rb') as tf:
+        content = tf.read()
+    # marks of the parser are character offsets
+    text = None
+    try:
+        content.decode('ascii')
+    except UnicodeDecodeError:
+        text = content.decode('utf-8')
+
+    def byte_offset(index):
+        if text is None:
+            return index
+        return len(text[:index].encode('utf-8'))
+
+    loader = YamlLoader(content)
+    try:
+        node = loader.get_single_node()
+        if not isinstance(node, yaml.SequenceNode):
+            return items
+        for item_node in node.value:
+            start = item_node.start_mark.index - item_node.start_mark.column
+            end = item_node.end_mark.index
+            item = loader.construct_document(item_node)
+            items.append((item, byte_offset(start), byte_offset(end)))
+    finally:
+        loader.dispose()
+    return items
+
+
+def parse_task_file(task_file):
+    """Get all valid tasks from the task file and their positions
+
+    :param task_file: str
+    :rtype: tuple
+    :return: (task_file, tasks, positions, error) where tasks are by their
+             ids, positions are (start, end) offsets of each task in the file
+             and error is the parsing error message or None
+    """
+    tasks = {}
+    positions = {}
     task_directory = os.path.dirname(task_file)
-    with open(task_file, 'r') as tf:
+    try:
+        items = task_file_items(task_file)
+    except Exception, exception:
+        return task_file, tasks, positions, str(exception)
+    for item, start, end in items:
+        task = process_task(item, task_directory)
+        if not task:
+            continue
+        tasks[task['id']] = task
+        positions[task['id']] = (start, end)
+    return task_file, tasks, positions, None
+
+
+def parse_task_files(config, task_files):
+    """Parse many task files using a process pool if there are enough of them
+
+    :param config: Config
+    :param task_files: list
+    :rtype: list
+    :return: List of parse_task_file results in the order of files
+    """
+    workers = config['parse_workers'] or None
+    if len(task_files) < config['parse_pool_threshold'] or workers == 1:
+        return map(parse_task_file, task_files)
+    try:
+        pool = multiprocessing.Pool(workers)
+    except OSError:
+        return map(parse_task_file, task_files)
+    try:
+        return pool.map(parse_task_file, task_files)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def process_task_data(task_file):
+    """Get all valid tasks from the task file
+
+    :param task_file: str
+    :rtype: dict
+    :return: Dictionary of tasks by their ids
+    """
+    return parse_task_file(task_file)[1]
+
+
+def process_task_chunk(task_file, start, end):
+    """Parse only the part of the task file with a single task
+
+    Only this part is read from the file.
+    :param task_file: str
+    :param start: byte offset of the task
+    :param end: byte offset of the end of the task
+    :rtype: dict
+    :return: the task or None if the part could not be parsed
+    """
+    try:
+        with open(task_file, 'rb') as tf:
+            tf.seek(start)
+            content = tf.read(end - start).decode('utf-8')
+        tasks = yaml.load(content, Loader=YamlLoader)
+    except Exception:
+        return None
+    if not isinstance(tasks, list) or len(tasks) != 1:
+        return None
+    return process_task(tasks[0], os.path.dirname(task_file))
+
+
+def directory_mtime(path):
+    """Modification time of the directory or None if it's not there
+
+    :param path: str
+    :rtype: float
+    """
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def tasks_files(config, directories=None):
+    """Find all task files in the tasks directory
+
+    Files are found in the same order as os.walk would find them.
+    :param config: Config
+    :param directories: if a dict is given the mtime of every searched
+                        directory is added to it
+    :return: generator of file paths
+    """
+    if scandir is None:
+        for root, dirnames, filenames in os.walk(config['tasks_directory']):
+            if directories is not None:
+                directories[root] = directory_mtime(root)
+            for filename in fnmatch.filter(filenames,
+                                           config['tasks_pattern']):
+                task_file = os.path.join(root, filename)
+                if os.path.isfile(task_file):
+                    yield task_file
+        return
+    pattern = re.compile(fnmatch.translate(config['tasks_pattern']))
+    directories_left = [config['tasks_directory']]
+    while directories_left:
+        directory = directories_left.pop()
+        # taken before the listing, a file added meanwhile changes it
+        mtime = directory_mtime(directory)
         try:
-            tasks = yaml.load(tf)
-            if not isinstance(tasks, list):
-                return task_data
-            for task in tasks:
-                if not 'id' in task:
-                    continue
-                if not 'type' in task:
-                    continue
-                if not task['type'] in ['puppet', 'shell']:
-                    continue
-                if 'parameters' in task:
-                    if not 'cwd' in task:
-                        task['parameters']['cwd'] = task_directory
-                task_data[task['id']] = task
-        except Exception, exception:
-            print "Error parsing file: %s - %s" % (task_file, exception)
-            return task_data
-    return task_data
-
-
-def tasks_files(config):
-    for root, dirnames, filenames in os.walk(config['tasks_directory']):
-        for filename in fnmatch.filter(filenames, config['tasks_pattern']):
-            yield os.path.join(root, filename)
+            entries = list(scandir(directory))
+        except OSError:
+            continue
+        if directories is not None:
+            directories[directory] = mtime
+        subdirectories = []
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirectories.append(entry.path)
+                elif pattern.match(entry.name) and entry.is_file():
+                    yield entry.path
+            except OSError:
+                continue
+        directories_left.extend(reversed(subdirectories))
 
 
 def ensure_dir_created(path):
     if not os.path.exists(path):
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            # another worker could have created it
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def update_digest(digest, path):
+    """Add the state of the file or directory tree to the digest
+
+    Contents of a file are added. A directory tree is walked and the
+    relative path, size and mtime of its every file are added.
+    :param digest: hashlib object
+    :param path: str
+    """
+    digest.update(path + '\0')
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), ''):
+                digest.update(block)
+        return
+    if not os.path.isdir(path):
+        digest.update('missing\0')
+        return
+    for root, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            file_path = os.path.join(root, filename)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            digest.update('%s\0%d\0%r\0' % (
+                os.path.relpath(file_path, path),
+                stat.st_size,
+                stat.st_mtime,
+            ))
+
 
+def output_stream(path):
+    """Open the file for the command output or a temporary file
 
-def execute(cmd):
-    command = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    stdout, stderr = command.communicate()
-    return command.returncode, stdout, stderr
+    :param path: str or None
+    :rtype: file
+    """
+    if path:
+        return open(path, 'w+b')
+    return tempfile.TemporaryFile()
+
+
+def read_tail(stream, size):
+    """Read the last bytes of the output file
+
+    :param stream: file
+    :param size: maximum size of the tail
+    :rtype: str
+    """
+    stream.seek(0, os.SEEK_END)
+    length = stream.tell()
+    if length <= size:
+        stream.seek(0)
+        return stream.read()
+    stream.seek(length - size)
+    return "... %d bytes skipped ...\n" % (length - size) + stream.read()
+
+
+def group_exists(pgid):
+    """Check if any process of the group is still there
+
+    :param pgid: process group id
+    :rtype: bool
+    """
+    try:
+        os.killpg(pgid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+    return True
+
+
+def kill_group(command, kill_timeout=KILL_TIMEOUT):
+    """Terminate the process group of the command
+
+    SIGTERM is sent first and if any process of the group is still there
+    after 'kill_timeout' seconds, even if the command itself has exited,
+    the group is killed with SIGKILL. The command is reaped.
+    :param command: subprocess.Popen
+    :param kill_timeout: float
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(command.pid, sig)
+        except OSError:
+            pass
+        deadline = monotonic() + kill_timeout
+        delay = 0.001
+        while True:
+            # an unreaped command keeps its group existing
+            if reap(command, os.WNOHANG) is not None and \
+                    not group_exists(command.pid):
+                return
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+
+
+def rusage_stats(rusage):
+    """Resource usage of a child as a dictionary
+
+    CPU times are in seconds and the maximum RSS is in kilobytes.
+    :param rusage: resource.struct_rusage
+    :rtype: dict
+    """
+    return dict((name, getattr(rusage, field))
+                for name, field in RUSAGE_FIELDS)
+
+
+def current_rss():
+    """Resident set size of this process
+
+    :rtype: int
+    :return: kilobytes or None if it's unknown
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def reap(command, options=0):
+    """Wait for the command by wait4 keeping its resource usage
+
+    The resource usage is saved to the 'rusage' attribute of the command.
+    :param command: subprocess.Popen
+    :param options: os.WNOHANG to return at once if it's running
+    :rtype: int
+    :return: exit code or None if it's running
+    """
+    while command.returncode is None:
+        try:
+            pid, exit_status, rusage = os.wait4(command.pid, options)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.ECHILD:
+                raise
+            # reaped by somebody else, the usage is lost
+            return command.poll()
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(exit_status):
+            command.returncode = -os.WTERMSIG(exit_status)
+        else:
+            command.returncode = os.WEXITSTATUS(exit_status)
+        command.rusage = rusage_stats(rusage)
+    return command.returncode
+
+
+def wait_process(command, deadline=None):
+    """Wait for the command to finish until the deadline
+
+    :param command: subprocess.Popen
+    :param deadline: monotonic clock deadline or None to wait forever
+    :rtype: int
+    :return: exit code or None if the deadline has passed
+    """
+    if deadline is None:
+        return reap(command)
+    delay = 0.001
+    while reap(command, os.WNOHANG) is None:
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+    return command.returncode
+
+
+def split_command(cmd):
+    """Split the command to run it without the shell
+
+    Commands with any shell syntax (pipes, redirections, lists, variables,
+    globs, subshells, assignments) or with a first word that is not an
+    executable in PATH (shell builtins and keywords) need the shell.
+    :param cmd: str
+    :rtype: list
+    :return: argv list or None if the shell is needed
+    """
+    if SHELL_SYNTAX.search(cmd):
+        return None
+    try:
+        argv = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not argv or '=' in argv[0]:
+        return None
+    if not find_executable(argv[0]):
+        return None
+    return argv
+
+
+class Command(object):
+    """A command writing its output directly to the files
+
+    The output does not pass through the memory of this process, only
+    the last 'tail' bytes of each output are read back after the command
+    is finished. Temporary files are used if no files are given.
+    The command is run in its own process group. If it runs longer than
+    'timeout' seconds the whole group is killed and None is returned
+    as the exit code.
+    With 'direct' a command without any shell syntax is executed directly
+    instead of starting /bin/sh to run it.
+    'preexec_fn' is called in the child process before the command is
+    executed, after it has got its own process group.
+
+    Command can be waited for with 'wait' or, by an event loop, started
+    with 'start' and checked with 'poll' until it's finished.
+    The run time and the resource usage of the finished command are
+    given by 'stats'.
+    """
+
+    def __init__(self, cmd, stdout_file=None, stderr_file=None,
+                 timeout=None, direct=False, cwd=None, preexec_fn=None):
+        self.cmd = cmd
+        self.stdout_file = stdout_file
+        self.stderr_file = stderr_file
+        self.timeout = timeout
+        self.direct = direct
+        self.cwd = cwd
+        self.preexec_fn = preexec_fn
+        self.process = None
+        self.stdout = None
+        self.stderr = None
+        self.deadline = None
+        self.code = None
+        self.started = None
+        self.finished = None
+        self.parent_rss = None
+
+    def preexec(self):
+        os.setsid()
+        if self.preexec_fn:
+            self.preexec_fn()
+
+    def popen(self):
+        argv = None
+        if self.direct:
+            argv = split_command(self.cmd)
+        if argv:
+            try:
+                return subprocess.Popen(
+                    argv, stdout=self.stdout, stderr=self.stderr,
+                    cwd=self.cwd, preexec_fn=self.preexec)
+            except OSError:
+                pass
+        return subprocess.Popen(
+            self.cmd, stdout=self.stdout, stderr=self.stderr, shell=True,
+            cwd=self.cwd, preexec_fn=self.preexec)
+
+    def start(self):
+        self.started = monotonic()
+        if self.timeout:
+            self.deadline = self.started + self.timeout
+        self.stdout = output_stream(self.stdout_file)
+        self.stderr = output_stream(self.stderr_file)
+        self.parent_rss = current_rss()
+        try:
+            self.process = self.popen()
+        except OSError:
+            self.close()
+            raise
+
+    def poll(self):
+        """Check if the command is finished, kill it after the deadline
+
+        :rtype: bool
+        """
+        self.code = reap(self.process, os.WNOHANG)
+        if self.code is not None:
+            self.finished = monotonic()
+            return True
+        if self.deadline is not None and monotonic() >= self.deadline:
+            kill_group(self.process)
+            self.finished = monotonic()
+            return True
+        return False
+
+    def wait(self):
+        self.start()
+        self.code = wait_process(self.process, self.deadline)
+        if self.code is None:
+            kill_group(self.process)
+        self.finished = monotonic()
+
+    def stats(self):
+        """Run time and resource usage of the finished command
+
+        :rtype: dict
+        :return: command, exit code, monotonic start and end times and
+                 the wait4 resource usage if it's known
+        """
+        stats = {
+            'cmd': self.cmd,
+            'code': self.code,
+            'start': self.started,
+            'end': self.finished,
+        }
+        stats.update(getattr(self.process, 'rusage', None) or {})
+        # the child is forked from tasklib and its maximum RSS is at least
+        # the RSS of tasklib at the fork, only a larger one is the peak of
+        # the command itself
+        if stats.get('max_rss', None) is not None and (
+                self.parent_rss is None or
+                stats['max_rss'] <= self.parent_rss + FORK_RSS_MARGIN):
+            stats['max_rss'] = None
+        return stats
+
+    def close(self):
+        for stream in (self.stdout, self.stderr):
+            if stream:
+                stream.close()
+
+    def result(self, tail=None):
+        """Get the result of the finished command
+
+        :param tail: maximum size of the returned output
+        :rtype: tuple
+        :return: exit code or None if timed out and tails of stdout
+                 and stderr
+        """
+        if tail is None:
+            tail = DEFAULT_OUTPUT_TAIL
+        try:
+            return (self.code,
+                    read_tail(self.stdout, tail),
+                    read_tail(self.stderr, tail))
+        finally:
+            self.close()
+
+
+def execute(cmd, stdout_file=None, stderr_file=None, tail=None,
+            timeout=None, direct=False, cwd=None):
+    """Run the command and wait for it
+
+    :param cmd: str
+    :param stdout_file: path to save stdout
+    :param stderr_file: path to save stderr
+    :param tail: maximum size of the returned output
+    :param timeout: seconds or None to wait forever
+    :param direct: run simple commands without the shell
+    :param cwd: directory to run the command in
+    :rtype: tuple
+    :return: exit code and tails of stdout and stderr
+    """
+    command = Command(cmd, stdout_file, stderr_file, timeout, direct, cwd)
+    command.wait()
+    return command.result(tail)
 
 
 def output(string, newline=True, fill=None):
@@ -125,6 +734,45 @@ def report_to_text(report):
     return text_report
 
 
+def timing_to_text(timing):
+    """Timing of the last run as a table of phases
+
+    Resource usage of the commands of a phase is summed up, the maximum
+    RSS is the largest known one of its commands.
+    :param timing: dict
+    :rtype: str
+    """
+    if not isinstance(timing, dict) or not timing.get('phases'):
+        return
+    row = '%-6s %9s %9s %9s %10s %9s %9s %9s\n'
+    text_timing = "===== timing =====\n"
+    text_timing += row % ('Phase', 'Duration', 'User', 'Sys', 'MaxRSS KB',
+                          'Blk in', 'Blk out', 'Switches')
+    for action in ['pre', 'task', 'post']:
+        phase = timing['phases'].get(action, None)
+        if not phase:
+            continue
+        commands = phase.get('commands', None) or []
+        usage = dict((name, sum(command.get(name, 0) or 0
+                                for command in commands))
+                     for name, field in RUSAGE_FIELDS)
+        known_rss = [command['max_rss'] for command in commands
+                     if command.get('max_rss', None) is not None]
+        usage['max_rss'] = max(known_rss) if known_rss else '-'
+        duration = phase.get('duration', None)
+        text_timing += row % (
+            action,
+            '-' if duration is None else '%.3f' % duration,
+            '%.3f' % usage['user'],
+            '%.3f' % usage['sys'],
+            usage['max_rss'],
+            usage['block_in'],
+            usage['block_out'],
+            usage['voluntary_switches'] + usage['involuntary_switches'],
+        )
+    return text_timing
+
+
 def task_type(task_data):
     parameters_type = task_data.get('parameters', {}).get('type', None)
     if parameters_type:
@@ -29,6 +29,7 @@ class Config(object):
             'tasks_directory': '/etc/puppet/modules/osnailyfacter/modular/',
             'tasks_pattern': '*tasks.yaml',
             'puppet_modules': '/etc/puppet/modules',
+            'puppet_manifest': 'site.pp',
             'puppet_options': '--logdest syslog '
                               '--logdest /var/log/puppet.log '
                               '--logdest console '
@@ -43,6 +44,42 @@ class Config(object):
             'log_file': '/var/tmp/tasklib.log',
             'log_console': False,
             'debug': False,
+            'use_cache': True,
+            'parse_workers': 0,
+            'parse_pool_threshold': 64,
+            'workers': 0,
+            'history_size': 10,
+            'output_tail': 65536,
+            'exec_mode': 'direct',
+            'persistent_shell': '/bin/bash',
+            'engine': 'sync',
+            'profile_top': 10,
+            'catalog_cache': False,
+            'puppet_batch': False,
+            'state_backend': 'file',
+            'state_db': None,
+            'report_compression': 'gzip',
+            'server_refresh': 1.0,
+            'supervisor_workers': 0,
+            'cgroup_root': '/sys/fs/cgroup/tasklib',
+            'concurrency_limits': {},
+            'catalog_dir': '/var/tmp/task_catalogs',
+            'catalog_node': None,
+            'hiera_paths': [
+                '/etc/hiera.yaml',
+                '/etc/puppet/hiera.yaml',
+                '/etc/hiera',
+            ],
+            'facts_paths': [
+                '/etc/astute.yaml',
+                '/etc/facter/facts.d',
+            ],
+            'incremental': False,
+            'force': False,
+            'default_durations': {
+                'puppet': 60,
+                'shell': 1,
+            },
         }
 
     def update_from_file(self, config_file):
@@ -0,0 +1,269 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Execution engines for the steps of tasks and actions.
+
+Tasks and actions describe their work as generators of steps:
+
+* A generator yields an operation such as 'common.Command' or 'Sleep' to
+  wait until it's finished. An operation has 'start', 'poll' and 'wait'
+  methods and an optional 'deadline'.
+* A generator yields another generator to run it and wait for its end.
+  Exceptions raised by the inner generator are raised at the yield.
+* Any other yielded value is sent back at once.
+
+The sync engine ('run') waits for every operation in turn and is used by
+Task.run and Action.run. The async engine runs many generators in a single
+process and waits for all their operations at the same time, limiting
+the number of running commands.
+"""
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import sys
+import time
+import types
+
+from tasklib import common
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.deadline = None
+
+    def start(self):
+        self.deadline = common.monotonic() + self.seconds
+
+    def poll(self):
+        return common.monotonic() >= self.deadline
+
+    def wait(self):
+        self.start()
+        time.sleep(max(self.seconds, 0))
+
+
+def is_operation(value):
+    return hasattr(value, 'start') and hasattr(value, 'poll')
+
+
+def is_command(value):
+    return isinstance(value, common.Command)
+
+
+def setup_wakeup(signums):
+    """Make the signals wake up a select on a pipe
+
+    A signal received at any time is kept in the pipe until it's read, so
+    it can't be lost between a check and the wait.
+    :param signums: list of signal numbers
+    :rtype: tuple
+    :return: the pipe and the saved handlers for restore_wakeup
+    """
+    wakeup = os.pipe()
+    for fd in wakeup:
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    handlers = []
+    for signum in signums:
+        handlers.append(
+            (signum, signal.signal(signum, lambda signum, frame: None)))
+        signal.siginterrupt(signum, False)
+    return wakeup, (handlers, signal.set_wakeup_fd(wakeup[1]))
+
+
+def restore_wakeup(wakeup, saved):
+    handlers, wakeup_fd = saved
+    for signum, handler in handlers:
+        signal.signal(signum, handler)
+    signal.set_wakeup_fd(wakeup_fd)
+    for fd in wakeup:
+        os.close(fd)
+
+
+def wait_wakeup(wakeup, timeout=None):
+    """Wait for a signal or the timeout and empty the pipe
+
+    :param wakeup: pipe of setup_wakeup
+    :param timeout: seconds or None to wait for a signal
+    """
+    try:
+        readable = select.select([wakeup[0]], [], [], timeout)[0]
+    except select.error as e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return
+    if readable:
+        try:
+            while os.read(wakeup[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class Coroutine(object):
+    """Stack of nested generators advanced to their next operation"""
+
+    def __init__(self, generator):
+        self.stack = [generator]
+
+    @property
+    def done(self):
+        return not self.stack
+
+    def step(self, error=None):
+        """Advance the generators until they yield an operation
+
+        :param error: exc_info to raise at the current yield
+        :return: the operation or None if all generators have finished
+        """
+        value = None
+        while self.stack:
+            generator = self.stack[-1]
+            try:
+                if error:
+                    result = generator.throw(*error)
+                else:
+                    result = generator.send(value)
+            except StopIteration:
+                self.stack.pop()
+                error = None
+                value = None
+                continue
+            except Exception:
+                self.stack.pop()
+                if not self.stack:
+                    raise
+                error = sys.exc_info()
+                continue
+            error = None
+            value = None
+            if isinstance(result, types.GeneratorType):
+                self.stack.append(result)
+            elif is_operation(result):
+                return result
+            else:
+                value = result
+        return None
+
+
+def run(generator):
+    """Run the steps waiting for each operation in turn
+
+    :param generator: generator of steps
+    """
+    coroutine = Coroutine(generator)
+    operation = coroutine.step()
+    while not coroutine.done:
+        try:
+            operation.wait()
+        except Exception:
+            operation = coroutine.step(sys.exc_info())
+        else:
+            operation = coroutine.step()
+
+
+class AsyncEngine(object):
+    """Runs many generators of steps at once in a single process
+
+    * A finished child process wakes the loop through SIGCHLD, deadlines of
+      operations wake it by the select timeout, so there is no busy polling
+      and no thread per child.
+    * At most 'concurrency' commands are running at the same time, the
+      other ones wait in the queue.
+    * The callback of a generator is called with None when it's finished
+      or with exc_info if it has raised an exception.
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.commands = 0
+        self.operations = {}
+        self.queue = []
+        self.callbacks = {}
+        self.wakeup = None
+
+    def spawn(self, generator, callback=None):
+        coroutine = Coroutine(generator)
+        self.callbacks[coroutine] = callback
+        self.advance(coroutine)
+
+    def advance(self, coroutine, error=None):
+        try:
+            operation = coroutine.step(error)
+        except Exception:
+            self.finish(coroutine, sys.exc_info())
+            return
+        if operation is None:
+            self.finish(coroutine, None)
+        elif is_command(operation) and self.commands >= self.concurrency:
+            self.queue.append((operation, coroutine))
+        else:
+            self.start(operation, coroutine)
+
+    def start(self, operation, coroutine):
+        try:
+            operation.start()
+        except Exception:
+            self.advance(coroutine, sys.exc_info())
+            return
+        if is_command(operation):
+            self.commands += 1
+        self.operations[operation] = coroutine
+
+    def finish(self, coroutine, error):
+        callback = self.callbacks.pop(coroutine)
+        if callback:
+            callback(error)
+
+    def complete(self, operation):
+        coroutine = self.operations.pop(operation)
+        if is_command(operation):
+            self.commands -= 1
+            while self.queue and self.commands < self.concurrency:
+                self.start(*self.queue.pop(0))
+        self.advance(coroutine)
+
+    def timeout(self):
+        """Time until the nearest deadline of the running operations
+
+        :rtype: float
+        """
+        deadlines = [operation.deadline for operation in self.operations
+                     if getattr(operation, 'deadline', None) is not None]
+        if not deadlines:
+            return None
+        return max(min(deadlines) - common.monotonic(), 0)
+
+    def sleep(self):
+        """Wait for a child process to exit or for the nearest deadline"""
+        wait_wakeup(self.wakeup, self.timeout())
+
+    def run(self):
+        """Run until all spawned generators are finished"""
+        self.wakeup, saved = setup_wakeup([signal.SIGCHLD])
+        try:
+            while self.operations or self.queue:
+                for operation in self.operations.keys():
+                    if operation.poll():
+                        self.complete(operation)
+                if self.operations:
+                    self.sleep()
+        finally:
+            restore_wakeup(self.wakeup, saved)
+            self.wakeup = None
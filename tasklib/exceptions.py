@@ -33,6 +33,15 @@ class NotValidMetadata(TaskLibException):
                    self.object_name
 
 
+class NotValidResources(NotValidMetadata):
+    def __init__(self, task_name, name, value):
+        self.object_name = task_name
+        self.name = name
+        self.value = value
+        self.msg = "Task: '%s' resources: '%s' has an invalid value: '%s'!" \
+                   % (self.object_name, self.name, self.value)
+
+
 class Failed(TaskLibException):
     def __init__(self, task_name, action_type):
         self.task_name = task_name
@@ -41,9 +50,31 @@ class Failed(TaskLibException):
                    (self.task_name, self.action_type)
 
 
+class TimedOut(Failed):
+    def __init__(self, task_name, action_type, timeout):
+        self.task_name = task_name
+        self.action_type = action_type
+        self.timeout = timeout
+        self.msg = "Task: '%s' action: '%s' have timed out after %s s!" % \
+                   (self.task_name, self.action_type, self.timeout)
+
+
 class AlreadyRunning(TaskLibException):
     def __init__(self, task_name, pid):
         self.task_name = task_name
         self.pid = pid
         self.msg = "Task: '%s' is already running at pid: '%s'!" % \
                    (self.task_name, self.pid)
+
+
+class CoprocessExited(TaskLibException):
+    def __init__(self, shell):
+        self.shell = shell
+        self.msg = "Persistent shell: '%s' has exited!" % self.shell
+
+
+class CycleDetected(TaskLibException):
+    def __init__(self, cycle):
+        self.cycle = cycle
+        self.msg = "Dependency cycle detected: '%s'!" % \
+                   ' -> '.join(self.cycle)
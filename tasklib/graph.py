@@ -0,0 +1,179 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Dependency graph of the tasks.
+
+* 'requires' of a task lists the tasks that should be finished before it.
+* 'required_for' of a task lists the tasks that should wait for it.
+* Only the tasks present in the graph are connected, references to the
+  other tasks (stages, tasks of other types, tasks not selected to run)
+  are ignored.
+* A graph should not have cycles, 'verify' raises 'exceptions.CycleDetected'
+  if there is one.
+* Given the estimated durations of the tasks the graph can find the
+  longest remaining path from every task to the end of the graph and
+  the critical path of the whole graph.
+"""
+
+from tasklib import exceptions
+
+
+def task_references(task_data, key):
+    references = task_data.get(key, None) or []
+    if not isinstance(references, list):
+        references = [references]
+    return references
+
+
+class Graph(object):
+    def __init__(self, library, task_ids=None):
+        if task_ids is None:
+            task_ids = library.keys()
+        self.library = library
+        self.nodes = set()
+        self.requires = {}
+        self.required_for = {}
+        for task_id in task_ids:
+            if task_id not in library:
+                continue
+            self.nodes.add(task_id)
+            self.requires[task_id] = set()
+            self.required_for[task_id] = set()
+        for task_id in self.nodes:
+            task_data = library[task_id]
+            for required in task_references(task_data, 'requires'):
+                self.add_edge(required, task_id)
+            for required_for in task_references(task_data, 'required_for'):
+                self.add_edge(task_id, required_for)
+
+    def add_edge(self, first, second):
+        """Make the second task wait for the first one
+
+        :param first: str
+        :param second: str
+        """
+        if first not in self.nodes or second not in self.nodes:
+            return
+        self.requires[second].add(first)
+        self.required_for[first].add(second)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, task_id):
+        return task_id in self.nodes
+
+    def find_cycle(self):
+        """Find any dependency cycle in the graph
+
+        :rtype: list
+        :return: List of tasks forming a cycle or None
+        """
+        visited = set()
+        for start in sorted(self.nodes):
+            if start in visited:
+                continue
+            path = [start]
+            on_path = set(path)
+            stack = [iter(sorted(self.required_for[start]))]
+            visited.add(start)
+            while stack:
+                for task_id in stack[-1]:
+                    if task_id in on_path:
+                        return path[path.index(task_id):] + [task_id]
+                    if task_id in visited:
+                        continue
+                    visited.add(task_id)
+                    path.append(task_id)
+                    on_path.add(task_id)
+                    stack.append(iter(sorted(self.required_for[task_id])))
+                    break
+                else:
+                    stack.pop()
+                    on_path.discard(path.pop())
+        return None
+
+    def verify(self):
+        cycle = self.find_cycle()
+        if cycle:
+            raise exceptions.CycleDetected(cycle)
+
+    def topology(self):
+        """Sort the tasks so every task goes after the tasks it requires
+
+        :rtype: list
+        :return: Sorted list of task ids
+        """
+        self.verify()
+        waiting = dict((task_id, len(self.requires[task_id]))
+                       for task_id in self.nodes)
+        ready = sorted(task_id for task_id, count in waiting.iteritems()
+                       if count == 0)
+        order = []
+        while ready:
+            task_id = ready.pop(0)
+            order.append(task_id)
+            for next_task_id in sorted(self.required_for[task_id]):
+                waiting[next_task_id] -= 1
+                if waiting[next_task_id] == 0:
+                    ready.append(next_task_id)
+        return order
+
+    def descendants(self, task_id):
+        """All tasks that directly or indirectly require this task
+
+        :param task_id: str
+        :rtype: set
+        """
+        found = set()
+        stack = list(self.required_for[task_id])
+        while stack:
+            next_task_id = stack.pop()
+            if next_task_id in found:
+                continue
+            found.add(next_task_id)
+            stack.extend(self.required_for[next_task_id])
+        return found
+
+    def remaining_paths(self, durations):
+        """Length of the longest path from each task to the end of the graph
+
+        The length includes the duration of the task itself.
+        :param durations: dict of estimated task durations
+        :rtype: dict
+        """
+        lengths = {}
+        for task_id in reversed(self.topology()):
+            following = [lengths[next_task_id]
+                         for next_task_id in self.required_for[task_id]]
+            lengths[task_id] = durations.get(task_id, 0) + \
+                max(following or [0])
+        return lengths
+
+    def critical_path(self, durations):
+        """The longest path of the graph
+
+        :param durations: dict of estimated task durations
+        :rtype: list
+        :return: List of task ids on the critical path
+        """
+        lengths = self.remaining_paths(durations)
+        path = []
+        candidates = [task_id for task_id in self.nodes
+                      if not self.requires[task_id]]
+        while candidates:
+            task_id = max(sorted(candidates), key=lengths.get)
+            path.append(task_id)
+            candidates = self.required_for[task_id]
+        return path
@@ -0,0 +1,75 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Run history of the tasks.
+
+Every run of a task records the wall clock duration of its pre, task and
+post actions to the state backend. Only the last 'history_size' runs are
+kept. The history is used to estimate how long
+a task is going to run.
+"""
+
+import time
+
+from tasklib import common
+from tasklib import state
+
+
+def load(config, task_id):
+    """Read the run history of the task
+
+    :param config: Config
+    :param task_id: str
+    :rtype: list
+    :return: List of run records, the oldest first
+    """
+    return state.backend(config).history(task_id)
+
+
+def record(config, task_id, status, durations):
+    """Add a run record to the task history
+
+    :param config: Config
+    :param task_id: str
+    :param status: status name of the run
+    :param durations: dict of action durations in seconds
+    """
+    state.backend(config).add_history(task_id, {
+        'time': time.time(),
+        'status': status,
+        'durations': durations,
+    })
+
+
+def estimate(config, task_id, task_data):
+    """Estimate the task run duration
+
+    Average duration of the successful runs is used. If there are none
+    then all runs are used and if the task was never run the default
+    duration of its type is used.
+    :param config: Config
+    :param task_id: str
+    :param task_data: dict
+    :rtype: float
+    :return: estimated duration in seconds
+    """
+    records = load(config, task_id)
+    successful = [r for r in records
+                  if r.get('status') == common.STATUS.success.name]
+    records = successful or records
+    if records:
+        total = sum(sum(r.get('durations', {}).values()) for r in records)
+        return float(total) / len(records)
+    defaults = config['default_durations'] or {}
+    return float(defaults.get(common.task_type(task_data), 0))
@@ -0,0 +1,264 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Lock files of the running tasks.
+
+* A running task holds the flock of <pid_dir>/<task>.lock for the whole
+  run in any engine, daemon or worker. The lock is released by the kernel
+  when the process exits, so a crashed run never looks running and a
+  reused pid is never mistaken for the task.
+* A task is running if its lock can't be taken. The check is a single
+  non-blocking lock probe. The probe holds a shared lock for a moment, so
+  a run failing to take the lock tries again for 'ACQUIRE_RETRY' seconds
+  before it gives up.
+* The lock file contains the pid and the start time of the run. Lock
+  files are not removed after the run, removing them would race with
+  the next run.
+* Lock descriptors are not inherited by the commands started by the task,
+  so a background process left by a command doesn't hold the lock.
+* A task MAY have a 'concurrency_group', its type is the group by default.
+  'concurrency_limits' of the configuration limit the number of tasks of
+  a group running at the same time, the 'default' limit is used for the
+  groups not listed. No limit or 0 means no limit.
+* A group limited to N tasks has N slot files in <pid_dir>/concurrency and
+  a running task holds the flock of one of them, so the limits are shared
+  by all tasklib processes: runs, daemons, workers and graph runners.
+* A task waiting for a slot is an operation of the engines, the async
+  engine keeps running other tasks while it waits.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import time
+
+from tasklib import common
+from tasklib import exceptions
+
+SUFFIX = '.lock'
+ACQUIRE_RETRY = 0.05
+ACQUIRE_RETRY_INTERVAL = 0.001
+SLOTS_DIRECTORY = 'concurrency'
+SLOT_POLL_INTERVAL = 0.1
+
+
+def lock_file(config, task_id):
+    return os.path.join(config['pid_dir'], task_id + SUFFIX)
+
+
+def open_lock(path):
+    """Open the lock file not inherited by the commands
+
+    :rtype: int
+    :return: file descriptor
+    """
+    common.ensure_dir_created(os.path.dirname(path))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+                fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fd
+
+
+def try_lock(fd):
+    """Take the exclusive lock without waiting
+
+    :rtype: bool
+    :return: True if the lock is taken
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def probe(path):
+    """Check if the lock is held by a running task
+
+    :param path: path to the lock file
+    :rtype: dict
+    :return: pid and start time of the run or None if it's not running
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+        else:
+            return None
+        try:
+            holder = json.loads(os.read(fd, 4096))
+        except ValueError:
+            holder = {}
+        if not isinstance(holder, dict):
+            holder = {}
+        return {
+            'pid': holder.get('pid', None),
+            'start': holder.get('start', None),
+        }
+    finally:
+        os.close(fd)
+
+
+def running(config):
+    """Running tasks found by a single scan of the pid directory
+
+    :param config: Config
+    :rtype: dict
+    :return: Dictionary of task ids and their pids and start times
+    """
+    tasks = {}
+    directory = config['pid_dir']
+    if not os.path.isdir(directory):
+        return tasks
+    for file_name in os.listdir(directory):
+        if not file_name.endswith(SUFFIX):
+            continue
+        holder = probe(os.path.join(directory, file_name))
+        if holder is not None:
+            tasks[file_name[:-len(SUFFIX)]] = holder
+    return tasks
+
+
+class TaskLock(object):
+    def __init__(self, config, task_id):
+        self.task_id = task_id
+        self.path = lock_file(config, task_id)
+        self.fd = None
+
+    def holder(self):
+        """Pid and start time of the run holding the lock or None"""
+        if self.fd is not None:
+            return {'pid': os.getpid(), 'start': None}
+        return probe(self.path)
+
+    def acquire(self):
+        """Take the lock without waiting for another run
+
+        A lock held by a probe is released at once, it's tried again
+        for a short time.
+        :raises: exceptions.AlreadyRunning if it's held by another run
+        """
+        fd = open_lock(self.path)
+        deadline = common.monotonic() + ACQUIRE_RETRY
+        try:
+            locked = try_lock(fd)
+            while not locked and common.monotonic() < deadline:
+                time.sleep(ACQUIRE_RETRY_INTERVAL)
+                locked = try_lock(fd)
+        except IOError:
+            os.close(fd)
+            raise
+        if not locked:
+            os.close(fd)
+            holder = probe(self.path) or {}
+            raise exceptions.AlreadyRunning(self.task_id,
+                                            holder.get('pid', None))
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps({'pid': os.getpid(), 'start': time.time()}))
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
+
+
+def concurrency_group(task_data):
+    """Concurrency group of the task, its type by default
+
+    :param task_data: dict
+    :rtype: str
+    """
+    return task_data.get('concurrency_group', None) or \
+        common.task_type(task_data)
+
+
+def semaphore(config, task_data):
+    """Semaphore limiting the concurrency group of the task
+
+    :param config: Config
+    :param task_data: dict
+    :rtype: Semaphore
+    :return: the semaphore or None if the group is not limited
+    """
+    group = concurrency_group(task_data)
+    limits = config['concurrency_limits'] or {}
+    limit = limits.get(group, limits.get('default', None))
+    if not group or not limit:
+        return None
+    return Semaphore(config, group, int(limit))
+
+
+class Semaphore(object):
+    """Operation of the engines waiting for a slot of the group
+
+    The slot is held until 'release' or the exit of the process.
+    """
+
+    def __init__(self, config, group, limit):
+        self.group = group
+        self.limit = limit
+        self.directory = os.path.join(config['pid_dir'], SLOTS_DIRECTORY)
+        self.fd = None
+        self.deadline = None
+
+    def slot_file(self, slot):
+        name = '%s.%d' % (self.group.replace(os.sep, '_'), slot)
+        return os.path.join(self.directory, name)
+
+    def try_acquire(self):
+        """Take any free slot of the group
+
+        :rtype: bool
+        """
+        for slot in range(self.limit):
+            fd = open_lock(self.slot_file(slot))
+            try:
+                if try_lock(fd):
+                    self.fd = fd
+                    return True
+            except IOError:
+                os.close(fd)
+                raise
+            os.close(fd)
+        return False
+
+    def start(self):
+        self.deadline = common.monotonic()
+
+    def poll(self):
+        if self.fd is not None or self.try_acquire():
+            return True
+        self.deadline = common.monotonic() + SLOT_POLL_INTERVAL
+        return False
+
+    def wait(self):
+        while not self.try_acquire():
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def release(self):
+        if self.fd is None:
+            return
+        os.close(self.fd)
+        self.fd = None
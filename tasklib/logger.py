@@ -18,6 +18,8 @@ import sys
 
 def setup_logging(config, module):
     log = logging.getLogger(module)
+    if log.handlers:
+        return log
     if config['debug']:
         log.setLevel(logging.DEBUG)
     formatter = logging.Formatter(
@@ -38,3 +40,13 @@ def setup_logging(config, module):
         file_handler.setFormatter(formatter)
         log.addHandler(file_handler)
     return log
+
+
+def file_descriptors(log):
+    """Descriptors of the log files to keep open by daemons
+
+    :param log: logging.Logger
+    :rtype: list
+    """
+    return [handler.stream.fileno() for handler in log.handlers
+            if isinstance(handler, logging.FileHandler)]
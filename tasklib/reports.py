@@ -0,0 +1,195 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Compressed storage and paged reading of task reports.
+
+* Reports are written through a streaming compressor selected by
+  'report_compression': 'gzip' (default), 'zstd' if the zstandard module is
+  installed (gzip otherwise) or 'none'.
+* The compression is recognized by the magic bytes of the data, so
+  reports saved uncompressed are still read.
+* A page is selected by the byte offset and length in the uncompressed
+  report and then by the number of its first or last lines.
+* Plain report files are paged through mmap. Compressed reports are
+  decompressed as a stream keeping only the requested page in memory.
+"""
+
+import collections
+import gzip
+import itertools
+import mmap
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 65536
+GZIP_MAGIC = '\x1f\x8b'
+ZSTD_MAGIC = '\x28\xb5\x2f\xfd'
+
+
+def compression(config):
+    """Compression used for new reports
+
+    :param config: Config
+    :rtype: str
+    :return: 'gzip', 'zstd' or None
+    """
+    name = config['report_compression']
+    if name in (None, False, 'none'):
+        return None
+    if name == 'zstd' and zstandard is not None:
+        return 'zstd'
+    return 'gzip'
+
+
+def chunks(data):
+    for start in xrange(0, len(data), CHUNK_SIZE):
+        yield data[start:start + CHUNK_SIZE]
+
+
+def write(stream, data, name):
+    """Write the report to the file through the compressor
+
+    :param stream: file opened for writing
+    :param data: str
+    :param name: compression name or None
+    """
+    if name == 'zstd':
+        writer = zstandard.ZstdCompressor().stream_writer(stream)
+    elif name == 'gzip':
+        writer = gzip.GzipFile(filename='', mode='wb', compresslevel=6,
+                               fileobj=stream)
+    else:
+        writer = None
+    for chunk in chunks(data):
+        (writer or stream).write(chunk)
+    if writer is not None:
+        writer.close()
+
+
+def reader(stream):
+    """Decompressing reader of the report
+
+    :param stream: file opened for reading at the start of the report
+    :return: file-like object of the uncompressed report
+    """
+    magic = stream.read(4)
+    stream.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise IOError('zstandard module is required to read the report')
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+def compressed(stream):
+    magic = stream.read(4)
+    stream.seek(0)
+    return magic.startswith(GZIP_MAGIC) or magic.startswith(ZSTD_MAGIC)
+
+
+def read(stream, head=None, tail=None, offset=None, length=None):
+    """Read a page of the report
+
+    :param stream: file opened for reading at the start of the report
+    :param head: number of the first lines
+    :param tail: number of the last lines
+    :param offset: offset of the page in bytes
+    :param length: maximum size of the page in bytes
+    :rtype: str
+    """
+    if not compressed(stream):
+        try:
+            fileno = stream.fileno()
+        except (AttributeError, IOError):
+            fileno = None
+        if fileno is not None:
+            return read_mapped(fileno, head, tail, offset, length)
+    decompressed = reader(stream)
+    if offset:
+        skip(decompressed, offset)
+    lines = split_lines(read_chunks(decompressed, length))
+    if head is not None:
+        lines = itertools.islice(lines, head)
+    if tail is not None:
+        lines = collections.deque(lines, tail)
+    return ''.join(lines)
+
+
+def read_mapped(fileno, head=None, tail=None, offset=None, length=None):
+    """Read a page of the plain report file through mmap"""
+    size = os.fstat(fileno).st_size
+    start = min(offset or 0, size)
+    end = size if length is None else min(start + length, size)
+    if start >= end:
+        return ''
+    data = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    try:
+        if head is not None:
+            position = start
+            for _ in xrange(head):
+                position = data.find('\n', position, end)
+                if position < 0:
+                    break
+                position += 1
+            else:
+                end = position
+        if tail is not None:
+            # the last line doesn't have to end by a newline
+            position = end - 1
+            for _ in xrange(tail):
+                position = data.rfind('\n', start, position)
+                if position < 0:
+                    break
+            else:
+                start = position + 1
+        return data[start:end]
+    finally:
+        data.close()
+
+
+def skip(stream, size):
+    while size > 0:
+        chunk = stream.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            return
+        size -= len(chunk)
+
+
+def read_chunks(stream, length=None):
+    while length is None or length > 0:
+        size = CHUNK_SIZE if length is None else min(length, CHUNK_SIZE)
+        chunk = stream.read(size)
+        if not chunk:
+            return
+        if length is not None:
+            length -= len(chunk)
+        yield chunk
+
+
+def split_lines(chunks_iterator):
+    """Split the stream of chunks to lines keeping the newlines"""
+    rest = ''
+    for chunk in chunks_iterator:
+        lines = (rest + chunk).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if rest:
+        yield rest
@@ -0,0 +1,273 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Resource limits of the commands of a task.
+
+* A task MAY have 'resources' with 'cpu_weight' and 'io_weight' (1-10000,
+  100 is the default of the kernel), 'memory_max' (bytes or a number with
+  a K, M, G or T suffix, 'max' is no limit), 'nice' (-20-19) and 'ionice'
+  (a best-effort level 0-7 or 'idle').
+* The values are checked when the task is loaded, an invalid one raises
+  exceptions.NotValidResources.
+* If the cgroup v2 tree at 'cgroup_root' can be created and written every
+  task gets its own cgroup there with cpu.weight, memory.max and io.weight,
+  and its commands are moved into it.
+* Otherwise the memory limit is set by RLIMIT_AS and the CPU weight is
+  turned into a nice level. The IO weight has no fallback.
+* 'nice' and 'ionice' are applied to the commands in both cases.
+* Limits are applied by the forked child before the command is executed,
+  tasklib itself is never limited. Failures to apply them are ignored, the
+  command is run anyway.
+"""
+
+import math
+import multiprocessing
+import os
+import platform
+import resource
+
+from tasklib import common
+from tasklib import exceptions
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+CONTROLLERS = ('cpu', 'memory', 'io')
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_SET = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+}
+
+
+def cpu_count():
+    """Number of CPUs this process is allowed to run on
+
+    :rtype: int
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return count_cpus(line.split(':', 1)[1])
+    except (IOError, ValueError):
+        pass
+    return multiprocessing.cpu_count()
+
+
+def count_cpus(cpu_list):
+    """Count the CPUs of the list like '0-3,6'
+
+    :rtype: int
+    """
+    count = 0
+    for item in cpu_list.strip().split(','):
+        first, _, last = item.partition('-')
+        count += int(last or first) - int(first) + 1
+    return count
+
+
+def parse_size(value):
+    """Size in bytes
+
+    :param value: int or str with a size suffix
+    :rtype: int
+    :raises: ValueError if it's not a size
+    """
+    if value is None or isinstance(value, (int, long)):
+        return value
+    value = str(value).strip().upper()
+    if value.endswith('B'):
+        value = value[:-1]
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def weight_to_nice(weight):
+    """Nice level giving about the same share of CPU as the weight
+
+    Every nice level changes the share by about 1.25 times and the
+    weight 100 is the nice level 0.
+    :rtype: int
+    """
+    nice = int(round(-math.log(weight / 100.0, 1.25)))
+    return max(-20, min(19, nice))
+
+
+def write(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+
+class Limits(object):
+    def __init__(self, config, task_id, resources, log=None):
+        self.config = config
+        self.task_id = task_id
+        self.log = log
+        self.cpu_weight = self.number(resources, 'cpu_weight', 1, 10000)
+        self.io_weight = self.number(resources, 'io_weight', 1, 10000)
+        self.memory_max = self.size(resources, 'memory_max')
+        self.nice = self.number(resources, 'nice', -20, 19)
+        self.ionice = resources.get('ionice', None)
+        if self.ionice != 'idle':
+            self.ionice = self.number(resources, 'ionice', 0, 7)
+        self.cgroup = None
+        self.prepared = False
+
+    def number(self, resources, name, low, high):
+        """Integer value of the resource checked to be in the range
+
+        :rtype: int
+        :raises: exceptions.NotValidResources
+        """
+        value = resources.get(name, None)
+        if value is None:
+            return None
+        if isinstance(value, bool) or not isinstance(value, (int, long)) \
+                or not low <= value <= high:
+            raise exceptions.NotValidResources(self.task_id, name, value)
+        return value
+
+    def size(self, resources, name):
+        """Size in bytes, None for no limit
+
+        :rtype: int
+        :raises: exceptions.NotValidResources
+        """
+        value = resources.get(name, None)
+        if value is None or str(value).strip().lower() == 'max':
+            return None
+        try:
+            size = parse_size(value)
+        except ValueError:
+            size = None
+        if isinstance(value, bool) or not size or size < 0:
+            raise exceptions.NotValidResources(self.task_id, name, value)
+        return size
+
+    @classmethod
+    def for_task(cls, task):
+        """Limits of the task or None if it has no resources
+
+        :param task: Task
+        :rtype: Limits
+        """
+        resources = task.data.get('resources', None)
+        if not resources:
+            return None
+        if not isinstance(resources, dict):
+            raise exceptions.NotValidResources(task.id, 'resources',
+                                               resources)
+        return cls(task.config, task.id, resources, task.log)
+
+    def prepare(self):
+        """Create the cgroup of the task if the cgroup tree is writable
+
+        It's done once by the parent process before the commands are run.
+        :rtype: str
+        :return: path to the cgroup or None
+        """
+        if self.prepared:
+            return self.cgroup
+        self.prepared = True
+        root = self.config['cgroup_root']
+        if not root or not os.path.isfile(os.path.join(
+                os.path.dirname(root), 'cgroup.controllers')):
+            return None
+        try:
+            common.ensure_dir_created(root)
+            self.enable_controllers(os.path.dirname(root))
+            self.enable_controllers(root)
+            cgroup = os.path.join(root, self.task_id)
+            common.ensure_dir_created(cgroup)
+            for name, value in (('cpu.weight', self.cpu_weight),
+                                ('io.weight', self.io_weight and
+                                 'default %d' % self.io_weight),
+                                ('memory.max', self.memory_max)):
+                if value is not None:
+                    write(os.path.join(cgroup, name), value)
+        except (IOError, OSError) as e:
+            if self.log:
+                self.log.debug("Task: '%s' cgroup is not used: %s",
+                               self.task_id, e)
+            return None
+        self.cgroup = cgroup
+        return self.cgroup
+
+    @staticmethod
+    def enable_controllers(cgroup):
+        """Enable the controllers for the children of the cgroup"""
+        with open(os.path.join(cgroup, 'cgroup.controllers'), 'r') as f:
+            available = f.read().split()
+        for controller in CONTROLLERS:
+            if controller not in available:
+                continue
+            try:
+                write(os.path.join(cgroup, 'cgroup.subtree_control'),
+                      '+' + controller)
+            except IOError:
+                pass
+
+    def preexec(self):
+        """Function applying the limits in the forked child
+
+        :rtype: callable
+        """
+        self.prepare()
+        return self.apply
+
+    def apply(self):
+        cgroup = self.cgroup
+        if cgroup:
+            try:
+                write(os.path.join(cgroup, 'cgroup.procs'), 0)
+            except IOError:
+                cgroup = None
+        nice = self.nice
+        if not cgroup:
+            if self.memory_max:
+                try:
+                    resource.setrlimit(resource.RLIMIT_AS,
+                                       (self.memory_max, self.memory_max))
+                except (ValueError, resource.error):
+                    pass
+            if nice is None and self.cpu_weight:
+                nice = weight_to_nice(self.cpu_weight)
+        if nice:
+            try:
+                os.nice(nice)
+            except OSError:
+                pass
+        if self.ionice is not None:
+            self.set_ionice()
+
+    def set_ionice(self):
+        number = IOPRIO_SET.get(platform.machine(), None)
+        if common.libc is None or number is None:
+            return
+        if self.ionice == 'idle':
+            ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+        else:
+            level = max(0, min(7, int(self.ionice)))
+            ioprio = (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | level
+        common.libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio)
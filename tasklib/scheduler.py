@@ -0,0 +1,317 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Scheduler runs the tasks of a dependency graph.
+
+* Every task is run by a separate worker process using its Agent, so
+  status and report files are maintained the same way as for a single run.
+* A task is started as soon as all tasks it requires have succeeded and
+  there is a free worker.
+* Ready tasks with the longest remaining path to the end of the graph are
+  started first. The path lengths are estimated from the run history.
+* The number of workers running at the same time is limited.
+* If a task fails all tasks depending on it are not started and get
+  the 'skipped' status.
+* With 'puppet_batch' enabled chains of puppet tasks are run together by
+  a single puppet apply, see 'batch'.
+* With the 'async' engine the tasks are run in the scheduler process by
+  engine.AsyncEngine instead of worker processes. The number of commands
+  running at the same time is limited by the number of workers.
+"""
+
+import errno
+import os
+import sys
+
+from tasklib import agent
+from tasklib import batch
+from tasklib import common
+from tasklib import engine
+from tasklib import history
+from tasklib import logger
+from tasklib import resources
+from tasklib import state
+
+
+class Scheduler(object):
+    def __init__(self, config, graph, workers=None):
+        self.config = config
+        self.graph = graph
+        self.log = logger.setup_logging(self.config, 'TaskLib')
+        self.workers = workers or self.config['workers'] or \
+            resources.cpu_count()
+        self.statuses = {}
+        self.running = {}
+        self.waiting = {}
+        self.batches = {}
+        self.durations = {}
+        for task_id in self.graph.nodes:
+            self.durations[task_id] = history.estimate(
+                self.config, task_id, self.graph.library[task_id])
+        self.priorities = self.graph.remaining_paths(self.durations)
+
+    def ready(self):
+        """Tasks which have all their requirements succeeded
+
+        :rtype: list
+        :return: Task ids, the longest remaining path first
+        """
+        ready = [task_id for task_id, count in self.waiting.iteritems()
+                 if count == 0]
+        return sorted(ready, key=lambda t: (-self.priorities[t], t))
+
+    def start(self, task_id):
+        """Start the task or the batch in a new worker process
+
+        :param task_id: str
+        """
+        for batch_task_id in self.batches.get(task_id, [task_id]):
+            del self.waiting[batch_task_id]
+        sys.stdout.flush()
+        sys.stderr.flush()
+        state.close()
+        pid = os.fork()
+        if pid == 0:
+            code = common.STATUS.error.code
+            try:
+                code = self.run_task(task_id)
+            except Exception as e:
+                self.log.exception(str(e))
+            finally:
+                os._exit(code)
+        self.log.debug("Task: '%s' worker started with pid: '%d'",
+                       task_id, pid)
+        self.running[pid] = task_id
+
+    def run_task(self, task_id):
+        """Run the task inside the worker process
+
+        :param task_id: str
+        :rtype: int
+        :return: task status code
+        """
+        if task_id in self.batches:
+            batch.Batch(self.config, self.batches[task_id],
+                        self.graph.library).run()
+            return common.STATUS.success.code
+        task_agent = agent.Agent(task_id, self.config,
+                                 self.graph.library[task_id])
+        return task_agent.run()
+
+    def finish(self, pid, exit_status):
+        """Process the finished worker and unlock the tasks waiting for it
+
+        :param pid: int
+        :param exit_status: int
+        """
+        task_id = self.running.pop(pid)
+        if os.WIFEXITED(exit_status):
+            code = os.WEXITSTATUS(exit_status)
+        else:
+            code = common.STATUS.error.code
+        if task_id in self.batches:
+            self.complete_batch(task_id, code)
+        else:
+            self.complete(task_id, code)
+
+    def complete_batch(self, task_id, code):
+        """Complete every task of the batch by its saved status
+
+        Tasks which have not got a final status because the batch
+        has crashed get the code of the batch.
+        :param task_id: first task of the batch
+        :param code: batch status code
+        """
+        final = (common.STATUS.success.name, common.STATUS.fail_task.name,
+                 common.STATUS.timeout.name, common.STATUS.skipped.name)
+        for batch_task_id in self.batches[task_id]:
+            task_agent = agent.Agent(batch_task_id, self.config,
+                                     self.graph.library[batch_task_id])
+            status = task_agent.status()
+            if status in final:
+                self.complete(batch_task_id, task_agent.code())
+            else:
+                self.complete(batch_task_id, code)
+
+    def complete(self, task_id, code):
+        """Record the task status and unlock the tasks waiting for it
+
+        :param task_id: str
+        :param code: task status code
+        """
+        self.statuses[task_id] = common.status_name(code)
+        self.log.debug("Task: '%s' worker finished with status: '%s'",
+                       task_id, self.statuses[task_id])
+        if code == common.STATUS.success.code:
+            for next_task_id in self.graph.required_for[task_id]:
+                if next_task_id in self.waiting:
+                    self.waiting[next_task_id] -= 1
+        else:
+            for next_task_id in self.graph.descendants(task_id):
+                if next_task_id in self.waiting:
+                    self.skip(next_task_id)
+
+    def skip(self, task_id):
+        del self.waiting[task_id]
+        self.statuses[task_id] = common.STATUS.skipped.name
+        task_agent = agent.Agent(task_id, self.config,
+                                 self.graph.library[task_id])
+        task_agent.task.reset()
+        task_agent.task.save_status(common.STATUS.skipped.name)
+        self.log.warning("Task: '%s' skipped because its requirements "
+                         "have failed", task_id)
+
+    def spawn(self, async_engine, task_id):
+        """Start the task in the async engine
+
+        :param async_engine: engine.AsyncEngine
+        :param task_id: str
+        """
+        if task_id in self.batches:
+            self.spawn_batch(async_engine, task_id)
+            return
+        del self.waiting[task_id]
+        task_agent = agent.Agent(task_id, self.config,
+                                 self.graph.library[task_id])
+        self.running[task_id] = task_agent
+
+        def callback(error):
+            del self.running[task_id]
+            if error:
+                self.log.error("Task: '%s' failed with exception",
+                               task_id, exc_info=error)
+                code = common.STATUS.error.code
+            else:
+                code = task_agent.code()
+            self.complete(task_id, code)
+            self.spawn_ready(async_engine)
+
+        async_engine.spawn(task_agent.steps(), callback)
+
+    def spawn_batch(self, async_engine, task_id):
+        for batch_task_id in self.batches[task_id]:
+            del self.waiting[batch_task_id]
+        task_batch = batch.Batch(self.config, self.batches[task_id],
+                                 self.graph.library)
+        self.running[task_id] = task_batch
+
+        def callback(error):
+            del self.running[task_id]
+            code = common.STATUS.success.code
+            if error:
+                self.log.error("Batch: '%s' failed with exception",
+                               task_id, exc_info=error)
+                code = common.STATUS.error.code
+            self.complete_batch(task_id, code)
+            self.spawn_ready(async_engine)
+
+        async_engine.spawn(task_batch.steps(), callback)
+
+    def spawn_ready(self, async_engine):
+        for task_id in self.ready():
+            if task_id in self.waiting:
+                self.spawn(async_engine, task_id)
+
+    def run_async(self):
+        """Run the tasks in this process with the async engine
+
+        All ready tasks are started at once, the engine limits the number
+        of commands running at the same time to the number of workers.
+        """
+        async_engine = engine.AsyncEngine(self.workers)
+        self.spawn_ready(async_engine)
+        async_engine.run()
+
+    def run_forked(self):
+        """Run every task in its own worker process"""
+        while self.waiting or self.running:
+            for task_id in self.ready():
+                if len(self.running) >= self.workers:
+                    break
+                self.start(task_id)
+            if not self.running:
+                break
+            try:
+                pid, exit_status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid in self.running:
+                self.finish(pid, exit_status)
+
+    def run(self):
+        """Run all tasks of the graph
+
+        :rtype: dict
+        :return: Dictionary of task statuses
+        """
+        self.graph.verify()
+        self.statuses = {}
+        self.running = {}
+        self.waiting = dict((task_id, len(self.graph.requires[task_id]))
+                            for task_id in self.graph.nodes)
+        self.batches = {}
+        if self.config['puppet_batch']:
+            self.batches = batch.find_batches(self.graph)
+            for task_ids in self.batches.itervalues():
+                self.log.debug("Batch of puppet tasks: '%s'",
+                               ', '.join(task_ids))
+        self.log.debug("Graph run start: '%d' tasks with '%d' workers "
+                       "using '%s' engine", len(self.graph), self.workers,
+                       self.config['engine'])
+        if self.config['engine'] == 'async':
+            self.run_async()
+        else:
+            self.run_forked()
+        self.log.debug("Graph run end")
+        return self.statuses
+
+    def plan(self):
+        """Simulate the run using the estimated task durations
+
+        :rtype: list
+        :return: List of (task_id, start, end) in the start order
+        """
+        self.graph.verify()
+        waiting = dict((task_id, len(self.graph.requires[task_id]))
+                       for task_id in self.graph.nodes)
+        running = []
+        order = []
+        now = 0.0
+        while waiting or running:
+            ready = [task_id for task_id, count in waiting.iteritems()
+                     if count == 0]
+            ready.sort(key=lambda t: (-self.priorities[t], t))
+            for task_id in ready[:self.workers - len(running)]:
+                del waiting[task_id]
+                end = now + self.durations[task_id]
+                running.append((end, task_id))
+                order.append((task_id, now, end))
+            running.sort()
+            now, task_id = running.pop(0)
+            for next_task_id in self.graph.required_for[task_id]:
+                waiting[next_task_id] -= 1
+        return order
+
+    def code(self):
+        """Code of the first not successful task in the graph order
+
+        :rtype: int
+        """
+        for task_id in self.graph.topology():
+            status = self.statuses.get(task_id, common.STATUS.error.name)
+            if status != common.STATUS.success.name:
+                return getattr(common.STATUS, status).code
+        return common.STATUS.success.code
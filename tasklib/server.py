@@ -0,0 +1,270 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Resident agent server answering the CLI over a Unix socket.
+
+* 'taskcmd serve' keeps the configuration, the task library, the logger
+  and the state backend in memory and listens on the socket the client
+  connects to: 'TASKLIB_SOCKET' in the environment or the default one.
+* A request is a JSON line with the command line arguments and the working
+  directory of the client. The answer is a JSON line with the exit code
+  and the output of the action. Output that is not UTF-8, like the output
+  of commands in reports, is decoded with replacement characters.
+* A request failing in the server is answered with the error, so the
+  client can show it.
+* Only the actions of client.SERVED_ACTIONS with the configuration file of
+  the server are served. Other requests are refused and the client runs
+  them by itself.
+* Queries are answered by the server process. 'run' and 'daemon' are
+  forked so a long task doesn't block other requests.
+* The task files are checked for changes at most every 'server_refresh'
+  seconds.
+"""
+
+import errno
+import json
+import os
+import signal
+import socket
+import StringIO
+import sys
+
+from tasklib import cache
+from tasklib import client
+from tasklib import common
+from tasklib import exceptions
+from tasklib import logger
+from tasklib import state
+
+FORKED_ACTIONS = ('run', 'daemon')
+REQUEST_TIMEOUT = 10
+
+
+def decode(output):
+    """Text of the captured output for the JSON answer
+
+    :param output: str
+    :rtype: unicode
+    """
+    if isinstance(output, unicode):
+        return output
+    return output.decode('utf-8', 'replace')
+
+
+def error_response(error):
+    """Answer to a request that failed in the server
+
+    :param error: exception
+    :rtype: dict
+    """
+    return {
+        'served': True,
+        'code': common.STATUS.error.code,
+        'stdout': '',
+        'stderr': decode('Server error: %s\n' % error),
+    }
+
+
+class Output(StringIO.StringIO):
+    """Captured output keeping only byte strings
+
+    Mixed unicode and non-ASCII byte strings can't be joined.
+    """
+
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        StringIO.StringIO.write(self, s)
+
+
+class Server(object):
+    def __init__(self, api, config_file=None):
+        """
+        :param api: cli.CmdApi with the loaded configuration
+        :param config_file: configuration file of the server
+        """
+        self.api = api
+        self.config = api.config
+        self.config_file = config_file and os.path.abspath(config_file)
+        self.log = logger.setup_logging(self.config, 'TaskLib')
+        self.path = client.socket_path()
+        self.listener = None
+        self.refreshed = None
+        self.pid = os.getpid()
+
+    def refresh(self):
+        """Reload the task library if it's older than 'server_refresh'"""
+        now = common.monotonic()
+        if self.refreshed is not None and \
+                now - self.refreshed < self.config['server_refresh']:
+            return
+        errors = []
+        self.api.library = cache.task_library(self.config, errors=errors)
+        self.api.library_errors = errors
+        self.refreshed = now
+
+    def listen(self):
+        common.ensure_dir_created(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                raise exceptions.AlreadyRunning('server', self.path)
+            finally:
+                probe.close()
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.listener.listen(128)
+
+    @staticmethod
+    def reap(*args):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except OSError:
+            pass
+
+    def run(self):
+        """Serve the requests until SIGTERM or SIGINT"""
+        self.listen()
+        signal.signal(signal.SIGCHLD, self.reap)
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        self.log.info("Server listening on: '%s'", self.path)
+        try:
+            while True:
+                try:
+                    connection = self.listener.accept()[0]
+                except socket.error as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    self.handle(connection)
+                except Exception as e:
+                    self.log.exception("Server request failed: %s", e)
+                    # the client reads only the first answer
+                    self.answer(connection, error_response(e))
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # forked children leave by SystemExit too
+            if os.getpid() == self.pid:
+                self.listener.close()
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                self.log.info("Server stopped: '%s'", self.path)
+
+    def handle(self, connection):
+        connection.settimeout(REQUEST_TIMEOUT)
+        request = json.loads(connection.makefile('rb').readline() or 'null')
+        if not isinstance(request, dict):
+            return
+        argv = [str(argument) for argument in request.get('argv', [])]
+        os.chdir(request.get('cwd', None) or '/')
+        action = client.action(argv)
+        try:
+            parsed = self.api.parser.parse_args(argv)
+        except SystemExit:
+            parsed = None
+        if parsed is None or not self.accepts(parsed, action):
+            self.answer(connection, {'served': False})
+            return
+        self.refresh()
+        if action not in FORKED_ACTIONS:
+            self.answer(connection, self.execute(parsed))
+            return
+        if action == 'daemon':
+            # daemonize exits the parent, so the answer is sent before
+            response = self.execute(parsed, self.api.daemon_check)
+            self.answer(connection, response)
+            if response['code']:
+                return
+        state.close()
+        if os.fork():
+            return
+        # the child exits by SystemExit, so the daemon removes its pid file
+        self.listener.close()
+        # the child is killed by the signals as the standalone CLI is
+        for signum in (signal.SIGCHLD, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        try:
+            if action == 'daemon':
+                self.execute(parsed)
+            else:
+                self.answer(connection, self.execute(parsed))
+        finally:
+            sys.exit(0)
+
+    def accepts(self, parsed, action):
+        """Check if the request can be served by this server
+
+        :param parsed: parsed arguments
+        :param action: action of the request
+        :rtype: bool
+        """
+        if action not in client.SERVED_ACTIONS:
+            return False
+        config_file = parsed.config and os.path.abspath(parsed.config)
+        return config_file == self.config_file
+
+    def execute(self, parsed, func=None):
+        """Run the action capturing its output
+
+        Options of the request are applied to the configuration only for
+        the time of the request.
+        :param parsed: parsed arguments
+        :param func: function to call instead of the action
+        :rtype: dict
+        """
+        options = dict((name, self.config[name])
+                       for name in self.api.OPTIONS)
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = Output(), Output()
+        try:
+            self.api.apply_options(parsed)
+            code = (func or parsed.func)(parsed)
+        except SystemExit as e:
+            code = e.code
+        except Exception as e:
+            self.log.exception("Server action failed: %s", e)
+            sys.stderr.write('%s\n' % e)
+            code = common.STATUS.error.code
+        finally:
+            output = sys.stdout.getvalue(), sys.stderr.getvalue()
+            sys.stdout, sys.stderr = stdout, stderr
+            for name, value in options.iteritems():
+                self.config[name] = value
+        return {
+            'served': True,
+            'code': code or 0,
+            'stdout': decode(output[0]),
+            'stderr': decode(output[1]),
+        }
+
+    @staticmethod
+    def answer(connection, response):
+        try:
+            data = json.dumps(response)
+        except (TypeError, ValueError) as e:
+            data = json.dumps(error_response(e))
+        try:
+            connection.sendall(data + '\n')
+        except socket.error:
+            pass
@@ -0,0 +1,447 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+State backends keep statuses, reports, pids, the run history and the
+timing of the last run of tasks.
+
+* The 'file' backend is the default. A status is kept in
+  <status_dir>/<task>.status, a report in <report_dir>/<task>.<action>,
+  a pid in <pid_dir>/<task>.pid, the history in <status_dir>/<task>.history
+  and the timing as JSON in <status_dir>/<task>.timing. Files are replaced
+  atomically.
+* The 'sqlite' backend keeps everything in a single SQLite database in the
+  WAL mode ('state_db', <status_dir>/state.db by default). Every change
+  is a transaction and statuses are indexed so the state of all tasks is
+  read by a single query.
+* Pid files are written by the daemon in both backends because they are
+  used for locking. The sqlite backend records the pids too.
+* Reports are compressed as set by 'report_compression' in both backends
+  and can be read by pages (see the reports module).
+* Output files and artifacts of the actions are always files.
+* A backend is created once per process. SQLite connections can't be
+  shared with forked processes, so they are closed by 'close' before
+  forking and the workers open their own ones.
+"""
+
+import json
+import os
+import sqlite3
+import StringIO
+import time
+
+from tasklib import common
+from tasklib import reports as report_store
+
+
+class FileState(object):
+    def __init__(self, config):
+        self.config = config
+
+    def status_file(self, task_id):
+        return os.path.join(self.config['status_dir'], task_id + '.status')
+
+    def report_file(self, task_id, action):
+        return os.path.join(self.config['report_dir'], task_id + '.' + action)
+
+    def pid_file(self, task_id):
+        return os.path.join(self.config['pid_dir'], task_id + '.pid')
+
+    def history_file(self, task_id):
+        return os.path.join(self.config['status_dir'], task_id + '.history')
+
+    def timing_file(self, task_id):
+        return os.path.join(self.config['status_dir'], task_id + '.timing')
+
+    @staticmethod
+    def read(path):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return f.read()
+
+    @staticmethod
+    def write(path, data):
+        if data is None:
+            if os.path.exists(path):
+                os.unlink(path)
+            return
+        temp_file = '%s.%d' % (path, os.getpid())
+        with open(temp_file, 'w') as f:
+            f.write(data)
+        os.rename(temp_file, path)
+
+    def status(self, task_id):
+        return self.read(self.status_file(task_id))
+
+    def set_status(self, task_id, status):
+        self.write(self.status_file(task_id), status)
+
+    def statuses(self, status=None):
+        """Statuses of all tasks
+
+        :param status: return only the tasks with this status
+        :rtype: dict
+        """
+        statuses = {}
+        directory = self.config['status_dir']
+        if not os.path.isdir(directory):
+            return statuses
+        for file_name in os.listdir(directory):
+            if not file_name.endswith('.status'):
+                continue
+            task_id = file_name[:-len('.status')]
+            task_status = self.status(task_id)
+            if task_status is None:
+                continue
+            if status is None or task_status == status:
+                statuses[task_id] = task_status
+        return statuses
+
+    def summary(self):
+        """Statuses and last runs of all tasks by a single directory scan
+
+        :rtype: dict
+        :return: Dictionary of task ids and tuples of the status and
+                 the last history record or None
+        """
+        summary = {}
+        directory = self.config['status_dir']
+        if not os.path.isdir(directory):
+            return summary
+        file_names = set(os.listdir(directory))
+        for file_name in file_names:
+            if not file_name.endswith('.status'):
+                continue
+            task_id = file_name[:-len('.status')]
+            task_status = self.status(task_id)
+            if task_status is None:
+                continue
+            last_run = None
+            if task_id + '.history' in file_names:
+                records = self.history(task_id)
+                if records:
+                    last_run = records[-1]
+            summary[task_id] = (task_status, last_run)
+        return summary
+
+    def report(self, task_id, action, **page):
+        """Read the report or its page without loading the whole file
+
+        :param page: head, tail, offset and length of reports.read
+        :rtype: str
+        :return: the report or None if there is no report
+        """
+        try:
+            with open(self.report_file(task_id, action), 'rb') as f:
+                return report_store.read(f, **page)
+        except IOError:
+            return None
+
+    def reports(self, task_ids, **page):
+        """Reports of the tasks
+
+        :param task_ids: list of task ids
+        :param page: head, tail, offset and length of reports.read
+        :rtype: dict
+        :return: Dictionary of task ids and dictionaries of their reports
+        """
+        reports = {}
+        for task_id in task_ids:
+            for action in ('pre', 'task', 'post'):
+                report = self.report(task_id, action, **page)
+                if report is not None:
+                    reports.setdefault(task_id, {})[action] = report
+        return reports
+
+    def set_report(self, task_id, action, report):
+        path = self.report_file(task_id, action)
+        if report is None:
+            self.write(path, None)
+            return
+        temp_file = '%s.%d' % (path, os.getpid())
+        with open(temp_file, 'wb') as f:
+            report_store.write(f, report,
+                               report_store.compression(self.config))
+        os.rename(temp_file, path)
+
+    def pid(self, task_id):
+        return self.read(self.pid_file(task_id))
+
+    def set_pid(self, task_id, pid):
+        """Pid files are maintained by the daemon"""
+
+    def close(self):
+        pass
+
+    def history(self, task_id):
+        try:
+            with open(self.history_file(task_id), 'r') as f:
+                records = json.load(f)
+        except (IOError, ValueError):
+            return []
+        if not isinstance(records, list):
+            return []
+        return records
+
+    def add_history(self, task_id, record):
+        records = self.history(task_id)
+        records.append(record)
+        records = records[-self.config['history_size']:]
+        self.write(self.history_file(task_id), json.dumps(records))
+
+    def timing(self, task_id):
+        try:
+            with open(self.timing_file(task_id), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def set_timing(self, task_id, timing):
+        self.write(self.timing_file(task_id),
+                   None if timing is None else json.dumps(timing))
+
+
+class SqliteState(object):
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS status ('
+        ' task_id TEXT PRIMARY KEY, status TEXT NOT NULL,'
+        ' updated REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS status_status ON status (status)',
+        'CREATE TABLE IF NOT EXISTS report ('
+        ' task_id TEXT NOT NULL, action TEXT NOT NULL, report TEXT,'
+        ' PRIMARY KEY (task_id, action))',
+        'CREATE TABLE IF NOT EXISTS pid ('
+        ' task_id TEXT PRIMARY KEY, pid INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS history ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT, task_id TEXT NOT NULL,'
+        ' time REAL NOT NULL, status TEXT, durations TEXT)',
+        'CREATE INDEX IF NOT EXISTS history_task ON history (task_id, id)',
+        'CREATE TABLE IF NOT EXISTS timing ('
+        ' task_id TEXT PRIMARY KEY, timing TEXT NOT NULL)',
+    ]
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config['state_db'] or os.path.join(
+            config['status_dir'], 'state.db')
+        common.ensure_dir_created(os.path.dirname(self.path))
+        self.connection = sqlite3.connect(self.path, timeout=60,
+                                          isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.transaction() as cursor:
+            for statement in self.SCHEMA:
+                cursor.execute(statement)
+
+    def transaction(self):
+        return Transaction(self.connection)
+
+    def close(self):
+        self.connection.close()
+
+    def query(self, sql, *args):
+        return self.connection.execute(sql, args).fetchall()
+
+    def status(self, task_id):
+        rows = self.query('SELECT status FROM status WHERE task_id = ?',
+                          task_id)
+        if not rows:
+            return None
+        return str(rows[0][0])
+
+    def set_status(self, task_id, status):
+        with self.transaction() as cursor:
+            if status is None:
+                cursor.execute('DELETE FROM status WHERE task_id = ?',
+                               (task_id,))
+            else:
+                cursor.execute('INSERT OR REPLACE INTO status '
+                               '(task_id, status, updated) VALUES (?, ?, ?)',
+                               (task_id, status, time.time()))
+
+    def statuses(self, status=None):
+        if status is None:
+            rows = self.query('SELECT task_id, status FROM status')
+        else:
+            rows = self.query('SELECT task_id, status FROM status '
+                              'WHERE status = ?', status)
+        return dict((str(task_id), str(task_status))
+                    for task_id, task_status in rows)
+
+    def summary(self):
+        summary = dict((task_id, (task_status, None)) for task_id, task_status
+                       in self.statuses().iteritems())
+        rows = self.query('SELECT h.task_id, h.time, h.status, h.durations '
+                          'FROM history h JOIN (SELECT MAX(id) AS id '
+                          'FROM history GROUP BY task_id) l ON h.id = l.id')
+        for task_id, record_time, status, durations in rows:
+            task_id = str(task_id)
+            if task_id not in summary:
+                continue
+            summary[task_id] = (summary[task_id][0], {
+                'time': record_time,
+                'status': status and str(status),
+                'durations': json.loads(durations or '{}'),
+            })
+        return summary
+
+    @staticmethod
+    def read_report(report, **page):
+        """Read a page of the stored report
+
+        Reports are compressed blobs, the text ones are saved uncompressed.
+        """
+        if report is None:
+            return None
+        if isinstance(report, unicode):
+            report = report.encode('utf-8')
+        return report_store.read(StringIO.StringIO(str(report)), **page)
+
+    def reports(self, task_ids, **page):
+        task_ids = set(task_ids)
+        reports = {}
+        for task_id, action, report in self.query(
+                'SELECT task_id, action, report FROM report'):
+            task_id = str(task_id)
+            if task_id in task_ids and report is not None:
+                reports.setdefault(task_id, {})[str(action)] = \
+                    self.read_report(report, **page)
+        return reports
+
+    def report(self, task_id, action, **page):
+        rows = self.query('SELECT report FROM report '
+                          'WHERE task_id = ? AND action = ?',
+                          task_id, action)
+        if not rows:
+            return None
+        return self.read_report(rows[0][0], **page)
+
+    def set_report(self, task_id, action, report):
+        if report is not None:
+            data = StringIO.StringIO()
+            report_store.write(data, report,
+                               report_store.compression(self.config))
+            report = sqlite3.Binary(data.getvalue())
+        with self.transaction() as cursor:
+            if report is None:
+                cursor.execute('DELETE FROM report '
+                               'WHERE task_id = ? AND action = ?',
+                               (task_id, action))
+            else:
+                cursor.execute('INSERT OR REPLACE INTO report '
+                               '(task_id, action, report) VALUES (?, ?, ?)',
+                               (task_id, action, report))
+
+    def pid(self, task_id):
+        rows = self.query('SELECT pid FROM pid WHERE task_id = ?', task_id)
+        if not rows:
+            return None
+        return str(rows[0][0])
+
+    def set_pid(self, task_id, pid):
+        with self.transaction() as cursor:
+            if pid is None:
+                cursor.execute('DELETE FROM pid WHERE task_id = ?',
+                               (task_id,))
+            else:
+                cursor.execute('INSERT OR REPLACE INTO pid (task_id, pid) '
+                               'VALUES (?, ?)', (task_id, pid))
+
+    def history(self, task_id):
+        rows = self.query('SELECT time, status, durations FROM history '
+                          'WHERE task_id = ? ORDER BY id', task_id)
+        return [{
+            'time': record_time,
+            'status': status and str(status),
+            'durations': json.loads(durations or '{}'),
+        } for record_time, status, durations in rows]
+
+    def add_history(self, task_id, record):
+        with self.transaction() as cursor:
+            cursor.execute('INSERT INTO history '
+                           '(task_id, time, status, durations) '
+                           'VALUES (?, ?, ?, ?)',
+                           (task_id, record['time'], record['status'],
+                            json.dumps(record['durations'])))
+            cursor.execute('DELETE FROM history WHERE task_id = ? AND id NOT '
+                           'IN (SELECT id FROM history WHERE task_id = ? '
+                           'ORDER BY id DESC LIMIT ?)',
+                           (task_id, task_id, self.config['history_size']))
+
+    def timing(self, task_id):
+        rows = self.query('SELECT timing FROM timing WHERE task_id = ?',
+                          task_id)
+        if not rows:
+            return None
+        return json.loads(rows[0][0])
+
+    def set_timing(self, task_id, timing):
+        with self.transaction() as cursor:
+            if timing is None:
+                cursor.execute('DELETE FROM timing WHERE task_id = ?',
+                               (task_id,))
+            else:
+                cursor.execute('INSERT OR REPLACE INTO timing '
+                               '(task_id, timing) VALUES (?, ?)',
+                               (task_id, json.dumps(timing)))
+
+
+class Transaction(object):
+    """Immediate transaction of the autocommit connection"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        return cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+
+
+BACKENDS = {
+    'file': FileState,
+    'sqlite': SqliteState,
+}
+
+backends = {}
+
+
+def backend(config):
+    """State backend of the current process
+
+    :param config: Config
+    :rtype: FileState or SqliteState
+    """
+    name = config['state_backend']
+    key = (os.getpid(), name, id(config))
+    if key not in backends:
+        backend_class = BACKENDS.get(name, None)
+        if backend_class is None:
+            raise ValueError("Unknown state backend: '%s'" % name)
+        backends[key] = backend_class(config)
+    return backends[key]
+
+
+def close():
+    """Close the backends of the current process before forking"""
+    for key in backends.keys():
+        state = backends.pop(key)
+        if key[0] == os.getpid():
+            state.close()
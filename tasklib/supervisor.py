@@ -0,0 +1,298 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""
+Supervisor running many background tasks by a single daemon.
+
+* 'daemon' with several tasks or a role or group selector queues the tasks
+  and starts one detached supervisor instead of a daemon per task.
+* The job queue is a JSON file in the pid directory. A job stays in the
+  queue until its task has finished, so a restarted supervisor runs the
+  unfinished jobs again.
+* The jobs are run by a pool of 'supervisor_workers' forked worker
+  processes. The task library is loaded once by the supervisor.
+* A worker maintains the pid file and the status of its task as a task
+  daemon does, so 'status', 'report' and 'clear' of the task keep working.
+* Only one supervisor runs at a time, it holds the lock of its pid file.
+  New jobs are added to the queue of the running supervisor and it's woken
+  up by SIGHUP. The queue is locked while it's changed.
+* SIGHUP and SIGCHLD wake the supervisor through a wakeup pipe as in the
+  async engine, so a signal arriving before it starts waiting isn't lost.
+* The queued tasks are run in the queue order without their dependencies,
+  'run-graph' runs the tasks in the graph order.
+"""
+
+import errno
+import fcntl
+import json
+import os
+import signal
+
+import daemonize
+
+from tasklib import agent
+from tasklib import cache
+from tasklib import common
+from tasklib import engine
+from tasklib import logger
+from tasklib import resources
+from tasklib import state
+
+
+def selected(task_data, roles=None, groups=None):
+    """Check if the task matches any of the roles or groups
+
+    A task with the '*' role matches every role.
+    :param task_data: dict
+    :param roles: list of role names
+    :param groups: list of group names
+    :rtype: bool
+    """
+    for key, names in (('role', roles), ('groups', groups)):
+        if not names:
+            continue
+        values = task_data.get(key, None) or []
+        if not isinstance(values, list):
+            values = [values]
+        if '*' in values or set(values) & set(names):
+            return True
+    return False
+
+
+def select(library, roles=None, groups=None):
+    """Task ids of the library matching the roles or groups
+
+    :param library: Task library dictionary
+    :rtype: list
+    """
+    return sorted(task_id for task_id, task_data in library.iteritems()
+                  if isinstance(task_data, dict) and
+                  common.task_type(task_data) and
+                  selected(task_data, roles, groups))
+
+
+class JobQueue(object):
+    def __init__(self, config):
+        self.path = os.path.join(config['pid_dir'], 'supervisor.queue')
+        # a plain descriptor: the one inherited by the daemon is closed by
+        # daemonize and must not be closed again when it's replaced
+        self.lock_fd = None
+
+    def lock(self):
+        self.lock_fd = os.open(self.path + '.lock',
+                               os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+
+    def unlock(self):
+        os.close(self.lock_fd)
+        self.lock_fd = None
+
+    def jobs(self):
+        """Task ids of the queued jobs in their order
+
+        :rtype: list
+        """
+        try:
+            with open(self.path, 'r') as f:
+                jobs = json.load(f)
+        except (IOError, ValueError):
+            return []
+        if not isinstance(jobs, list):
+            return []
+        return [str(task_id) for task_id in jobs]
+
+    def save(self, jobs):
+        temp_file = '%s.%d' % (self.path, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(jobs, f)
+        os.rename(temp_file, self.path)
+
+    def add(self, task_ids):
+        jobs = self.jobs()
+        jobs.extend(task_id for task_id in task_ids if task_id not in jobs)
+        self.save(jobs)
+
+    def remove(self, task_id):
+        self.save([job for job in self.jobs() if job != task_id])
+
+
+class Supervisor(object):
+    def __init__(self, config, library=None, workers=None):
+        self.config = config
+        self.log = logger.setup_logging(self.config, 'TaskLib')
+        self.library = library
+        self.workers = workers or self.config['supervisor_workers'] or \
+            resources.cpu_count()
+        self.queue = JobQueue(config)
+        self.running = {}
+        self.saved_directory = None
+        self.wakeup = None
+        self.saved_signals = None
+
+    @property
+    def pid_file(self):
+        return os.path.join(self.config['pid_dir'], 'supervisor.pid')
+
+    def pid(self):
+        """Pid of the running supervisor
+
+        :rtype: int
+        :return: the pid, 0 if it's just starting or None if there is no
+                 running supervisor
+        """
+        try:
+            pid_file = open(self.pid_file, 'r')
+        except IOError:
+            return None
+        with pid_file:
+            try:
+                fcntl.flock(pid_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError:
+                return int(pid_file.read().strip() or 0)
+            return None
+
+    def submit(self, task_ids):
+        """Queue the tasks and wake up or start the supervisor
+
+        The new supervisor is started with the queue locked, it waits for
+        the queue until the calling process exits.
+        :param task_ids: list of task ids
+        :rtype: int
+        :return: pid of the running supervisor or None if it's started
+        """
+        common.ensure_dir_created(self.config['pid_dir'])
+        self.queue.lock()
+        try:
+            self.queue.add(task_ids)
+            pid = self.pid()
+            if pid is not None:
+                if pid:
+                    os.kill(pid, signal.SIGHUP)
+                return pid
+            self.log.debug("Supervisor start with pid file: '%s'",
+                           self.pid_file)
+            self.daemon().start()
+        finally:
+            if self.queue.lock_fd is not None:
+                self.queue.unlock()
+
+    def daemon(self):
+        state.close()
+        # daemonize changes the directory to '/', the paths of the
+        # configuration can be relative to the current one
+        self.saved_directory = os.getcwdu()
+        return daemonize.Daemonize(
+            app='tasklib-supervisor',
+            pid=self.pid_file,
+            action=self.run,
+            keep_fds=logger.file_descriptors(self.log),
+        )
+
+    def run(self):
+        """Run the queued jobs until the queue is empty
+
+        The queue stays locked until the supervisor exits, so no job can
+        be added for this supervisor after it has decided to exit.
+        """
+        if self.saved_directory and os.path.isdir(self.saved_directory):
+            os.chdir(self.saved_directory)
+            self.saved_directory = None
+        self.wakeup, self.saved_signals = engine.setup_wakeup(
+            [signal.SIGHUP, signal.SIGCHLD])
+        self.log.info("Supervisor active with pid: '%d' and '%d' workers",
+                      os.getpid(), self.workers)
+        while True:
+            self.queue.lock()
+            jobs = [task_id for task_id in self.queue.jobs()
+                    if task_id not in self.running.values()]
+            if not jobs and not self.running:
+                self.log.info("Supervisor finished")
+                # the locks of the queue and the pid file are released
+                # only by the exit of the process
+                os.unlink(self.pid_file)
+                os._exit(0)
+            self.queue.unlock()
+            for task_id in jobs:
+                if len(self.running) >= self.workers:
+                    break
+                self.start(task_id)
+            # all the jobs could have been dropped, no worker would wake
+            # the supervisor up
+            if self.running:
+                self.wait()
+
+    def task_data(self, task_id):
+        if self.library is None or task_id not in self.library:
+            self.library = cache.task_library(self.config)
+        return self.library.get(task_id, None)
+
+    def start(self, task_id):
+        """Start the job in a new worker process
+
+        Jobs of unknown or already running tasks are dropped.
+        :param task_id: str
+        """
+        task_data = self.task_data(task_id)
+        task_agent = None
+        if task_data:
+            task_agent = agent.Agent(task_id, self.config, task_data)
+        if task_agent is None or task_agent.running():
+            self.log.error("Task: '%s' is %s, job removed", task_id,
+                           'running' if task_agent else 'not found')
+            self.remove(task_id)
+            return
+        state.close()
+        pid = os.fork()
+        if pid == 0:
+            code = common.STATUS.error.code
+            try:
+                engine.restore_wakeup(self.wakeup, self.saved_signals)
+                code = task_agent.supervised_run()
+            except Exception as e:
+                self.log.exception(str(e))
+            finally:
+                os._exit(code or 0)
+        self.log.debug("Task: '%s' worker started with pid: '%d'",
+                       task_id, pid)
+        self.running[pid] = task_id
+
+    def wait(self):
+        """Wait for a signal and collect the finished workers
+
+        Signals received since the last wait are kept in the wakeup pipe.
+        """
+        engine.wait_wakeup(self.wakeup)
+        while self.running:
+            try:
+                pid, exit_status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if pid == 0:
+                break
+            if pid not in self.running:
+                continue
+            task_id = self.running.pop(pid)
+            self.log.debug("Task: '%s' worker finished with code: '%s'",
+                           task_id, os.WEXITSTATUS(exit_status))
+            self.remove(task_id)
+
+    def remove(self, task_id):
+        self.queue.lock()
+        try:
+            self.queue.remove(task_id)
+        finally:
+            self.queue.unlock()
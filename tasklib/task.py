@@ -27,18 +27,33 @@ report files.
 * A task SHOULD run pre, task and post if 'run' method is called. Failed
   action stops the run.
 * A task SHOULD collect reports from tests and actions and save them to the
-  report files.
-* A task SHOULD maintain the status file with its current status.
+  state backend. Full output of actions is saved to the output files and
+  their artifacts to the artifacts directory of the action.
+* A task SHOULD maintain its current status in the state backend.
+* A task SHOULD record durations of its actions to the run history.
+* A task SHOULD record the monotonic start and end times of its actions and
+  the run times and resource usage of their commands as the timing of the
+  last run.
+* In the incremental mode a task SHOULD NOT run again if the last run was
+  successful and the fingerprint of its metadata and the files used by its
+  actions is the same. The 'force' option disables this check.
 * A task SHOULD return the current status and its code when
   'status' and 'code' methods are called.
 * A task should return the reports of tests and actions when
   the 'report' method is called with 'pre', 'task' and 'post' parameters
+* A task SHOULD provide its run as a generator of steps with 'steps' so
+  engines can run many tasks at once. 'run' runs these steps in turn.
+* A task SHOULD NOT change the current directory, actions are given
+  the task directory to run in.
 * A task MUST NOT go into the details of how an action is working.
 * A task MUST NOT interfere with pid, status and other Agent's jobs.
 
 * Task's 'parameters' contains the actual job the task should do
 * Pre test is run before the task and, it it fails, task will not be started
   at all. Pre test parameters are inside 'test_pre'.
+* Actions are retried if 'retries' and 'interval' are set in their
+  parameters. An action running longer than its 'timeout' is killed and
+  the task gets the 'timeout' status.
 * Post test is run after the task and, it it fails, task is considered
   unsuccessful even if the task itself did not fail. Post test parameters
   are inside 'test_post'.
@@ -48,11 +63,19 @@ report files.
   type. These types should be present in the task or an action data.
 """
 
+import hashlib
+import json
 import os
+import shutil
+import time
 from tasklib.actions import shell
 from tasklib.actions import puppet
 from tasklib import common
+from tasklib import engine
 from tasklib import exceptions
+from tasklib import history
+from tasklib import resources
+from tasklib import state
 from contextlib import contextmanager
 
 # use stevedore here
@@ -70,8 +93,8 @@ class Task(object):
         self.log = agent.log
         self.data = data
         self._status = None
-        self._report = {}
-        self.saved_directory = None
+        self.durations = {}
+        self.timing = {}
         self.verify()
         self.log.debug("Task: '%s' task init", self.id)
 
@@ -145,60 +168,120 @@ class Task(object):
 
     ##
 
-    def report_file(self, action):
-        return os.path.join(self.config['report_dir'], self.id + '.' + action)
+    @property
+    def state(self):
+        return state.backend(self.config)
+
+    def output_file(self, action, stream):
+        return os.path.join(self.config['report_dir'],
+                            '%s.%s.%s' % (self.id, action, stream))
+
+    def artifacts_directory(self, action):
+        return os.path.join(self.config['report_dir'],
+                            '%s.%s.artifacts' % (self.id, action))
 
-    def status_file(self):
-        return os.path.join(self.config['status_dir'], self.id + '.status')
+    def fingerprint_file(self):
+        return os.path.join(self.config['status_dir'],
+                            self.id + '.fingerprint')
 
     ##
 
     def save_status(self, status):
         self._status = status
         #TODO set process title to Task(id) - status
-        status_file = self.status_file()
-        if status is None:
-            self.remove_status_file()
-            return
-        with open(status_file, 'w') as f:
-            f.write(status)
+        self.state.set_status(self.id, status)
 
     def save_report(self, action, report):
         if report is None:
-            if action in self._report:
-                del self._report[action]
             self.remove_report_file(action)
         else:
-            self._report[action] = report
-            with open(self.report_file(action), 'w') as f:
-                f.write(report)
+            self.state.set_report(self.id, action, report)
+
+    def save_artifacts(self, action, artifacts):
+        directory = self.artifacts_directory(action)
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        if not artifacts:
+            return
+        common.ensure_dir_created(directory)
+        for name, content in artifacts.iteritems():
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(content)
 
     ##
 
-    def remove_status_file(self):
-        status_file = self.status_file()
-        if not os.path.exists(status_file):
+    def save_fingerprint(self, fingerprint):
+        if fingerprint is None:
+            if os.path.exists(self.fingerprint_file()):
+                os.unlink(self.fingerprint_file())
+            return
+        with open(self.fingerprint_file(), 'w') as f:
+            f.write(fingerprint)
+
+    def saved_fingerprint(self):
+        if not os.path.exists(self.fingerprint_file()):
             return None
-        os.unlink(status_file)
+        with open(self.fingerprint_file(), 'r') as f:
+            return f.read()
+
+    def fingerprint(self):
+        """Calculate the fingerprint of the task inputs
+
+        :rtype: str
+        :return: hex digest of the metadata and the files used by actions
+        """
+        digest = hashlib.sha1()
+        digest.update(json.dumps(self.data, sort_keys=True, default=str))
+        for action_type, data in ((self.pre_type, self.pre_data),
+                                  (self.type, self.task_data),
+                                  (self.post_type, self.post_data)):
+            if not data:
+                continue
+            for path in self.action(action_type, data).fingerprint_paths():
+                common.update_digest(digest, path)
+        return digest.hexdigest()
+
+    def up_to_date(self, fingerprint):
+        if self.config['force']:
+            return False
+        if self.status() != common.STATUS.success.name:
+            return False
+        return self.saved_fingerprint() == fingerprint
 
     def remove_report_file(self, action):
-        report_file = self.report_file(action)
-        if not os.path.exists(report_file):
-            return None
-        os.unlink(report_file)
+        self.state.set_report(self.id, action, None)
+        for path in (self.output_file(action, 'stdout'),
+                     self.output_file(action, 'stderr')):
+            if os.path.exists(path):
+                os.unlink(path)
+        if os.path.isdir(self.artifacts_directory(action)):
+            shutil.rmtree(self.artifacts_directory(action))
 
     ##
 
-    def report(self, action):
-        # return report from memory if present
-        if action in self._report:
-            return self._report[action]
-
-        # read report from file
-        report_file = self.report_file(action)
-        if not os.path.exists(report_file):
+    def report(self, action, **page):
+        """Read the saved report of the action
+
+        Reports are not kept in memory, they are read from the state
+        backend every time and can be read by pages.
+        :param action: 'pre', 'task' or 'post'
+        :param page: head, tail, offset and length of reports.read
+        :rtype: str
+        """
+        return self.state.report(self.id, action, **page)
+
+    def artifact(self, action, name):
+        """Read an artifact saved by the action
+
+        :param action: 'pre', 'task' or 'post'
+        :param name: file name of the artifact
+        :rtype: str
+        :return: the contents or None if there is no such artifact
+        """
+        path = os.path.join(self.artifacts_directory(action), name)
+        if not os.path.isfile(path):
             return None
-        with open(report_file, 'r') as f:
+        with open(path, 'r') as f:
             return f.read()
 
     def code(self):
@@ -212,103 +295,188 @@ class Task(object):
         if self._status:
             return self._status
 
-        # read status from file
-        status_file = self.status_file()
-        if not os.path.exists(status_file):
+        # read status from the state backend
+        status = self.state.status(self.id)
+        if status is None:
             return common.STATUS.not_found.name
-        with open(status_file, 'r') as f:
-            return f.read()
+        return status
 
     ##
 
     def verify(self):
         if not self.id and self.type:
             raise exceptions.NotValidMetadata(str(self))
+        # invalid resource limits are reported before anything is run
+        resources.Limits.for_task(self)
 
     def reset(self):
         self.save_status(None)
+        self.save_fingerprint(None)
+        self.state.set_timing(self.id, None)
         for action in ['pre', 'task', 'post']:
             self.save_report(action, None)
 
-    def action(self, action_type, data):
+    def action(self, action_type, data, phase=None):
         action_class = type_mapping.get(action_type)
         if action_class is None:
             raise exceptions.NotValidMetadata(str(self))
-        action = action_class(self, data)
+        action = action_class(self, data, phase)
         return action
 
-    @contextmanager
-    def inside_task_directory(self):
-        self.saved_directory = None
+    @property
+    def working_directory(self):
+        """Directory to run the actions in
+
+        :rtype: str
+        :return: task directory or None if it's not present
+        """
         if self.task_directory and os.path.isdir(self.task_directory):
-            self.saved_directory = os.getcwd()
-            os.chdir(self.task_directory)
-        yield
-        if self.saved_directory:
-            os.chdir(self.saved_directory)
+            return self.task_directory
+        return None
 
     ##
 
-    def run(self):
-        self.log.debug("Task: '%s' run start", self.id)
+    def save_timing(self, started, phases):
+        """Save the timing of the last run
 
-        try:
-            self.save_status(common.STATUS.run_pre.name)
-            self.pre()
-        except exceptions.Failed:
-            self.log.warning("Task: '%s' pre test failed!", self.id)
-            self.save_status(common.STATUS.fail_pre.name)
-            return common.STATUS.fail_pre.code
+        :param started: wall clock start time of the run
+        :param phases: dict of phase timings
+        """
+        self.state.set_timing(self.id, {
+            'time': started,
+            'status': self.status(),
+            'phases': phases,
+        })
 
-        try:
-            self.save_status(common.STATUS.run_task.name)
-            self.task()
-        except exceptions.Failed:
-            self.log.warning("Task: '%s' task failed!", self.id)
-            self.save_status(common.STATUS.fail_task.name)
-            return common.STATUS.fail_task.code
+    def last_timing(self):
+        """Timing of the last run
+
+        :rtype: dict
+        :return: the start time, the status and the timings of the phases
+                 or None if it's not recorded
+        """
+        return self.state.timing(self.id)
 
+    @contextmanager
+    def timer(self, action):
+        start = common.monotonic()
         try:
-            self.save_status(common.STATUS.run_post.name)
-            self.post()
-        except exceptions.Failed:
-            self.log.warning("Task: '%s' post test failed!", self.id)
-            self.save_status(common.STATUS.fail_post.name)
-            return common.STATUS.fail_post.code
+            yield
+        finally:
+            end = common.monotonic()
+            self.durations[action] = end - start
+            self.timing.setdefault(action, {}).update({
+                'start': start,
+                'end': end,
+                'duration': end - start,
+            })
 
-        self.save_status(common.STATUS.success.name)
+    def run(self):
+        engine.run(self.steps())
+        return self.code()
+
+    def steps(self):
+        """Steps of the task run for the engines
+
+        :return: generator of steps
+        """
+        self.log.debug("Task: '%s' run start", self.id)
+        fingerprint = None
+        if self.config['incremental']:
+            fingerprint = self.fingerprint()
+            if self.up_to_date(fingerprint):
+                self.log.info("Task: '%s' is up to date, skipping run",
+                              self.id)
+                self.save_status(common.STATUS.success.name)
+                return
+        self.save_fingerprint(None)
+        self.durations = {}
+        self.timing = {}
+        started = time.time()
+        yield self.run_actions()
+        history.record(self.config, self.id, self.status(), self.durations)
+        # phases without an action have no commands
+        self.save_timing(started, dict(
+            (phase, timing) for phase, timing in self.timing.iteritems()
+            if 'commands' in timing))
+        if self.success():
+            self.save_fingerprint(fingerprint)
         self.log.debug("Task: '%s' run end", self.id)
-        return common.STATUS.success.code
+
+    def run_actions(self):
+        for action, name in (('pre', 'pre test'),
+                             ('task', 'task'),
+                             ('post', 'post test')):
+            try:
+                self.save_status(getattr(common.STATUS, 'run_' + action).name)
+                with self.timer(action):
+                    yield self.phase_steps(action)
+            except exceptions.TimedOut:
+                self.log.warning("Task: '%s' %s timed out!", self.id, name)
+                self.save_status(common.STATUS.timeout.name)
+                return
+            except exceptions.Failed:
+                self.log.warning("Task: '%s' %s failed!", self.id, name)
+                status = getattr(common.STATUS, 'fail_' + action)
+                self.save_status(status.name)
+                return
+            except Exception:
+                # the phase must not be left looking running
+                self.log.exception("Task: '%s' %s error!", self.id, name)
+                status = getattr(common.STATUS, 'fail_' + action)
+                self.save_status(status.name)
+                raise
+
+        self.save_status(common.STATUS.success.name)
+
+    def run_action(self, action):
+        """Run the action retrying it if it fails
+
+        The action is run again 'retries' times waiting 'interval' seconds
+        before each retry. The waiting is a step of the engine so it
+        does not delay the other tasks.
+        :param action: Action
+        :return: generator of steps
+        """
+        attempt = 0
+        while True:
+            try:
+                yield action.steps()
+                return
+            except exceptions.Failed:
+                if attempt >= action.retries:
+                    raise
+                attempt += 1
+                self.log.warning("Task: '%s' action: '%s' failed, "
+                                 "retry %d of %d in %s seconds",
+                                 self.id, action.phase, attempt,
+                                 action.retries, action.interval)
+                yield engine.Sleep(action.interval)
+
+    def phase_steps(self, phase):
+        action_type, data = {
+            'pre': (self.pre_type, self.pre_data),
+            'task': (self.type, self.task_data),
+            'post': (self.post_type, self.post_data),
+        }[phase]
+        if not data:
+            return
+        action = self.action(action_type, data, phase)
+        try:
+            self.log.debug("Task: '%s' start action: %s", self.id, phase)
+            yield self.run_action(action)
+        finally:
+            self.timing.setdefault(phase, {})['commands'] = \
+                action.command_stats()
+            self.save_report(phase, action.report())
+            self.save_artifacts(phase, action.artifacts())
+        self.log.debug("Task: '%s' end action: %s", self.id, phase)
 
     def task(self):
-        if not self.task_data:
-            return None
-        action = self.action(self.type, self.task_data)
-        with self.inside_task_directory():
-            self.log.debug("Task: '%s' start action: task", self.id)
-            action.run()
-            report = action.report()
-        self.save_report('task', report)
-        self.log.debug("Task: '%s' end action: task", self.id)
+        engine.run(self.phase_steps('task'))
 
     def pre(self):
-        if not self.pre_data:
-            return None
-        action = self.action(self.pre_type, self.pre_data)
-        with self.inside_task_directory():
-            self.log.debug("Task: '%s' start action: pre", self.id)
-            action.run()
-            report = action.report()
-        self.save_report('pre', report)
-        self.log.debug("Task: '%s' end action: pre", self.id)
+        engine.run(self.phase_steps('pre'))
 
     def post(self):
-        if not self.post_data:
-            return None
-        action = self.action(self.post_type, self.post_data)
-        with self.inside_task_directory():
-            self.log.debug("Task: '%s' start action: post", self.id)
-            action.run()
-            report = action.report()
-        self.save_report('post', report)
-        self.log.debug("Task: '%s' end action: post", self.id)
\ No newline at end of file
+        engine.run(self.phase_steps('post'))
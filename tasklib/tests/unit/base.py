@@ -0,0 +1,37 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tasklib import config
+
+
+class TestCase(unittest.TestCase):
+    """Test case with a configuration using a temporary directory"""
+
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.directory = tempfile.mkdtemp(prefix='tasklib-test-')
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.config = config.Config()
+        for key in ('tasks_directory', 'report_dir', 'pid_dir',
+                    'status_dir'):
+            self.config[key] = self.path(key)
+        self.config['log_file'] = self.path('tasklib.log')
+
+    def path(self, *parts):
+        return os.path.join(self.directory, *parts)
@@ -0,0 +1,65 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+from tasklib.actions import coprocess
+from tasklib import agent
+from tasklib.tests.unit import base
+
+
+class TestActionOutput(base.TestCase):
+
+    def setUp(self):
+        super(TestActionOutput, self).setUp()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+        self.config['report_dir'] = 'report'
+        self.work = self.path('work')
+        os.mkdir(self.work)
+        task_data = {
+            'id': 'task',
+            'type': 'shell',
+            'parameters': {'type': 'shell', 'cmd': 'pwd', 'cwd': self.work},
+        }
+        self.task = agent.Agent('task', self.config, task_data).task
+
+    def test_paths_are_absolute(self):
+        action = self.task.action('shell', self.task.task_data, 'task')
+        self.assertEqual(action.output_file('stdout'),
+                         self.path('report', 'task.task.stdout'))
+        self.assertEqual(action.output_file('stderr'),
+                         self.path('report', 'task.task.stderr'))
+
+    def test_output_of_command_in_task_directory(self):
+        action = self.task.action('shell', self.task.task_data, 'task')
+        self.assertEqual(action.run(), 0)
+        self.assertEqual(action.stdout, self.work + '\n')
+        with open(self.path('report', 'task.task.stdout')) as f:
+            self.assertEqual(f.read(), self.work + '\n')
+        self.assertFalse(os.path.exists(os.path.join(self.work, 'report')))
+
+    def test_persistent_shell(self):
+        # the coprocess keeps the directory it was started in
+        shell = coprocess.coprocess(self.config['persistent_shell'])
+        shell.stop()
+        self.addCleanup(shell.stop)
+        os.chdir(self.work)
+        shell.start()
+        os.chdir(self.directory)
+        data = dict(self.task.task_data, persistent=True)
+        action = self.task.action('shell', data, 'task')
+        self.assertEqual(action.run(), 0)
+        with open(self.path('report', 'task.task.stdout')) as f:
+            self.assertEqual(f.read(), self.work + '\n')
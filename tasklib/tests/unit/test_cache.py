@@ -0,0 +1,87 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+import os
+
+from tasklib import cache
+from tasklib import common
+from tasklib.tests.unit import base
+
+
+class TestLibraryCache(base.TestCase):
+
+    def setUp(self):
+        super(TestLibraryCache, self).setUp()
+        self.config['tasks_pattern'] = 'tasks.yaml'
+
+    def write_tasks(self, directory, *tasks):
+        path = self.path('tasks_directory', directory, 'tasks.yaml')
+        common.ensure_dir_created(os.path.dirname(path))
+        with open(path, 'w') as f:
+            for task_id, cmd in tasks:
+                f.write('- id: %s\n  type: shell\n  cmd: %s\n' %
+                        (task_id, cmd))
+        return path
+
+    def assertSamePrecedence(self, task_id):
+        library = cache.task_library(self.config)
+        self.assertEqual(cache.task_data(self.config, task_id),
+                         library.get(task_id))
+        return library.get(task_id)
+
+    def test_task_from_index(self):
+        self.write_tasks('a', ('first', 'echo 1'), ('second', 'echo 2'))
+        cache.task_library(self.config)
+        self.assertEqual(cache.task_data(self.config, 'second')['cmd'],
+                         'echo 2')
+        self.assertIsNone(cache.task_data(self.config, 'missing'))
+
+    def test_utf8_offsets(self):
+        self.write_tasks('a', ('first', "echo 'h\xc3\xa9llo'"),
+                         ('second', 'echo \xe2\x9c\x93'), ('third', 'echo 3'))
+        cache.task_library(self.config)
+        self.assertEqual(cache.task_data(self.config, 'second')['cmd'],
+                         u'echo \u2713')
+        self.assertEqual(cache.task_data(self.config, 'third')['cmd'],
+                         'echo 3')
+
+    def test_duplicate_ids(self):
+        self.write_tasks('a', ('dup', 'echo a'), ('other', 'echo'))
+        self.write_tasks('b', ('dup', 'echo b'))
+        self.assertSamePrecedence('dup')
+        self.write_tasks('a', ('dup', 'echo changed'), ('other', 'echo'))
+        self.assertSamePrecedence('dup')
+
+    def test_added_file_redefining_task(self):
+        self.write_tasks('a', ('dup', 'echo a'))
+        self.assertEqual(self.assertSamePrecedence('dup')['cmd'], 'echo a')
+        self.write_tasks('a/b', ('dup', 'echo b'))
+        self.assertEqual(cache.task_data(self.config, 'dup')['cmd'],
+                         'echo b')
+        self.assertSamePrecedence('dup')
+
+    def test_removed_file(self):
+        self.write_tasks('a', ('dup', 'echo a'))
+        path = self.write_tasks('a/b', ('dup', 'echo b'))
+        self.assertSamePrecedence('dup')
+        os.unlink(path)
+        self.assertEqual(cache.task_data(self.config, 'dup')['cmd'],
+                         'echo a')
+
+    def test_broken_index(self):
+        self.write_tasks('a', ('first', 'echo 1'))
+        cache.task_library(self.config)
+        with open(cache.LibraryCache(self.config).index_file, 'w') as f:
+            f.write('broken')
+        self.assertEqual(cache.task_data(self.config, 'first')['cmd'],
+                         'echo 1')
@@ -0,0 +1,90 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import signal
+import subprocess
+import time
+import unittest
+
+from tasklib import common
+
+
+def group(cmd):
+    return subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
+
+
+def wait_group_gone(pgid, timeout=5):
+    """Orphans of the group are reaped by init, give it some time"""
+    deadline = common.monotonic() + timeout
+    while common.group_exists(pgid) and common.monotonic() < deadline:
+        time.sleep(0.01)
+    return not common.group_exists(pgid)
+
+
+class TestWaitProcess(unittest.TestCase):
+
+    def test_exit_code(self):
+        command = group('exit 3')
+        self.assertEqual(common.wait_process(command), 3)
+        self.assertIn('user', command.rusage)
+
+    def test_exit_code_before_deadline(self):
+        command = group('exit 0')
+        deadline = common.monotonic() + 5
+        self.assertEqual(common.wait_process(command, deadline), 0)
+
+    def test_deadline(self):
+        command = group('exec sleep 5')
+        self.addCleanup(common.kill_group, command, 0)
+        started = common.monotonic()
+        self.assertIsNone(common.wait_process(command, started + 0.05))
+        self.assertLess(common.monotonic() - started, 1)
+        self.assertIsNone(command.returncode)
+
+    def test_killed(self):
+        command = group('kill -9 $$')
+        self.assertEqual(common.wait_process(command), -signal.SIGKILL)
+
+
+class TestKillGroup(unittest.TestCase):
+
+    def test_terminate(self):
+        command = group('sleep 5 & exec sleep 5')
+        started = common.monotonic()
+        common.kill_group(command, 5)
+        self.assertLess(common.monotonic() - started, 5)
+        self.assertEqual(command.returncode, -signal.SIGTERM)
+        self.assertTrue(wait_group_gone(command.pid))
+
+    def test_kill_ignoring_sigterm(self):
+        command = group('trap "" TERM; sleep 5; true')
+        time.sleep(0.1)
+        common.kill_group(command, 0.1)
+        self.assertEqual(command.returncode, -signal.SIGKILL)
+        self.assertTrue(wait_group_gone(command.pid))
+
+    def test_kill_rest_of_group(self):
+        # the command exits on SIGTERM but leaves a process ignoring it
+        command = group('(trap "" TERM; sleep 5; true) & exec sleep 5')
+        time.sleep(0.1)
+        common.kill_group(command, 0.1)
+        self.assertEqual(command.returncode, -signal.SIGTERM)
+        self.assertTrue(wait_group_gone(command.pid))
+
+    def test_finished_command(self):
+        command = group('exit 2')
+        command.wait()
+        common.kill_group(command, 5)
+        self.assertEqual(command.returncode, 2)
@@ -0,0 +1,176 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sys
+import unittest
+
+from tasklib import common
+from tasklib import engine
+
+
+class Failing(object):
+    """Operation failing to start"""
+
+    deadline = None
+
+    def start(self):
+        raise ValueError('start')
+
+    def poll(self):
+        return True
+
+    def wait(self):
+        self.start()
+
+
+def failing(message):
+    yield 'value'
+    raise ValueError(message)
+
+
+def catching(log, inner):
+    try:
+        yield inner
+    except ValueError as e:
+        log.append(('caught', str(e)))
+    value = yield 'sent back'
+    log.append(('value', value))
+
+
+class TestCoroutine(unittest.TestCase):
+
+    def test_values_are_sent_back(self):
+        log = []
+
+        def steps():
+            log.append((yield 1))
+            log.append((yield 'two'))
+
+        coroutine = engine.Coroutine(steps())
+        self.assertIsNone(coroutine.step())
+        self.assertTrue(coroutine.done)
+        self.assertEqual(log, [1, 'two'])
+
+    def test_inner_error_raised_at_yield(self):
+        log = []
+        coroutine = engine.Coroutine(catching(log, failing('inner')))
+        self.assertIsNone(coroutine.step())
+        self.assertEqual(log, [('caught', 'inner'), ('value', 'sent back')])
+
+    def test_error_through_many_generators(self):
+        log = []
+
+        def middle():
+            yield failing('deep')
+            log.append('not reached')
+
+        coroutine = engine.Coroutine(catching(log, middle()))
+        self.assertIsNone(coroutine.step())
+        self.assertEqual(log[0], ('caught', 'deep'))
+
+    def test_uncaught_error(self):
+        def outer():
+            yield failing('uncaught')
+
+        coroutine = engine.Coroutine(outer())
+        self.assertRaisesRegexp(ValueError, 'uncaught', coroutine.step)
+        self.assertTrue(coroutine.done)
+
+    def test_operation_error_raised_at_yield(self):
+        log = []
+        sleep = engine.Sleep(0)
+
+        def steps():
+            try:
+                yield sleep
+            except ValueError as e:
+                log.append(str(e))
+
+        coroutine = engine.Coroutine(steps())
+        self.assertIs(coroutine.step(), sleep)
+        try:
+            raise ValueError('operation')
+        except ValueError:
+            self.assertIsNone(coroutine.step(sys.exc_info()))
+        self.assertEqual(log, ['operation'])
+
+
+class TestRun(unittest.TestCase):
+
+    def test_run(self):
+        log = []
+
+        def steps():
+            yield engine.Sleep(0.01)
+            try:
+                yield Failing()
+            except ValueError as e:
+                log.append(str(e))
+            yield failing('run')
+
+        self.assertRaisesRegexp(ValueError, 'run', engine.run, steps())
+        self.assertEqual(log, ['start'])
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def test_callbacks(self):
+        results = {}
+
+        def steps(seconds, error=None):
+            yield engine.Sleep(seconds)
+            if error:
+                raise ValueError(error)
+
+        def callback(name):
+            return lambda error: results.update({
+                name: error and str(error[1])})
+
+        async_engine = engine.AsyncEngine(2)
+        for name, seconds, error in (('a', 0.05, None), ('b', 0.01, 'b'),
+                                     ('c', 0, None)):
+            async_engine.spawn(steps(seconds, error), callback(name))
+        started = common.monotonic()
+        async_engine.run()
+        self.assertLess(common.monotonic() - started, 1)
+        self.assertEqual(results, {'a': None, 'b': 'b', 'c': None})
+
+    def test_commands_are_limited(self):
+        finished = []
+
+        def steps(name):
+            command = common.Command('exit 0')
+            yield command
+            finished.append((name, command.code))
+
+        async_engine = engine.AsyncEngine(1)
+        for name in 'abc':
+            async_engine.spawn(steps(name))
+        self.assertEqual(async_engine.commands, 1)
+        self.assertEqual(len(async_engine.queue), 2)
+        async_engine.run()
+        self.assertEqual(finished, [('a', 0), ('b', 0), ('c', 0)])
+
+
+class TestCommand(unittest.TestCase):
+
+    def test_timeout(self):
+        code, stdout, stderr = common.execute('echo out; exec sleep 5',
+                                              timeout=0.1)
+        self.assertIsNone(code)
+        self.assertEqual(stdout, 'out\n')
+
+    def test_output(self):
+        self.assertEqual(common.execute('echo out; echo err >&2; exit 1'),
+                         (1, 'out\n', 'err\n'))
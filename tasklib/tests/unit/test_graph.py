@@ -0,0 +1,69 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from tasklib import exceptions
+from tasklib import graph
+
+
+def library(**requires):
+    return dict((task_id, {'id': task_id, 'requires': required})
+                for task_id, required in requires.iteritems())
+
+
+class TestGraph(unittest.TestCase):
+
+    def test_no_cycle(self):
+        tasks = graph.Graph(library(a=[], b=['a'], c=['a', 'b']))
+        self.assertIsNone(tasks.find_cycle())
+
+    def test_find_cycle(self):
+        tasks = graph.Graph(library(a=['c'], b=['a'], c=['b'], d=['a']))
+        cycle = tasks.find_cycle()
+        self.assertEqual(cycle[0], cycle[-1])
+        self.assertEqual(set(cycle), set(['a', 'b', 'c']))
+
+    def test_self_cycle(self):
+        tasks = graph.Graph(library(a=['a'], b=[]))
+        self.assertEqual(tasks.find_cycle(), ['a', 'a'])
+
+    def test_cycle_after_visited_branch(self):
+        tasks = graph.Graph(library(a=[], b=['a', 'd'], c=['b'], d=['c']))
+        self.assertEqual(set(tasks.find_cycle()), set(['b', 'c', 'd']))
+
+    def test_deep_chain_has_no_recursion_limit(self):
+        requires = dict(('t%05d' % i, ['t%05d' % (i - 1)] if i else [])
+                        for i in range(5000))
+        tasks = graph.Graph(library(**requires))
+        self.assertIsNone(tasks.find_cycle())
+        self.assertEqual(tasks.topology(), sorted(requires))
+
+    def test_topology(self):
+        tasks = graph.Graph(library(d=['b', 'c'], c=['a'], b=['a'], a=[]))
+        self.assertEqual(tasks.topology(), ['a', 'b', 'c', 'd'])
+
+    def test_topology_required_for(self):
+        data = library(a=[], b=[])
+        data['b']['required_for'] = 'a'
+        self.assertEqual(graph.Graph(data).topology(), ['b', 'a'])
+
+    def test_topology_ignores_other_tasks(self):
+        tasks = graph.Graph(library(a=['missing'], b=['a'], c=['b']),
+                            ['b', 'c'])
+        self.assertEqual(tasks.topology(), ['b', 'c'])
+
+    def test_topology_of_cycle(self):
+        tasks = graph.Graph(library(a=['b'], b=['a']))
+        self.assertRaises(exceptions.CycleDetected, tasks.topology)
@@ -0,0 +1,107 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fcntl
+import os
+import threading
+
+from tasklib import exceptions
+from tasklib import locks
+from tasklib.tests.unit import base
+
+
+class TestTaskLock(base.TestCase):
+
+    def lock(self, task_id='task'):
+        task_lock = locks.TaskLock(self.config, task_id)
+        self.addCleanup(task_lock.release)
+        return task_lock
+
+    def test_acquire_and_release(self):
+        task_lock = self.lock()
+        self.assertIsNone(task_lock.holder())
+        task_lock.acquire()
+        self.assertEqual(self.lock().holder()['pid'], os.getpid())
+        self.assertEqual(locks.running(self.config).keys(), ['task'])
+        task_lock.release()
+        self.assertIsNone(self.lock().holder())
+        self.assertEqual(locks.running(self.config), {})
+
+    def test_already_running(self):
+        self.lock().acquire()
+        with self.assertRaises(exceptions.AlreadyRunning) as context:
+            self.lock().acquire()
+        self.assertEqual(context.exception.pid, os.getpid())
+
+    def test_other_task(self):
+        self.lock().acquire()
+        self.lock('other').acquire()
+
+    def test_acquire_while_probed(self):
+        task_lock = self.lock()
+        task_lock.acquire()
+        task_lock.release()
+        # a probe holds a shared lock for a moment
+        fd = os.open(task_lock.path, os.O_RDONLY)
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        timer = threading.Timer(locks.ACQUIRE_RETRY / 5, os.close, [fd])
+        timer.start()
+        try:
+            task_lock.acquire()
+        finally:
+            timer.join()
+        self.assertIsNotNone(task_lock.fd)
+
+    def test_lock_not_inherited(self):
+        task_lock = self.lock()
+        task_lock.acquire()
+        flags = fcntl.fcntl(task_lock.fd, fcntl.F_GETFD)
+        self.assertTrue(flags & fcntl.FD_CLOEXEC)
+
+
+class TestSemaphore(base.TestCase):
+
+    def semaphore(self, group='shell', limit=2):
+        semaphore = locks.Semaphore(self.config, group, limit)
+        self.addCleanup(semaphore.release)
+        return semaphore
+
+    def test_limit(self):
+        first, second, third = [self.semaphore() for _ in range(3)]
+        self.assertTrue(first.try_acquire())
+        self.assertTrue(second.try_acquire())
+        self.assertFalse(third.try_acquire())
+        third.start()
+        self.assertFalse(third.poll())
+        self.assertIsNotNone(third.deadline)
+        first.release()
+        self.assertTrue(third.poll())
+
+    def test_groups_are_separate(self):
+        self.assertTrue(self.semaphore(limit=1).try_acquire())
+        self.assertTrue(self.semaphore('puppet', 1).try_acquire())
+        self.assertFalse(self.semaphore(limit=1).try_acquire())
+
+    def test_semaphore_of_task(self):
+        self.config['concurrency_limits'] = {'puppet': 1, 'default': 3}
+        puppet = locks.semaphore(self.config, {'type': 'puppet'})
+        self.assertEqual((puppet.group, puppet.limit), ('puppet', 1))
+        grouped = locks.semaphore(self.config, {
+            'type': 'shell', 'concurrency_group': 'db'})
+        self.assertEqual((grouped.group, grouped.limit), ('db', 3))
+
+    def test_no_limit(self):
+        self.assertIsNone(locks.semaphore(self.config, {'type': 'shell'}))
+        self.config['concurrency_limits'] = {'shell': 0}
+        self.assertIsNone(locks.semaphore(self.config, {'type': 'shell'}))
@@ -0,0 +1,109 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import json
+import os
+import signal
+import socket
+import time
+
+import yaml
+
+from tasklib import cli
+from tasklib import client
+from tasklib import common
+from tasklib.tests.unit import base
+
+
+class TestServer(base.TestCase):
+
+    def setUp(self):
+        super(TestServer, self).setUp()
+        common.ensure_dir_created(self.config['tasks_directory'])
+        with open(self.path('tasks_directory', 'tasks.yaml'), 'w') as f:
+            f.write("- id: binary\n"
+                    "  type: shell\n"
+                    "  parameters:\n"
+                    "    type: shell\n"
+                    "    cmd: printf 'out \\377\\376\\n'\n")
+        self.config_file = self.path('conf.yaml')
+        with open(self.config_file, 'w') as f:
+            yaml.safe_dump(self.config.config, f)
+        self.socket = self.path('tasklib.sock')
+        saved_socket = os.environ.get('TASKLIB_SOCKET', None)
+        os.environ['TASKLIB_SOCKET'] = self.socket
+        self.addCleanup(self.restore_socket, saved_socket)
+        self.start_server()
+
+    @staticmethod
+    def restore_socket(saved_socket):
+        if saved_socket is None:
+            del os.environ['TASKLIB_SOCKET']
+        else:
+            os.environ['TASKLIB_SOCKET'] = saved_socket
+
+    def start_server(self):
+        pid = os.fork()
+        if not pid:
+            try:
+                cli.CmdApi().parse(['-c', self.config_file, 'serve'])
+            finally:
+                os._exit(0)
+        self.addCleanup(self.stop_server, pid)
+        deadline = common.monotonic() + 5
+        while not os.path.exists(self.socket):
+            self.assertLess(common.monotonic(), deadline)
+            time.sleep(0.01)
+
+    @staticmethod
+    def stop_server(pid):
+        os.kill(pid, signal.SIGTERM)
+        while True:
+            try:
+                os.waitpid(pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+            return
+
+    def request(self, *argv):
+        return client.request(['-c', self.config_file] + list(argv))
+
+    def test_binary_output(self):
+        code, stdout, stderr = self.request('run', 'binary')
+        self.assertEqual(code, 0, stderr)
+        code, stdout, stderr = self.request('report', 'binary')
+        self.assertEqual(code, 0, stderr)
+        self.assertIn(u'out \ufffd\ufffd', stdout)
+        code, stdout, stderr = self.request('status', 'binary')
+        self.assertEqual((code, stderr), (0, ''))
+        self.assertIn('success', stdout)
+
+    def test_refused(self):
+        self.assertIsNone(client.request(['conf']))
+        self.assertIsNone(client.request(['list']))
+
+    def test_server_error(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(connection.close)
+        connection.connect(self.socket)
+        connection.sendall(json.dumps({
+            'argv': ['-c', self.config_file, 'list'],
+            'cwd': self.path('missing'),
+        }) + '\n')
+        response = json.loads(connection.makefile('rb').readline())
+        self.assertTrue(response['served'])
+        self.assertEqual(response['code'], common.STATUS.error.code)
+        self.assertIn('Server error', response['stderr'])
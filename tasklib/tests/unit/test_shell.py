@@ -0,0 +1,67 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from tasklib import agent
+from tasklib import common
+from tasklib import exceptions
+from tasklib import state
+from tasklib.tests.unit import base
+
+
+class TestSplitCommand(unittest.TestCase):
+
+    def test_simple_command(self):
+        self.assertEqual(common.split_command("echo 'a b' c"),
+                         ['echo', 'a b', 'c'])
+
+    def test_shell_needed(self):
+        for cmd in ('echo a | cat', 'echo $HOME', 'ls *', 'cd /tmp',
+                    'A=1 env', 'echo "unclosed', '', 'true; false',
+                    'echo a > /dev/null'):
+            self.assertIsNone(common.split_command(cmd), cmd)
+
+
+class TestShellAction(base.TestCase):
+
+    def task(self, cmd):
+        task_data = {
+            'id': 'task',
+            'type': 'shell',
+            'parameters': {'type': 'shell', 'cmd': cmd},
+        }
+        return agent.Agent('task', self.config, task_data).task
+
+    def test_direct_and_shell_commands(self):
+        for mode in ('direct', 'shell'):
+            self.config['exec_mode'] = mode
+            for cmd in ('echo a', 'echo a | cat'):
+                action = self.task(cmd).action('shell', {'cmd': cmd})
+                self.assertEqual(action.run(), 0)
+                self.assertEqual(action.stdout, 'a\n')
+
+    def test_not_a_string(self):
+        for cmd in (False, 123, None, ['ls']):
+            task = self.task(cmd)
+            self.assertRaises(exceptions.NotValidMetadata, task.action,
+                              'shell', {'cmd': cmd})
+            self.assertRaises(exceptions.NotValidMetadata, task.run)
+            self.assertEqual(state.FileState(self.config).status('task'),
+                             'fail_task')
+
+    def test_missing_command(self):
+        task = self.task('true')
+        self.assertRaises(exceptions.NotValidMetadata, task.action,
+                          'shell', {})
@@ -0,0 +1,102 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from tasklib import common
+from tasklib import state
+from tasklib.tests.unit import base
+
+
+class TestStateParity(base.TestCase):
+    """The file and sqlite backends give the same results"""
+
+    def setUp(self):
+        super(TestStateParity, self).setUp()
+        for key in ('report_dir', 'pid_dir', 'status_dir'):
+            common.ensure_dir_created(self.config[key])
+        self.config['history_size'] = 2
+
+    def backends(self):
+        backends = []
+        for backend_class in (state.FileState, state.SqliteState):
+            backend = backend_class(self.config)
+            self.addCleanup(backend.close)
+            backends.append(backend)
+        return backends
+
+    def assertParity(self, check):
+        results = [check(backend) for backend in self.backends()]
+        self.assertEqual(results[0], results[1])
+        return results[0]
+
+    def record(self, status, run_time):
+        return {'time': run_time, 'status': status,
+                'durations': {'task': run_time}}
+
+    def fill(self, backend):
+        backend.set_status('a', 'success')
+        backend.set_status('b', 'failed')
+        backend.set_status('c', 'running')
+        backend.set_status('c', 'success')
+        backend.set_status('d', 'success')
+        backend.set_status('d', None)
+        backend.set_report('a', 'task', 'line 1\nline 2\nline 3\n')
+        backend.set_report('a', 'post', 'post\n')
+        backend.set_report('b', 'task', 'failure\n')
+        backend.set_report('b', 'task', None)
+        for run_time in (1.0, 2.0, 3.0):
+            backend.add_history('a', self.record('success', run_time))
+        backend.add_history('b', self.record('failed', 4.0))
+        backend.set_timing('a', {'task': {'time': 1.5, 'max_rss': None}})
+        backend.set_timing('b', {'task': {'time': 2.5}})
+        backend.set_timing('b', None)
+
+    def test_statuses(self):
+        statuses = self.assertParity(
+            lambda backend: (self.fill(backend), backend.statuses())[1])
+        self.assertEqual(statuses, {'a': 'success', 'b': 'failed',
+                                    'c': 'success'})
+        self.assertParity(lambda backend: backend.statuses('success'))
+        self.assertParity(lambda backend: [
+            backend.status(task_id) for task_id in 'abcde'])
+
+    def test_summary(self):
+        summary = self.assertParity(
+            lambda backend: (self.fill(backend), backend.summary())[1])
+        self.assertEqual(summary['a'], ('success',
+                                        self.record('success', 3.0)))
+        self.assertEqual(summary['c'], ('success', None))
+
+    def test_history(self):
+        history = self.assertParity(
+            lambda backend: (self.fill(backend), backend.history('a'))[1])
+        self.assertEqual(history, [self.record('success', 2.0),
+                                   self.record('success', 3.0)])
+        self.assertParity(lambda backend: backend.history('missing'))
+
+    def test_reports(self):
+        reports = self.assertParity(
+            lambda backend: (self.fill(backend),
+                             backend.reports(['a', 'b', 'c']))[1])
+        self.assertEqual(reports, {'a': {'task': 'line 1\nline 2\nline 3\n',
+                                         'post': 'post\n'}})
+        page = self.assertParity(
+            lambda backend: backend.report('a', 'task', tail=1))
+        self.assertEqual(page, 'line 3\n')
+        self.assertParity(lambda backend: backend.report('a', 'pre'))
+
+    def test_timing(self):
+        timing = self.assertParity(
+            lambda backend: (self.fill(backend), backend.timing('a'))[1])
+        self.assertEqual(timing, {'task': {'time': 1.5, 'max_rss': None}})
+        self.assertParity(lambda backend: backend.timing('b'))
@@ -0,0 +1,149 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import signal
+import threading
+import time
+
+from tasklib import common
+from tasklib import locks
+from tasklib import state
+from tasklib import supervisor
+from tasklib.tests.unit import base
+
+
+class TestJobQueue(base.TestCase):
+
+    def setUp(self):
+        super(TestJobQueue, self).setUp()
+        common.ensure_dir_created(self.config['pid_dir'])
+        self.queue = supervisor.JobQueue(self.config)
+
+    def test_empty(self):
+        self.assertEqual(self.queue.jobs(), [])
+
+    def test_order_and_duplicates(self):
+        self.queue.add(['b', 'a'])
+        self.queue.add(['c', 'a'])
+        self.assertEqual(self.queue.jobs(), ['b', 'a', 'c'])
+        self.queue.remove('a')
+        self.assertEqual(self.queue.jobs(), ['b', 'c'])
+        self.queue.remove('missing')
+        self.assertEqual(self.queue.jobs(), ['b', 'c'])
+
+    def test_shared_by_instances(self):
+        self.queue.add(['a'])
+        self.assertEqual(supervisor.JobQueue(self.config).jobs(), ['a'])
+
+    def test_broken_file(self):
+        with open(self.queue.path, 'w') as f:
+            f.write('{"not": "a list"}')
+        self.assertEqual(self.queue.jobs(), [])
+        with open(self.queue.path, 'w') as f:
+            f.write('[broken')
+        self.assertEqual(self.queue.jobs(), [])
+        self.queue.add(['a'])
+        self.assertEqual(self.queue.jobs(), ['a'])
+
+    def test_lock(self):
+        other = supervisor.JobQueue(self.config)
+        self.queue.lock()
+        thread = threading.Thread(target=other.lock)
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.queue.unlock()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        other.unlock()
+        self.assertIsNone(other.lock_fd)
+
+
+class TestSelect(base.TestCase):
+
+    def test_select(self):
+        library = {
+            'a': {'type': 'shell', 'role': ['controller']},
+            'b': {'type': 'shell', 'role': '*'},
+            'c': {'type': 'puppet', 'groups': ['primary']},
+            'd': {'type': 'shell', 'role': ['compute']},
+            'untyped': {'role': '*'},
+        }
+        self.assertEqual(supervisor.select(library, roles=['controller']),
+                         ['a', 'b'])
+        self.assertEqual(supervisor.select(library, groups=['primary']),
+                         ['c'])
+        self.assertEqual(supervisor.select(library), [])
+
+
+class TestSupervisor(base.TestCase):
+
+    def setUp(self):
+        super(TestSupervisor, self).setUp()
+        common.ensure_dir_created(self.config['pid_dir'])
+        self.library = dict((task_id, {
+            'id': task_id,
+            'type': 'shell',
+            'parameters': {'type': 'shell', 'cmd': cmd},
+        }) for task_id, cmd in (('a', 'true'), ('b', 'exit 1'),
+                                ('c', 'true')))
+        self.supervisor = supervisor.Supervisor(self.config, self.library, 2)
+
+    def run_supervisor(self, timeout=10):
+        """Run the supervisor in a child process as its daemon does
+
+        :rtype: int
+        :return: exit status or None if it was still running
+        """
+        with open(self.supervisor.pid_file, 'w') as f:
+            f.write('0')
+        pid = os.fork()
+        if not pid:
+            try:
+                self.supervisor.run()
+            finally:
+                os._exit(1)
+        deadline = common.monotonic() + timeout
+        while common.monotonic() < deadline:
+            try:
+                finished, exit_status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if finished:
+                return exit_status
+            time.sleep(0.01)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        return None
+
+    def test_run_jobs(self):
+        self.supervisor.queue.add(['a', 'b', 'c'])
+        self.assertEqual(self.run_supervisor(), 0)
+        self.assertEqual(self.supervisor.queue.jobs(), [])
+        self.assertFalse(os.path.exists(self.supervisor.pid_file))
+        self.assertEqual(state.FileState(self.config).statuses(), {
+            'a': 'success', 'b': 'fail_task', 'c': 'success'})
+
+    def test_all_jobs_dropped(self):
+        task_lock = locks.TaskLock(self.config, 'a')
+        task_lock.acquire()
+        self.addCleanup(task_lock.release)
+        self.supervisor.queue.add(['missing', 'a'])
+        self.assertEqual(self.run_supervisor(), 0)
+        self.assertEqual(self.supervisor.queue.jobs(), [])
+        self.assertFalse(os.path.exists(self.supervisor.pid_file))
@@ -0,0 +1,73 @@
+#    Copyright 2014 Mirantis, Inc.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from tasklib import agent
+from tasklib import exceptions
+from tasklib import state
+from tasklib.tests.unit import base
+
+
+class TestRunActions(base.TestCase):
+
+    def task(self, parameters, **data):
+        parameters = dict(parameters, type='shell')
+        data.update({'id': 'task', 'type': 'shell',
+                     'parameters': parameters})
+        return agent.Agent('task', self.config, data).task
+
+    def saved_status(self):
+        return state.FileState(self.config).status('task')
+
+    def test_success(self):
+        task = self.task({'cmd': 'true'}, test_post={'cmd': 'true'})
+        self.assertEqual(task.run(), 0)
+        self.assertEqual(self.saved_status(), 'success')
+
+    def test_failed(self):
+        task = self.task({'cmd': 'exit 1'})
+        task.run()
+        self.assertEqual(self.saved_status(), 'fail_task')
+
+    def test_timeout(self):
+        task = self.task({'cmd': 'exec sleep 5', 'timeout': 0.1})
+        task.run()
+        self.assertEqual(self.saved_status(), 'timeout')
+
+    def test_retries(self):
+        counter = self.path('counter')
+        task = self.task({
+            'cmd': 'echo >> %s; test $(wc -l < %s) -ge 3' % (counter,
+                                                             counter),
+            'retries': 2,
+            'interval': 0.01,
+        })
+        self.assertEqual(task.run(), 0)
+        with open(counter) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_unexpected_error(self):
+        task = self.task({'cmd': 'true'}, test_post={'type': 'unknown'})
+        self.assertRaises(exceptions.NotValidMetadata, task.run)
+        self.assertEqual(self.saved_status(), 'fail_post')
+
+    def test_unexpected_error_in_first_phase(self):
+        task = self.task({'cmd': 'true'})
+
+        def broken_steps(phase):
+            raise OSError('broken')
+            yield
+
+        task.phase_steps = broken_steps
+        self.assertRaises(OSError, task.run)
+        self.assertEqual(self.saved_status(), 'fail_pre')